@@ -0,0 +1,296 @@
+"""
+Search the DeepCache arguments of a model for the best latency/quality tradeoffs.
+
+Each config of the search space (cache_interval, cache_layer_id,
+cache_block_id, and center/pow of the non-uniform schedules) generates the
+images of a prompt set with fixed seeds. It is scored by its latency and by
+the similarity (SSIM or PSNR) of its images with the images of the full UNet
+(cache_interval=1). The Pareto front of the configs is printed as a markdown
+table, and the fastest config on it above `--min-similarity` is saved with
+`onediffx.deep_cache.save_deep_cache_config`, for
+`onediffx.deep_cache.load_deep_cache_config` and the `deep_cache_config`
+input of the OneDiff DeepCache checkpoint loader of ComfyUI.
+
+Usage:
+    python3 benchmarks/deep_cache_search.py --model stabilityai/stable-diffusion-xl-base-1.0 \
+        --output-config sdxl_deep_cache.json --output-table sdxl_deep_cache.md
+    # sample 20 configs of a larger space
+    python3 benchmarks/deep_cache_search.py --intervals 2 3 4 5 6 --centers 10 15 \
+        --search random --trials 20
+
+Changing cache_layer_id or cache_block_id compiles the UNet again, which the
+`--warmups` of each config absorb.
+"""
+MODEL = "stabilityai/stable-diffusion-xl-base-1.0"
+VARIANT = "fp16"
+PIPELINE = "sdxl"
+STEPS = 30
+PROMPTS = [
+    "a photo of an astronaut riding a horse on mars",
+    "street style, detailed, raw photo, woman, face, shot on CineStill 800T",
+    "a cozy cabin in a snowy forest at night, warm light, 4K",
+    "a bowl of ramen on a wooden table, studio lighting",
+]
+SEED = 0
+WARMUPS = 1
+HEIGHT = None
+WIDTH = None
+INTERVALS = [2, 3, 4, 5]
+LAYER_IDS = [0, 1]
+BLOCK_IDS = [0, 1]
+CENTERS = []
+POWS = [1.4]
+MIN_SIMILARITY = 0.9
+
+import argparse
+import itertools
+import json
+import random
+import time
+
+import torch
+import torch.nn.functional as F
+
+from onediffx import compile_pipe
+from onediffx.deep_cache import save_deep_cache_config
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default=MODEL)
+    parser.add_argument("--variant", type=str, default=VARIANT)
+    parser.add_argument("--pipeline", type=str, default=PIPELINE, choices=["sd", "sdxl"])
+    parser.add_argument("--steps", type=int, default=STEPS)
+    parser.add_argument(
+        "--prompts", type=str, default=None, help="A file with one prompt per line"
+    )
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--warmups", type=int, default=WARMUPS)
+    parser.add_argument("--height", type=int, default=HEIGHT)
+    parser.add_argument("--width", type=int, default=WIDTH)
+    parser.add_argument("--intervals", type=int, nargs="+", default=INTERVALS)
+    parser.add_argument("--layer-ids", type=int, nargs="+", default=LAYER_IDS)
+    parser.add_argument("--block-ids", type=int, nargs="+", default=BLOCK_IDS)
+    parser.add_argument(
+        "--centers",
+        type=int,
+        nargs="*",
+        default=CENTERS,
+        help="Centers of the non-uniform schedules, none to search uniform schedules only",
+    )
+    parser.add_argument("--pows", type=float, nargs="+", default=POWS)
+    parser.add_argument("--search", type=str, default="grid", choices=["grid", "random"])
+    parser.add_argument("--trials", type=int, default=20)
+    parser.add_argument("--metric", type=str, default="ssim", choices=["ssim", "psnr"])
+    parser.add_argument("--min-similarity", type=float, default=MIN_SIMILARITY)
+    parser.add_argument("--output-config", type=str, default="deep_cache_config.json")
+    parser.add_argument("--output-table", type=str, default=None)
+    parser.add_argument("--output-json", type=str, default=None)
+    parser.add_argument(
+        "--compiler", type=str, default="oneflow", choices=["none", "oneflow"]
+    )
+    return parser.parse_args()
+
+
+def load_pipe(args):
+    if args.pipeline == "sdxl":
+        from onediffx.deep_cache import StableDiffusionXLPipeline as pipeline_cls
+    else:
+        from onediffx.deep_cache import StableDiffusionPipeline as pipeline_cls
+    extra_kwargs = {}
+    if args.variant is not None:
+        extra_kwargs["variant"] = args.variant
+    pipe = pipeline_cls.from_pretrained(
+        args.model, torch_dtype=torch.float16, **extra_kwargs
+    )
+    pipe.safety_checker = None
+    pipe.to(torch.device("cuda"))
+    if args.compiler == "oneflow":
+        pipe = compile_pipe(pipe)
+    return pipe
+
+
+def candidate_configs(args):
+    configs = []
+    for interval, layer_id, block_id in itertools.product(
+        args.intervals, args.layer_ids, args.block_ids
+    ):
+        base = dict(
+            cache_interval=interval, cache_layer_id=layer_id, cache_block_id=block_id
+        )
+        configs.append(dict(base, uniform=True))
+        for center, pow in itertools.product(args.centers, args.pows):
+            configs.append(dict(base, uniform=False, center=center, pow=pow))
+    if args.search == "random" and args.trials < len(configs):
+        configs = random.Random(args.seed).sample(configs, args.trials)
+    return configs
+
+
+def run_config(pipe, prompts, config, args):
+    """The mean latency (ms) of a prompt and the images of `config`."""
+
+    def generate(prompt):
+        return pipe(
+            prompt=prompt,
+            height=args.height,
+            width=args.width,
+            num_inference_steps=args.steps,
+            generator=torch.Generator(device="cuda").manual_seed(args.seed),
+            output_type="pt",
+            **config,
+        ).images
+
+    for _ in range(args.warmups):
+        generate(prompts[0])
+    images, latencies = [], []
+    for prompt in prompts:
+        torch.cuda.synchronize()
+        begin = time.perf_counter()
+        images.append(generate(prompt).float())
+        torch.cuda.synchronize()
+        latencies.append((time.perf_counter() - begin) * 1000)
+    return sum(latencies) / len(latencies), images
+
+
+def _gaussian_window(size=11, sigma=1.5, channels=3, device=None):
+    x = torch.arange(size, dtype=torch.float32, device=device) - size // 2
+    g = torch.exp(-(x ** 2) / (2 * sigma ** 2))
+    g = g / g.sum()
+    window = g[:, None] @ g[None, :]
+    return window.expand(channels, 1, size, size).contiguous()
+
+
+def ssim(a, b):
+    """The mean SSIM of (N, C, H, W) images in [0, 1]."""
+    channels = a.shape[1]
+    window = _gaussian_window(channels=channels, device=a.device)
+
+    def blur(x):
+        return F.conv2d(x, window, groups=channels)
+
+    mu_a, mu_b = blur(a), blur(b)
+    var_a = blur(a * a) - mu_a ** 2
+    var_b = blur(b * b) - mu_b ** 2
+    cov = blur(a * b) - mu_a * mu_b
+    c1, c2 = 0.01 ** 2, 0.03 ** 2
+    ssim_map = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / (
+        (mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2)
+    )
+    return ssim_map.mean().item()
+
+
+def psnr(a, b):
+    mse = F.mse_loss(a, b).clamp(min=1e-10)
+    return (10 * torch.log10(1 / mse)).item()
+
+
+def similarity(images, references, metric):
+    score = ssim if metric == "ssim" else psnr
+    scores = [score(a, b) for a, b in zip(images, references)]
+    return sum(scores) / len(scores)
+
+
+def pareto_front(results):
+    """The results that no other result beats on both latency and similarity."""
+    front = []
+    for result in sorted(results, key=lambda r: (r["latency_ms"], -r["similarity"])):
+        if len(front) == 0 or result["similarity"] > front[-1]["similarity"]:
+            front.append(result)
+    return front
+
+
+def format_config(config):
+    return ", ".join(f"{k}={v}" for k, v in config.items())
+
+
+def markdown_table(rows, baseline_latency, metric):
+    lines = [
+        f"| config | latency (ms) | speedup | {metric} |",
+        "| --- | --- | --- | --- |",
+    ]
+    for row in rows:
+        lines.append(
+            f"| {format_config(row['config'])} | {row['latency_ms']:.1f} "
+            f"| {baseline_latency / row['latency_ms']:.2f}x | {row['similarity']:.4f} |"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    args = parse_args()
+    if args.prompts is None:
+        prompts = PROMPTS
+    else:
+        with open(args.prompts) as f:
+            prompts = [line.strip() for line in f if line.strip()]
+
+    pipe = load_pipe(args)
+    baseline_latency, references = run_config(pipe, prompts, {"cache_interval": 1}, args)
+    print(f"Baseline (full UNet): {baseline_latency:.1f} ms")
+
+    results = []
+    for config in candidate_configs(args):
+        try:
+            latency, images = run_config(pipe, prompts, config, args)
+        except ValueError as e:
+            # e.g. no pow fits a non-uniform schedule
+            print(f"Skip {format_config(config)}: {e}")
+            continue
+        result = {
+            "config": config,
+            "latency_ms": latency,
+            "similarity": similarity(images, references, args.metric),
+        }
+        print(
+            f"{format_config(config)}: {latency:.1f} ms, "
+            f"{args.metric} {result['similarity']:.4f}"
+        )
+        results.append(result)
+
+    front = pareto_front(results)
+    table = markdown_table(front, baseline_latency, args.metric)
+    print("=======================================")
+    print(table)
+    if args.output_table is not None:
+        with open(args.output_table, "w") as f:
+            f.write(table + "\n")
+    if args.output_json is not None:
+        with open(args.output_json, "w") as f:
+            json.dump(
+                {"baseline_latency_ms": baseline_latency, "results": results},
+                f,
+                indent=2,
+            )
+
+    if len(front) == 0:
+        print("No config ran, nothing to recommend")
+        return
+    accepted = [r for r in front if r["similarity"] >= args.min_similarity]
+    if len(accepted) > 0:
+        recommended = accepted[0]
+    else:
+        print(f"No config reaches {args.metric} {args.min_similarity}")
+        recommended = front[-1]
+    save_deep_cache_config(
+        args.output_config,
+        recommended["config"],
+        metrics={
+            "model": args.model,
+            "pipeline": args.pipeline,
+            "num_inference_steps": args.steps,
+            "height": args.height,
+            "width": args.width,
+            "latency_ms": recommended["latency_ms"],
+            "baseline_latency_ms": baseline_latency,
+            "speedup": baseline_latency / recommended["latency_ms"],
+            args.metric: recommended["similarity"],
+        },
+    )
+    print(
+        f"Recommended {format_config(recommended['config'])}, "
+        f"saved to {args.output_config}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -135,13 +135,30 @@ class IterationProfiler:
         return callback_kwargs
 
 
+def get_deep_cache_pipeline_cls(args):
+    from diffusers import DiffusionPipeline
+    import onediffx.deep_cache as deep_cache
+
+    is_xl = "XL" in DiffusionPipeline.load_config(args.model)["_class_name"]
+    if args.controlnet is not None:
+        if args.input_image is not None:
+            raise ValueError("DeepCache does not support ControlNet img2img yet")
+        task = "ControlNet"
+    elif args.input_image is not None:
+        task = "Img2Img"
+    else:
+        task = ""
+    return getattr(
+        deep_cache, f"StableDiffusion{'XL' if is_xl else ''}{task}Pipeline"
+    )
+
+
 def main():
     args = parse_args()
-    if args.input_image is None:
-        if args.deepcache:
-            from onediffx.deep_cache import StableDiffusionXLPipeline as pipeline_cls
-        else:
-            from diffusers import AutoPipelineForText2Image as pipeline_cls
+    if args.deepcache:
+        pipeline_cls = get_deep_cache_pipeline_cls(args)
+    elif args.input_image is None:
+        from diffusers import AutoPipelineForText2Image as pipeline_cls
     else:
         from diffusers import AutoPipelineForImage2Image as pipeline_cls
 
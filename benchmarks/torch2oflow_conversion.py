@@ -0,0 +1,197 @@
+"""
+Benchmark the torch2oflow conversion of a synthetic SDXL-sized module tree on CPU,
+before and after the conversion caches.
+
+The tree is built from the custom classes of a diffusers-style package, written
+to a temporary directory and imported like a third-party package, so conversion
+goes through the mocker (`LazyMocker`, `MockEntityNameFormatter`,
+`DynamicMockModule`) as it does for diffusers. It has the module count of the
+SDXL UNet (70 transformer blocks, 22 resnet blocks) with narrow layers, since
+conversion time scales with the number of modules and tensors rather than their
+size.
+
+Usage:
+    python3 benchmarks/torch2oflow_conversion.py --repeats 3
+
+Each run reports:
+    "before": the caches are disabled with `conversion_cache(False)`, every
+        converted instance builds its class and mocked entities again.
+    "cold": the caches are cleared first, like the first conversion in a fresh
+        process.
+    "warm": the caches are reused, like converting a second model (e.g. the
+        DeepCache fast_unet) in the same process.
+"""
+CHANNELS = 64
+TRANSFORMER_BLOCKS = 70
+RESNET_BLOCKS = 22
+REPEATS = 3
+PACKAGE = "synthetic_diffusers"
+
+import argparse
+import importlib
+import os
+import sys
+import tempfile
+import textwrap
+import time
+import torch
+from onediff.infer_compiler.transform.builtin_transform import (
+    torch2oflow,
+    clear_conversion_cache,
+    conversion_cache,
+)
+
+PACKAGE_SOURCE = '''
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class AttnProcessor:
+    def __init__(self, scale=1.0):
+        self.scale = scale
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None):
+        context = hidden_states if encoder_hidden_states is None else encoder_hidden_states
+        q, k, v = attn.to_q(hidden_states), attn.to_k(context), attn.to_v(context)
+        hidden_states = F.scaled_dot_product_attention(q, k, v)
+        return attn.to_out[1](attn.to_out[0](hidden_states))
+
+
+class Attention(nn.Module):
+    def __init__(self, channels):
+        super().__init__()
+        self.to_q = nn.Linear(channels, channels, bias=False)
+        self.to_k = nn.Linear(channels, channels, bias=False)
+        self.to_v = nn.Linear(channels, channels, bias=False)
+        self.to_out = nn.ModuleList([nn.Linear(channels, channels), nn.Dropout(0.0)])
+        self.processor = AttnProcessor()
+
+    def forward(self, hidden_states, encoder_hidden_states=None):
+        return self.processor(self, hidden_states, encoder_hidden_states)
+
+
+class GEGLU(nn.Module):
+    def __init__(self, dim_in, dim_out):
+        super().__init__()
+        self.proj = nn.Linear(dim_in, dim_out * 2)
+
+    def forward(self, hidden_states):
+        hidden_states, gate = self.proj(hidden_states).chunk(2, dim=-1)
+        return hidden_states * F.gelu(gate)
+
+
+class FeedForward(nn.Module):
+    def __init__(self, channels):
+        super().__init__()
+        self.net = nn.ModuleList(
+            [GEGLU(channels, channels * 4), nn.Dropout(0.0), nn.Linear(channels * 4, channels)]
+        )
+
+    def forward(self, hidden_states):
+        for module in self.net:
+            hidden_states = module(hidden_states)
+        return hidden_states
+
+
+class BasicTransformerBlock(nn.Module):
+    def __init__(self, channels):
+        super().__init__()
+        self.norm1 = nn.LayerNorm(channels)
+        self.attn1 = Attention(channels)
+        self.norm2 = nn.LayerNorm(channels)
+        self.attn2 = Attention(channels)
+        self.norm3 = nn.LayerNorm(channels)
+        self.ff = FeedForward(channels)
+
+    def forward(self, hidden_states, encoder_hidden_states=None):
+        hidden_states = self.attn1(self.norm1(hidden_states)) + hidden_states
+        hidden_states = (
+            self.attn2(self.norm2(hidden_states), encoder_hidden_states) + hidden_states
+        )
+        return self.ff(self.norm3(hidden_states)) + hidden_states
+
+
+class ResnetBlock2D(nn.Module):
+    def __init__(self, channels):
+        super().__init__()
+        self.norm1 = nn.GroupNorm(32, channels)
+        self.conv1 = nn.Conv2d(channels, channels, 3, padding=1)
+        self.time_emb_proj = nn.Linear(channels * 4, channels)
+        self.norm2 = nn.GroupNorm(32, channels)
+        self.dropout = nn.Dropout(0.0)
+        self.conv2 = nn.Conv2d(channels, channels, 3, padding=1)
+        self.nonlinearity = nn.SiLU()
+
+    def forward(self, hidden_states, temb):
+        residual = hidden_states
+        hidden_states = self.conv1(self.nonlinearity(self.norm1(hidden_states)))
+        hidden_states = hidden_states + self.time_emb_proj(temb)[:, :, None, None]
+        hidden_states = self.nonlinearity(self.norm2(hidden_states))
+        return self.conv2(self.dropout(hidden_states)) + residual
+
+
+class SyntheticUNet(nn.Module):
+    def __init__(self, channels, transformer_blocks, resnet_blocks):
+        super().__init__()
+        self.resnets = nn.ModuleList(
+            [ResnetBlock2D(channels) for _ in range(resnet_blocks)]
+        )
+        self.transformer_blocks = nn.ModuleList(
+            [BasicTransformerBlock(channels) for _ in range(transformer_blocks)]
+        )
+'''
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--channels", type=int, default=CHANNELS)
+    parser.add_argument("--transformer-blocks", type=int, default=TRANSFORMER_BLOCKS)
+    parser.add_argument("--resnet-blocks", type=int, default=RESNET_BLOCKS)
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    return parser.parse_args()
+
+
+def import_synthetic_package(tmp_dir):
+    package_dir = os.path.join(tmp_dir, PACKAGE)
+    os.makedirs(package_dir)
+    with open(os.path.join(package_dir, "__init__.py"), "w") as f:
+        f.write(textwrap.dedent(PACKAGE_SOURCE))
+    sys.path.insert(0, tmp_dir)
+    return importlib.import_module(PACKAGE)
+
+
+def timed_conversion(model):
+    start = time.time()
+    torch2oflow(model)
+    return time.time() - start
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        package = import_synthetic_package(tmp_dir)
+        model = package.SyntheticUNet(
+            args.channels, args.transformer_blocks, args.resnet_blocks
+        )
+        num_modules = len(list(model.modules()))
+        num_tensors = len(list(model.parameters())) + len(list(model.buffers()))
+        print(f"Synthetic UNet: {num_modules} modules, {num_tensors} tensors")
+
+        with torch.no_grad():
+            for repeat in range(args.repeats):
+                clear_conversion_cache()
+                with conversion_cache(False):
+                    before = timed_conversion(model)
+
+                clear_conversion_cache()
+                cold = timed_conversion(model)
+                warm = timed_conversion(model)
+                print(
+                    f"run {repeat}: before {before:.3f}s, "
+                    f"cold {cold:.3f}s, warm {warm:.3f}s"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -31,7 +31,7 @@ from .utils.loader_sample_tools import compoile_unet, quantize_unet
 from .utils.graph_path import generate_graph_path
 from .modules.hijack_model_management import model_management_hijacker
 from .modules.hijack_nodes import nodes_hijacker
-from .utils.deep_cache_speedup import deep_cache_speedup
+from .utils.deep_cache_speedup import deep_cache_speedup, load_deep_cache_config
 from .utils.onediff_load_utils import onediff_load_quant_checkpoint_advanced
 
 model_management_hijacker.hijack()  # add flow.cuda.empty_cache()
@@ -499,7 +499,12 @@ class OneDiffDeepCacheCheckpointLoaderSimple(CheckpointLoaderSimple):
                     "INT",
                     {"default": 1000, "min": 0, "max": 1000, "step": 0.1,},
                 ),
-            }
+            },
+            "optional": {
+                # A config of benchmarks/deep_cache_search.py, overrides the
+                # cache_interval, cache_layer_id and cache_block_id above
+                "deep_cache_config": ("STRING", {"default": ""}),
+            },
         }
 
     CATEGORY = "OneDiff/Loaders"
@@ -517,7 +522,14 @@ class OneDiffDeepCacheCheckpointLoaderSimple(CheckpointLoaderSimple):
         cache_block_id=1,
         start_step=0,
         end_step=1000,
+        deep_cache_config="",
     ):
+        if deep_cache_config:
+            config = load_deep_cache_config(deep_cache_config)
+            cache_interval = config.get("cache_interval", cache_interval)
+            cache_layer_id = config.get("cache_layer_id", cache_layer_id)
+            cache_block_id = config.get("cache_block_id", cache_block_id)
+
         # CheckpointLoaderSimple.load_checkpoint
         modelpatcher, clip, vae = self.load_checkpoint(
             ckpt_name, output_vae, output_clip
@@ -167,6 +167,13 @@ class FastDeepCacheUNet(Module):
         :param y: an [N] Tensor of labels, if class-conditional.
         :return: an [N x C x ...] Tensor of outputs.
         """
+        if cache_h is None:
+            # A full step, so one module (and one compiled graph module) runs
+            # both kinds of DeepCache steps on the same weights.
+            return DeepCacheUNet.forward(
+                self, x, timesteps, context, y, control, transformer_options, **kwargs
+            )
+
         transformer_options["original_shape"] = list(x.shape)
         transformer_options["transformer_index"] = 0
         transformer_patches = transformer_options.get("patches", {})
@@ -1,8 +1,11 @@
+import json
+
 import torch
 from comfy import model_management
 from comfy.model_base import SVD_img2vid
 
 from onediff.infer_compiler.utils import set_boolean_env_var
+from onediff.infer_compiler.with_oneflow_compile import DeployableModule
 from .model_patcher import OneFlowDeepCacheSpeedUpModelPatcher
 
 
@@ -95,23 +98,21 @@ def deep_cache_speedup(
 
         is_slow_step = current_step % cache_interval == 0 and apply
 
-        model_output = None
-        if is_slow_step:
-            cache_h = None
-            model_output, cache_h = model_patcher.deep_cache_unet(
-                x, timesteps, context, y, control, transformer_options, **extra_conds,
-            )
-        else:
-            model_output, cache_h = model_patcher.fast_deep_cache_unet(
-                x,
-                cache_h,
-                timesteps,
-                context,
-                y,
-                control,
-                transformer_options,
-                **extra_conds,
-            )
+        # The full steps pass no cached features, so one tensor less than the
+        # shallow steps: a compiled module runs them through a graph of its own
+        unet = model_patcher.fast_deep_cache_unet
+        if is_slow_step and isinstance(unet, DeployableModule):
+            unet = unet.graph_entry("full_step")
+        model_output, cache_h = unet(
+            x,
+            None if is_slow_step else cache_h,
+            timesteps,
+            context,
+            y,
+            control,
+            transformer_options,
+            **extra_conds,
+        )
 
         return model_patcher.model.model_sampling.calculate_denoised(
             sigma, model_output, xa
@@ -119,3 +120,20 @@ def deep_cache_speedup(
 
     model_patcher.set_model_unet_function_wrapper(apply_model)
     return (model_patcher,)
+
+
+def load_deep_cache_config(path):
+    """The DeepCache arguments of a config saved by onediffx
+    `save_deep_cache_config`, e.g. by `benchmarks/deep_cache_search.py`."""
+    with open(path) as f:
+        config = json.load(f)["deep_cache"]
+    if config.get("uniform", True) is False:
+        print(
+            f"Warning: {path} has a non-uniform DeepCache schedule, "
+            "ComfyUI runs it with a uniform cache_interval"
+        )
+    return {
+        k: config[k]
+        for k in ("cache_interval", "cache_layer_id", "cache_block_id")
+        if k in config
+    }
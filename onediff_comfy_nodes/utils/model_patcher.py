@@ -151,6 +151,14 @@ class OneFlowSpeedUpModelPatcher(comfy.model_patcher.ModelPatcher):
         return list(p)
 
     def calculate_weight(self, patches, weight, key):
+        from onediff.lora import (
+            LoRAUpdate,
+            apply_lora_updates,
+            dequantize_weight,
+            lora_factors,
+            requantize_weight_,
+        )
+
         is_onediff_quant_available = False
         try:
             import onediff_quant
@@ -189,44 +197,11 @@ class OneFlowSpeedUpModelPatcher(comfy.model_patcher.ModelPatcher):
                             w1, weight.device, weight.dtype
                         )
             elif patch_type == "lora":  # lora/locon
-                mat1 = comfy.model_management.cast_to_device(
-                    v[0], weight.device, torch.float32
-                )
-                mat2 = comfy.model_management.cast_to_device(
-                    v[1], weight.device, torch.float32
+                up, down, scale = lora_factors(
+                    v[0], v[1], alpha=v[2], mid=v[3], strength=alpha
                 )
-                if v[2] is not None:
-                    alpha *= v[2] / mat2.shape[0]
-                if v[3] is not None:
-                    # locon mid weights, hopefully the math is fine because I didn't properly test it
-                    mat3 = comfy.model_management.cast_to_device(
-                        v[3], weight.device, torch.float32
-                    )
-                    final_shape = [
-                        mat2.shape[1],
-                        mat2.shape[0],
-                        mat3.shape[2],
-                        mat3.shape[3],
-                    ]
-                    mat2 = (
-                        torch.mm(
-                            mat2.transpose(0, 1).flatten(start_dim=1),
-                            mat3.transpose(0, 1).flatten(start_dim=1),
-                        )
-                        .reshape(final_shape)
-                        .transpose(0, 1)
-                    )
                 try:
-                    weight += (
-                        (
-                            alpha
-                            * torch.mm(
-                                mat1.flatten(start_dim=1), mat2.flatten(start_dim=1)
-                            )
-                        )
-                        .reshape(weight.shape)
-                        .type(weight.dtype)
-                    )
+                    apply_lora_updates([LoRAUpdate(weight, [(up, down, scale)])])
                 except Exception as e:
                     print("ERROR", key, e)
             elif patch_type == "lokr":
@@ -392,14 +367,7 @@ class OneFlowSpeedUpModelPatcher(comfy.model_patcher.ModelPatcher):
                     )
                 ):
                     is_quant = True
-                    org_weight_scale = (
-                        v[4]
-                        .weight_scale.reshape(
-                            [-1] + [1 for _ in range(len(weight.shape) - 1)]
-                        )
-                        .to(weight.device)
-                    )
-                    weight = weight.to(torch.float32) * org_weight_scale
+                    weight = dequantize_weight(weight, v[4])
 
                 mat1 = comfy.model_management.cast_to_device(
                     v[0], weight.device, torch.float32
@@ -460,24 +428,7 @@ class OneFlowSpeedUpModelPatcher(comfy.model_patcher.ModelPatcher):
                             .type(weight.dtype)
                         )
                     if is_quant:
-                        weight_max = torch.max(
-                            weight.reshape(weight.shape[0], -1), dim=1
-                        )[0].reshape([-1] + [1 for _ in range(len(weight.shape) - 1)])
-                        weight_scale = torch.abs(weight_max) / 127
-                        weight = torch.clamp(
-                            torch.round(weight / weight_scale), -127, 127
-                        ).to(weight.dtype)
-                        weight_acc = (weight * weight_scale).sum(
-                            dim=[d for d in range(1, len(weight.shape))]
-                        )
-                        weight_scale = weight_scale.reshape(v[4].weight_scale.shape).to(
-                            v[4].weight_scale.dtype
-                        )
-                        weight_acc = weight_acc.reshape(v[4].weight_acc.shape).to(
-                            v[4].weight_acc.dtype
-                        )
-                        v[4].weight_scale.copy_(weight_scale)
-                        v[4].weight_acc.copy_(weight_acc)
+                        weight = requantize_weight_(weight, v[4])
                 except Exception as e:
                     print("ERROR", key, e)
         return weight
@@ -512,15 +463,13 @@ class OneFlowDeepCacheSpeedUpModelPatcher(OneFlowSpeedUpModelPatcher):
             self.model.diffusion_model, cache_layer_id, cache_block_id
         )
 
+        # Runs the full steps too, given no cached features, so only this
+        # module is converted; the full steps get a graph entry of their own.
         self.fast_deep_cache_unet = FastDeepCacheUNet(
             self.model.diffusion_model, cache_layer_id, cache_block_id
         )
         if use_graph:
             gen_compile_options = gen_compile_options or (lambda x: {})
-            compile_options = gen_compile_options(self.deep_cache_unet)
-            self.deep_cache_unet = oneflow_compile(
-                self.deep_cache_unet, use_graph=use_graph, options=compile_options,
-            )
             compile_options = gen_compile_options(self.fast_deep_cache_unet)
             self.fast_deep_cache_unet = oneflow_compile(
                 self.fast_deep_cache_unet, use_graph=use_graph, options=compile_options,
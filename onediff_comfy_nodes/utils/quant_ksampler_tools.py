@@ -308,13 +308,9 @@ class SaveQuantizedCalibrateInfoMixin:
 def compile_model_patcher_context(model_patcher):
     if isinstance(model_patcher, OneFlowDeepCacheSpeedUpModelPatcher):
         original_models = {
-            "deep_cache_unet": model_patcher.deep_cache_unet,
             "fast_deep_cache_unet": model_patcher.fast_deep_cache_unet,
         }
 
-        model_patcher.deep_cache_unet = oneflow_compile(
-            model_patcher.deep_cache_unet, use_graph=True
-        )
         model_patcher.fast_deep_cache_unet = oneflow_compile(
             model_patcher.fast_deep_cache_unet, use_graph=True
         )
@@ -327,7 +323,6 @@ def compile_model_patcher_context(model_patcher):
     yield model_patcher
 
     if isinstance(model_patcher, OneFlowDeepCacheSpeedUpModelPatcher):
-        model_patcher.deep_cache_unet = original_models["deep_cache_unet"]
         model_patcher.fast_deep_cache_unet = original_models["fast_deep_cache_unet"]
     else:
         model_patcher.model.diffusion_model = original_diffusion_model
@@ -53,7 +53,8 @@ base.to("cuda")
 # Compile unet with oneflow
 if args.compile:
     print("Compiling unet with oneflow.")
-    base.unet = oneflow_compile(base.unet)
+    # fast_unet runs both the full and the shallow DeepCache steps, each
+    # kind with a graph of its own over one converted UNet
     base.fast_unet = oneflow_compile(base.fast_unet)
     base.vae.decoder = oneflow_compile(base.vae.decoder)
 
@@ -115,7 +115,8 @@ if args.compile:
         pipe.text_encoder = oneflow_compile(pipe.text_encoder, use_graph=args.graph)
     if pipe.text_encoder_2 is not None:
         pipe.text_encoder_2 = oneflow_compile(pipe.text_encoder_2, use_graph=args.graph)
-    pipe.unet = oneflow_compile(pipe.unet, use_graph=args.graph)
+    # fast_unet runs both the full and the shallow DeepCache steps, each
+    # kind with a graph of its own over one converted UNet
     pipe.fast_unet = oneflow_compile(pipe.fast_unet, use_graph=args.graph)
     if pipe.needs_upcasting:
         # To avoid mis-match of loaded graph and loaded model
@@ -125,8 +126,10 @@ if args.compile:
 if args.load_graph:
     print("Loading graphs to avoid compilation...")
     start_t = time.time()
-    pipe.unet.load_graph("base_unet_compiled", run_warmup=True)
     pipe.fast_unet.load_graph("base_fast_unet_compiled", run_warmup=True)
+    pipe.fast_unet.graph_entry("full_step").load_graph(
+        "base_fast_unet_full_step_compiled", run_warmup=True
+    )
     pipe.vae.decoder.load_graph("base_vae_compiled", run_warmup=True)
     end_t = time.time()
     print(f"warmup with loading graph elapsed: {end_t - start_t} s")
@@ -158,8 +161,10 @@ image.save(args.saved_image)
 if args.save_graph:
     print("Saving graphs...")
     start_t = time.time()
-    pipe.unet.save_graph("base_unet_compiled")
     pipe.fast_unet.save_graph("base_fast_unet_compiled")
+    pipe.fast_unet.graph_entry("full_step").save_graph(
+        "base_fast_unet_full_step_compiled"
+    )
     pipe.vae.decoder.save_graph("base_vae_compiled")
     end_t = time.time()
     print(f"save graphs elapsed: {end_t - start_t} s")
@@ -44,10 +44,26 @@ def _filter_parts(ignores=()):
 
     return filtered_parts
 
+
+def _pipe_parts(pipe, ignores=()):
+    # DeepCache pipelines run every step through fast_unet, never pipe.unet
+    if _recursive_getattr(pipe, "fast_unet", None) is not None:
+        ignores = (*ignores, "unet")
+    return _filter_parts(ignores=ignores)
+
+
+def _compiled_graphs(part, obj):
+    # The graph of a part and those of its graph entries, e.g. the full steps
+    # of the DeepCache fast_unet, saved as "fast_unet.full_step"
+    yield part, obj
+    for name, entry in obj.graph_entries().items():
+        yield f"{part}.{name}", entry
+
+
 def compile_pipe(
     pipe, *, ignores=(),
 ):
-    filtered_parts = _filter_parts(ignores=ignores)
+    filtered_parts = _pipe_parts(pipe, ignores=ignores)
     for part in filtered_parts:
         obj = _recursive_getattr(pipe, part, None)
         if obj is not None:
@@ -71,20 +87,22 @@ def save_pipe(
 ):
     if not os.path.exists(dir):
         os.makedirs(dir)
-    filtered_parts = _filter_parts(ignores=ignores)
+    filtered_parts = _pipe_parts(pipe, ignores=ignores)
     for part in filtered_parts:
         obj = _recursive_getattr(pipe, part, None)
-        if (
-            obj is not None
-            and isinstance(obj, DeployableModule)
-            and obj._deployable_module_dpl_graph is not None
-            and obj.get_graph().is_compiled
-        ):
-            if not overwrite and os.path.isfile(os.path.join(dir, part)):
-                logger.info(f"Compiled graph already exists for {part}, not overwriting it.")
+        if obj is None or not isinstance(obj, DeployableModule):
+            continue
+        for name, module in _compiled_graphs(part, obj):
+            if (
+                module._deployable_module_dpl_graph is None
+                or not module.get_graph().is_compiled
+            ):
+                continue
+            if not overwrite and os.path.isfile(os.path.join(dir, name)):
+                logger.info(f"Compiled graph already exists for {name}, not overwriting it.")
                 continue
-            logger.info(f"Saving {part}")
-            obj.save_graph(os.path.join(dir, part))
+            logger.info(f"Saving {name}")
+            module.save_graph(os.path.join(dir, name))
 
 
 def load_pipe(
@@ -92,12 +110,22 @@ def load_pipe(
 ):
     if not os.path.exists(dir):
         return
-    filtered_parts = _filter_parts(ignores=ignores)
+    filtered_parts = _pipe_parts(pipe, ignores=ignores)
     for part in filtered_parts:
         obj = _recursive_getattr(pipe, part, None)
-        if obj is not None and os.path.exists(os.path.join(dir, part)):
+        if obj is None:
+            continue
+        if os.path.exists(os.path.join(dir, part)):
             logger.info(f"Loading {part}")
             obj.load_graph(os.path.join(dir, part))
+        if not isinstance(obj, DeployableModule):
+            continue
+        for file in sorted(os.listdir(dir)):
+            if file.startswith(part + "."):
+                logger.info(f"Loading {file}")
+                obj.graph_entry(file[len(part) + 1 :]).load_graph(
+                    os.path.join(dir, file)
+                )
 
     if "image_processor" not in ignores:
         logger.info("Patching image_processor")
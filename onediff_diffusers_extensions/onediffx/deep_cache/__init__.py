@@ -1,5 +1,18 @@
 from .models.pipeline_utils import disable_deep_cache_pipeline
+from .schedule import DeepCacheSchedule, AdaptiveDeepCacheSchedule
+from .config import load_deep_cache_config, save_deep_cache_config
+from .feature_cache import DeepCacheFeatureCache
 
 from .pipeline_stable_diffusion_xl import StableDiffusionXLPipeline
 from .pipeline_stable_diffusion import StableDiffusionPipeline
 from .pipeline_stable_video_diffusion import StableVideoDiffusionPipeline
+from .pipeline_img2img import (
+    StableDiffusionImg2ImgPipeline,
+    StableDiffusionInpaintPipeline,
+    StableDiffusionXLImg2ImgPipeline,
+    StableDiffusionXLInpaintPipeline,
+)
+from .pipeline_controlnet import (
+    StableDiffusionControlNetPipeline,
+    StableDiffusionXLControlNetPipeline,
+)
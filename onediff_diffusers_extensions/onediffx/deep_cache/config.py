@@ -0,0 +1,58 @@
+import json
+import os
+from typing import Any, Dict, Optional, Union
+
+__all__ = ["DEEP_CACHE_CONFIG_KEYS", "load_deep_cache_config", "save_deep_cache_config"]
+
+# The DeepCache arguments of the pipelines, with their types
+DEEP_CACHE_CONFIG_KEYS = {
+    "cache_interval": int,
+    "cache_layer_id": int,
+    "cache_block_id": int,
+    "uniform": bool,
+    "center": int,
+    "pow": float,
+}
+
+
+def _check_config(config: Dict[str, Any]):
+    for key, value in config.items():
+        if key not in DEEP_CACHE_CONFIG_KEYS:
+            raise ValueError(
+                f"[OneDiffX DeepCache config] unknown key {key}, "
+                f"expect one of {list(DEEP_CACHE_CONFIG_KEYS)}"
+            )
+        expected = DEEP_CACHE_CONFIG_KEYS[key]
+        if value is not None and not isinstance(value, expected):
+            if not (expected is float and isinstance(value, int)):
+                raise ValueError(
+                    f"[OneDiffX DeepCache config] {key} must be {expected.__name__}, "
+                    f"got {value!r}"
+                )
+
+
+def load_deep_cache_config(path: Union[str, os.PathLike]) -> Dict[str, Any]:
+    r"""
+    Load the DeepCache arguments saved by `save_deep_cache_config`, e.g. the
+    recommended config of `benchmarks/deep_cache_search.py`.
+
+        >>> pipe(prompt, **load_deep_cache_config("sdxl_deep_cache.json"))
+    """
+    with open(path) as f:
+        config = json.load(f)["deep_cache"]
+    _check_config(config)
+    return config
+
+
+def save_deep_cache_config(
+    path: Union[str, os.PathLike],
+    config: Dict[str, Any],
+    metrics: Optional[Dict[str, Any]] = None,
+):
+    r"""
+    Save DeepCache arguments, with the `metrics` they were measured with
+    (model, steps, latency, similarity, ...), which are informative only.
+    """
+    _check_config(config)
+    with open(path, "w") as f:
+        json.dump({"deep_cache": config, "metrics": metrics or {}}, f, indent=2)
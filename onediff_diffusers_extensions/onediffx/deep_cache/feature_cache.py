@@ -0,0 +1,222 @@
+import hashlib
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional, Tuple
+
+import torch
+
+__all__ = ["DeepCacheFeatureCache"]
+
+
+def _update_hashes(hashes, value, batch_size):
+    if isinstance(value, torch.Tensor):
+        data = value.detach().contiguous().cpu()
+        if data.dim() > 0 and data.shape[0] == batch_size:
+            # Independent of the batch size, a sample keeps its key in any batch
+            header = f"{data.dtype}{tuple(data.shape[1:])}".encode()
+            rows = data.reshape(batch_size, -1).view(torch.uint8).numpy()
+            for h, row in zip(hashes, rows):
+                h.update(header)
+                h.update(row.tobytes())
+        else:
+            # Shared by all the samples, e.g. a scalar timestep
+            header = f"{data.dtype}{tuple(data.shape)}".encode()
+            data = data.reshape(-1).view(torch.uint8).numpy().tobytes()
+            for h in hashes:
+                h.update(header)
+                h.update(data)
+    elif isinstance(value, dict):
+        for key in sorted(value):
+            for h in hashes:
+                h.update(repr(key).encode())
+            _update_hashes(hashes, value[key], batch_size)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _update_hashes(hashes, item, batch_size)
+    else:
+        for h in hashes:
+            h.update(repr(value).encode())
+
+
+def _select_rows(value, index, batch_size):
+    if isinstance(value, torch.Tensor):
+        if value.dim() > 0 and value.shape[0] == batch_size:
+            return value.index_select(0, index.to(value.device))
+        return value
+    if isinstance(value, dict):
+        return {k: _select_rows(v, index, batch_size) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_select_rows(v, index, batch_size) for v in value]
+    if isinstance(value, tuple):
+        return tuple(_select_rows(v, index, batch_size) for v in value)
+    return value
+
+
+def _stack_rows(rows):
+    noise_pred = torch.stack([row[0] for row in rows])
+    if rows[0][1] is None:
+        return noise_pred, None
+    return noise_pred, torch.stack([row[1] for row in rows])
+
+
+class DeepCacheFeatureCache:
+    r"""
+    Share the full UNet steps of DeepCache across the samples of a batch and
+    across pipeline calls, e.g. the variations of a prompt and seed, whose
+    steps are the same until their latents diverge.
+
+    The outputs of a full step (noise prediction and cached features) are
+    kept per sample, keyed by the hash of its latent, the timestep and its
+    conditioning (prompt embeddings, SDXL added conditions, ...). A full step
+    only runs the UNet on the samples that are not cached, once per distinct
+    key, and scatters the outputs back to the batch. The least recently used
+    entries are evicted beyond `max_memory`.
+
+        >>> feature_cache = DeepCacheFeatureCache(max_memory=2 << 30)
+        >>> for guidance_scale in [5.0, 7.0, 9.0]:
+        ...     pipe(prompt, generator=torch.manual_seed(0), guidance_scale=guidance_scale,
+        ...          feature_cache=feature_cache, cache_interval=3, cache_layer_id=0, cache_block_id=0)
+        >>> feature_cache.summary()
+
+    Samples are only matched when identical, bit for bit. A step that runs a
+    part of the batch runs the UNet with a smaller batch, which a compiled
+    UNet compiles once per batch size. Call `clear` when
+    the weights of the UNet change, e.g. after switching LoRAs, since the
+    entries do not depend on them. Hashing copies the latents to the host,
+    which syncs with the device once per full step.
+
+    Parameters:
+        max_memory (int, optional): The most bytes of device memory held by the entries. Default is 1 GiB.
+    """
+
+    def __init__(self, max_memory: int = 1 << 30):
+        self.max_memory = max_memory
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def clear(self):
+        self._entries.clear()
+        self.memory = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def conditioning_keys(self, batch_size: int, *conditions: Any) -> List[bytes]:
+        """The hash of the conditions of each sample, the same at all the steps of a call."""
+        hashes = [hashlib.blake2b(digest_size=16) for _ in range(batch_size)]
+        _update_hashes(hashes, conditions, batch_size)
+        return [h.digest() for h in hashes]
+
+    def step_keys(
+        self, sample: torch.Tensor, timestep: Any, conditioning_keys: List[bytes]
+    ) -> List[bytes]:
+        """The key of each sample of a full step."""
+        batch_size = sample.shape[0]
+        hashes = [hashlib.blake2b(key, digest_size=16) for key in conditioning_keys]
+        _update_hashes(hashes, (sample, timestep), batch_size)
+        return [h.digest() for h in hashes]
+
+    def get(
+        self, keys: List[bytes]
+    ) -> Optional[Tuple[torch.Tensor, Optional[torch.Tensor]]]:
+        """The (noise_pred, features) of `keys`, or None unless all of them are
+        cached. Hits and misses are counted per key."""
+        rows = []
+        for key in keys:
+            row = self._entries.get(key)
+            if row is None:
+                self.misses += 1
+                continue
+            self.hits += 1
+            self._entries.move_to_end(key)
+            rows.append(row)
+        if len(rows) < len(keys):
+            return None
+        return _stack_rows(rows)
+
+    def run(
+        self, keys: List[bytes], unet: Callable, *args, **kwargs
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """The (noise_pred, features) of a full step, `unet(*args, **kwargs)`.
+
+        `unet` only runs on the samples whose key is not cached, the first one
+        of each distinct key, and its outputs are cached. The arguments with
+        the batch size as first dimension are sliced to these samples.
+        Samples served by the cache or by another sample of the batch count
+        as hits, the samples run as misses.
+        """
+        batch_size = len(keys)
+        # key -> the cached row, or the index of the sample that runs it
+        rows = {}
+        missing = []
+        for i, key in enumerate(keys):
+            if key in rows:
+                # A repeated sample of the batch
+                self.hits += 1
+                continue
+            row = self._entries.get(key)
+            if row is None:
+                self.misses += 1
+                missing.append(key)
+                rows[key] = i
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                rows[key] = row
+        if len(missing) == batch_size:
+            # All the samples are distinct and run, no need to scatter
+            noise_pred, features = unet(*args, **kwargs)
+            self.put(keys, noise_pred, features)
+            return noise_pred, features
+
+        if len(missing) > 0:
+            index = torch.tensor([rows[key] for key in missing], dtype=torch.long)
+            args = _select_rows(args, index, batch_size)
+            kwargs = _select_rows(kwargs, index, batch_size)
+            noise_pred, features = unet(*args, **kwargs)
+            self.put(missing, noise_pred, features)
+            for i, key in enumerate(missing):
+                rows[key] = (
+                    noise_pred[i],
+                    None if features is None else features[i],
+                )
+        return _stack_rows([rows[key] for key in keys])
+
+    def put(
+        self,
+        keys: List[bytes],
+        noise_pred: torch.Tensor,
+        features: Optional[torch.Tensor] = None,
+    ):
+        for i, key in enumerate(keys):
+            # The outputs of a compiled UNet may reuse their buffers
+            row = (
+                noise_pred[i].clone(),
+                None if features is None else features[i].clone(),
+            )
+            size = sum(t.numel() * t.element_size() for t in row if t is not None)
+            if size > self.max_memory:
+                continue
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = row
+            self.memory += size
+            while self.memory > self.max_memory:
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, key):
+        row = self._entries.pop(key)
+        self.memory -= sum(t.numel() * t.element_size() for t in row if t is not None)
+
+    def summary(self) -> str:
+        return (
+            f"{self.hits} hits, {self.misses} misses ({self.hit_rate:.1%}), "
+            f"{len(self._entries)} samples in {self.memory / 2 ** 20:.1f} MiB "
+            f"of {self.max_memory / 2 ** 20:.1f} MiB"
+        )
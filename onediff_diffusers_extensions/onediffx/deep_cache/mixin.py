@@ -0,0 +1,170 @@
+import functools
+import inspect
+from typing import Optional
+
+from diffusers.utils import logging
+
+from .models.fast_unet_2d_condition import FastUNet2DConditionModel
+from .models.unet_2d_condition import UNet2DConditionOutput
+from .models.pipeline_utils import full_step_unet
+from .feature_cache import DeepCacheFeatureCache
+from .schedule import DeepCacheSchedule
+
+__all__ = ["DeepCacheMixin"]
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+
+class _DeepCacheUNet:
+    r"""
+    Stands in for `pipeline.unet` during a call: each UNet call is a denoising
+    step, which runs `pipeline.fast_unet` in full or on the features cached by
+    the last full step, as `schedule` decides. Other attributes are the UNet's.
+    """
+
+    def __init__(
+        self, pipeline, unet, schedule, cache_layer_id, cache_block_id, feature_cache
+    ):
+        self._pipeline = pipeline
+        self._unet = unet
+        self._schedule = schedule
+        self._feature_cache = feature_cache
+        self._cache_layer_id = cache_layer_id
+        self._cache_block_id = cache_block_id
+        self._features = None
+        self._controlnet = None
+        self.step = 0
+
+    def __getattr__(self, name):
+        return getattr(self._unet, name)
+
+    def is_full_step(self) -> bool:
+        return self._features is None or self._schedule.is_full_step(self.step)
+
+    def __call__(self, sample, timestep, *args, return_dict=True, **kwargs):
+        full = self.is_full_step()
+        unet = self._pipeline.fast_unet
+        if full:
+            unet = full_step_unet(unet)
+        if full and self._feature_cache is not None:
+            # The conditioning of a step includes the ControlNet residuals
+            conditioning_keys = self._feature_cache.conditioning_keys(
+                sample.shape[0],
+                args,
+                kwargs,
+                self._cache_layer_id,
+                self._cache_block_id,
+            )
+            step_keys = self._feature_cache.step_keys(
+                sample, timestep, conditioning_keys
+            )
+            unet = functools.partial(self._feature_cache.run, step_keys, unet)
+        noise_pred, features = unet(
+            sample,
+            timestep,
+            *args,
+            replicate_prv_feature=None if full else self._features,
+            cache_layer_id=self._cache_layer_id,
+            cache_block_id=self._cache_block_id,
+            return_dict=False,
+            **kwargs,
+        )
+        if full:
+            self._features = features
+            self._schedule.update(self.step, noise_pred, features)
+        self.step += 1
+        if self.step == 1 and self._controlnet is not None:
+            # The ControlNet pipelines check the type of their controlnet
+            # before the denoising loop, so it is replaced after the first step.
+            object.__setattr__(self._pipeline, "controlnet", self._controlnet)
+        if return_dict:
+            return UNet2DConditionOutput(sample=noise_pred)
+        return (noise_pred,)
+
+
+class _DeepCacheControlNet:
+    r"""
+    Stands in for `pipeline.controlnet` during a call: on the shallow steps,
+    it returns the residuals of the last full step instead of running the
+    ControlNet. The shallow UNet only adds those of its shallow blocks.
+    """
+
+    def __init__(self, controlnet, unet):
+        self._controlnet = controlnet
+        self._unet = unet
+        self._residuals = None
+
+    def __getattr__(self, name):
+        return getattr(self._controlnet, name)
+
+    def __call__(self, *args, **kwargs):
+        if self._residuals is None or self._unet.is_full_step():
+            self._residuals = self._controlnet(*args, **kwargs)
+        return self._residuals
+
+
+class DeepCacheMixin:
+    r"""
+    DeepCache for a diffusers pipeline whose denoising loop calls
+    `self.unet(...)` once per step, e.g. img2img, inpaint and ControlNet. The
+    pipeline is used as is, the UNet calls of its loop are routed through
+    `self.fast_unet` for the duration of a call.
+
+    Mixed in first, before the diffusers pipeline class:
+
+        >>> class StableDiffusionImg2ImgPipeline(DeepCacheMixin, OrgStableDiffusionImg2ImgPipeline):
+        ...     pass
+
+    `__call__` takes the DeepCache arguments of `StableDiffusionPipeline`,
+    `cache_interval`, `cache_layer_id`, `cache_block_id`, `cache_schedule`
+    and `feature_cache`, on top of the arguments of the diffusers pipeline.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fast_unet = FastUNet2DConditionModel(self.unet)
+
+    def __call__(
+        self,
+        *args,
+        cache_interval: int = 1,
+        cache_layer_id: Optional[int] = None,
+        cache_block_id: Optional[int] = None,
+        cache_schedule: Optional[DeepCacheSchedule] = None,
+        feature_cache: Optional[DeepCacheFeatureCache] = None,
+        **kwargs,
+    ):
+        call = super().__call__
+        bound = inspect.signature(call).bind(*args, **kwargs)
+        bound.apply_defaults()
+        # img2img runs fewer steps, with `strength`
+        num_inference_steps = bound.arguments.get("num_inference_steps", 50)
+        if cache_schedule is None:
+            cache_schedule = DeepCacheSchedule(
+                range(0, num_inference_steps, cache_interval)
+            )
+        cache_schedule.reset(num_inference_steps)
+        self.deep_cache_schedule = cache_schedule
+
+        unet = self.unet
+        deep_cache_unet = _DeepCacheUNet(
+            self, unet, cache_schedule, cache_layer_id, cache_block_id, feature_cache
+        )
+        controlnet = getattr(self, "controlnet", None)
+        if controlnet is not None:
+            deep_cache_unet._controlnet = _DeepCacheControlNet(
+                controlnet, deep_cache_unet
+            )
+        # Bypass `DiffusionPipeline.__setattr__`, which would register them
+        object.__setattr__(self, "unet", deep_cache_unet)
+        try:
+            output = call(*args, **kwargs)
+        finally:
+            object.__setattr__(self, "unet", unet)
+            if controlnet is not None:
+                object.__setattr__(self, "controlnet", controlnet)
+        cache_schedule.num_inference_steps = deep_cache_unet.step
+        logger.info(f"DeepCache schedule: {cache_schedule.summary()}")
+        if feature_cache is not None:
+            logger.info(f"DeepCache feature cache: {feature_cache.summary()}")
+        return output
@@ -60,6 +60,26 @@ class FastUNet2DConditionModel(nn.Module):
                 If `return_dict` is True, an [`~models.unet_2d_condition.UNet2DConditionOutput`] is returned, otherwise
                 a `tuple` is returned where the first element is the sample tensor.
         """
+        if replicate_prv_feature is None:
+            # A full step, so one module (and one compiled graph module) runs
+            # both kinds of DeepCache steps on the same weights.
+            return self.unet_module(
+                sample,
+                timestep,
+                encoder_hidden_states,
+                class_labels=class_labels,
+                timestep_cond=timestep_cond,
+                attention_mask=attention_mask,
+                cross_attention_kwargs=cross_attention_kwargs,
+                added_cond_kwargs=added_cond_kwargs,
+                down_block_additional_residuals=down_block_additional_residuals,
+                mid_block_additional_residual=mid_block_additional_residual,
+                encoder_attention_mask=encoder_attention_mask,
+                cache_layer_id=cache_layer_id,
+                cache_block_id=cache_block_id,
+                return_dict=return_dict,
+            )
+
         # By default samples have to be AT least a multiple of the overall upsampling factor.
         # The overall upsampling factor is equal to 2 ** (# num of upsampling layers).
         # However, the upsampling interpolation output size can be forced to fit any upsampling size
@@ -311,6 +331,22 @@ class FastUNet2DConditionModel(nn.Module):
 
             down_block_res_samples += res_samples
 
+        if is_controlnet:
+            # The shallow blocks take the first residuals of the ControlNet
+            new_down_block_res_samples = ()
+
+            for down_block_res_sample, down_block_additional_residual in zip(
+                down_block_res_samples, down_block_additional_residuals
+            ):
+                down_block_res_sample = (
+                    down_block_res_sample + down_block_additional_residual
+                )
+                new_down_block_res_samples = new_down_block_res_samples + (
+                    down_block_res_sample,
+                )
+
+            down_block_res_samples = new_down_block_res_samples
+
         # No Middle
         # Up
         # print("down_block_res_samples:", [res_sample.shape for res_sample in down_block_res_samples])
@@ -43,6 +43,17 @@ class FastUNetSpatioTemporalConditionModel(nn.Module):
                 If `return_dict` is True, an [`~models.unet_slatio_temporal.UNetSpatioTemporalConditionOutput`] is returned, otherwise
                 a `tuple` is returned where the first element is the sample tensor.
         """
+        if cache_features is None:
+            # A full step, see `FastUNet2DConditionModel.forward`
+            return self.unet_module(
+                sample,
+                timestep,
+                encoder_hidden_states,
+                added_time_ids,
+                cache_branch=cache_branch,
+                return_dict=return_dict,
+            )
+
         # 1. time
         timesteps = timestep
         if not torch.is_tensor(timesteps):
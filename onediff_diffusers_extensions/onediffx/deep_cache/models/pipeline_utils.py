@@ -48,6 +48,8 @@ else:
 
 from diffusers.utils.torch_utils import is_compiled_module
 
+from onediff.infer_compiler.with_oneflow_compile import DeployableModule
+
 from diffusers.pipelines.pipeline_utils import DiffusionPipeline, maybe_raise_or_warn
 
 
@@ -819,7 +821,21 @@ def disable_deep_cache_pipeline():
     diffusers.DiffusionPipeline.from_pretrained = ORIGIN_DIFFUDION_PIPELINE
 
 
+def full_step_unet(fast_unet):
+    r"""
+    The module running the full steps of `fast_unet`, which pass no cached
+    features, so one tensor less than the shallow steps. A compiled
+    `fast_unet` runs them through a graph entry of its own, see
+    `DeployableModule.graph_entry`, rather than rebuilding its graph at each
+    switch between the kinds of steps.
+    """
+    if isinstance(fast_unet, DeployableModule):
+        return fast_unet.graph_entry("full_step")
+    return fast_unet
+
+
 __all__ = [
     "enable_deep_cache_pipeline",
     "disable_deep_cache_pipeline",
+    "full_step_unet",
 ]
@@ -0,0 +1,23 @@
+from diffusers import (
+    StableDiffusionControlNetPipeline as OrgStableDiffusionControlNetPipeline,
+    StableDiffusionXLControlNetPipeline as OrgStableDiffusionXLControlNetPipeline,
+)
+
+from .mixin import DeepCacheMixin
+from .models.pipeline_utils import enable_deep_cache_pipeline
+
+enable_deep_cache_pipeline()
+
+
+# On the shallow steps, the ControlNet is skipped and the shallow UNet adds the
+# residuals of the last full step to its skip connections.
+class StableDiffusionControlNetPipeline(
+    DeepCacheMixin, OrgStableDiffusionControlNetPipeline
+):
+    pass
+
+
+class StableDiffusionXLControlNetPipeline(
+    DeepCacheMixin, OrgStableDiffusionXLControlNetPipeline
+):
+    pass
@@ -0,0 +1,35 @@
+from diffusers import (
+    StableDiffusionImg2ImgPipeline as OrgStableDiffusionImg2ImgPipeline,
+    StableDiffusionInpaintPipeline as OrgStableDiffusionInpaintPipeline,
+    StableDiffusionXLImg2ImgPipeline as OrgStableDiffusionXLImg2ImgPipeline,
+    StableDiffusionXLInpaintPipeline as OrgStableDiffusionXLInpaintPipeline,
+)
+
+from .mixin import DeepCacheMixin
+from .models.pipeline_utils import enable_deep_cache_pipeline
+
+enable_deep_cache_pipeline()
+
+
+class StableDiffusionImg2ImgPipeline(
+    DeepCacheMixin, OrgStableDiffusionImg2ImgPipeline
+):
+    pass
+
+
+class StableDiffusionInpaintPipeline(
+    DeepCacheMixin, OrgStableDiffusionInpaintPipeline
+):
+    pass
+
+
+class StableDiffusionXLImg2ImgPipeline(
+    DeepCacheMixin, OrgStableDiffusionXLImg2ImgPipeline
+):
+    pass
+
+
+class StableDiffusionXLInpaintPipeline(
+    DeepCacheMixin, OrgStableDiffusionXLInpaintPipeline
+):
+    pass
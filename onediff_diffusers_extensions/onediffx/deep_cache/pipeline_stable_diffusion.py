@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import time
+import functools
 import inspect
 from typing import Any, Callable, Dict, List, Optional, Union
 
@@ -46,9 +47,11 @@ from diffusers import StableDiffusionPipeline as OrgStableDiffusionPipeline
 
 from .models.unet_2d_condition import UNet2DConditionModel
 from .models.fast_unet_2d_condition import FastUNet2DConditionModel
+from .schedule import DeepCacheSchedule
+from .feature_cache import DeepCacheFeatureCache
 
 
-from .models.pipeline_utils import enable_deep_cache_pipeline
+from .models.pipeline_utils import enable_deep_cache_pipeline, full_step_unet
 
 
 enable_deep_cache_pipeline()
@@ -294,6 +297,8 @@ class StableDiffusionPipeline(OrgStableDiffusionPipeline):
         pow: float = None,
         center: int = None,
         output_all_sequence: bool = False,
+        cache_schedule: Optional[DeepCacheSchedule] = None,
+        feature_cache: Optional[DeepCacheFeatureCache] = None,
     ):
         r"""
         The call function to the pipeline for generation.
@@ -437,23 +442,35 @@ class StableDiffusionPipeline(OrgStableDiffusionPipeline):
         prv_features = None
         latents_list = [latents]
 
-        if cache_interval == 1:
-            interval_seq = list(range(num_inference_steps))
-        else:
-            if uniform:
-                interval_seq = list(range(0, num_inference_steps, cache_interval))
+        if cache_schedule is None:
+            if cache_interval == 1:
+                interval_seq = list(range(num_inference_steps))
             else:
-                num_slow_step = num_inference_steps // cache_interval
-                if num_inference_steps % cache_interval != 0:
-                    num_slow_step += 1
-
-                interval_seq, pow = sample_from_quad_center(
-                    num_inference_steps, num_slow_step, center=center, pow=pow
-                )  # [0, 3, 6, 9, 12, 16, 22, 28, 35, 43,]
-                # interval_seq, pow = sample_from_quad(num_inference_steps, num_inference_steps//cache_interval, pow=pow)#[0, 3, 6, 9, 12, 16, 22, 28, 35, 43,]
-
-        interval_seq = sorted(interval_seq)
-        # print(interval_seq, len(interval_seq), pow)
+                if uniform:
+                    interval_seq = list(range(0, num_inference_steps, cache_interval))
+                else:
+                    num_slow_step = num_inference_steps // cache_interval
+                    if num_inference_steps % cache_interval != 0:
+                        num_slow_step += 1
+
+                    interval_seq, pow = sample_from_quad_center(
+                        num_inference_steps, num_slow_step, center=center, pow=pow
+                    )  # [0, 3, 6, 9, 12, 16, 22, 28, 35, 43,]
+                    # interval_seq, pow = sample_from_quad(num_inference_steps, num_inference_steps//cache_interval, pow=pow)#[0, 3, 6, 9, 12, 16, 22, 28, 35, 43,]
+
+            interval_seq = sorted(interval_seq)
+            cache_schedule = DeepCacheSchedule(interval_seq)
+        cache_schedule.reset(num_inference_steps)
+        self.deep_cache_schedule = cache_schedule
+
+        if feature_cache is not None:
+            conditioning_keys = feature_cache.conditioning_keys(
+                prompt_embeds.shape[0],
+                prompt_embeds,
+                cross_attention_kwargs,
+                cache_layer_id,
+                cache_block_id,
+            )
 
         with self.progress_bar(total=num_inference_steps) as progress_bar:
             # print("[INFO] Update Feature Interval = {}, Update Layer Number = {}, Update Block Number = {}".format(cache_interval, cache_layer_id, cache_block_id))
@@ -466,12 +483,20 @@ class StableDiffusionPipeline(OrgStableDiffusionPipeline):
                     latent_model_input, t
                 )
 
-                if i in interval_seq or cache_interval == 1:
+                if cache_schedule.is_full_step(i):
                     prv_features = None
                     # print(t, prv_features is None)
                     # predict the noise residual
 
-                    noise_pred, prv_features = self.unet(
+                    unet = full_step_unet(self.fast_unet)
+                    if feature_cache is not None:
+                        # samples cached by an earlier call, or repeated in the
+                        # batch, run the UNet once
+                        step_keys = feature_cache.step_keys(
+                            latent_model_input, t, conditioning_keys
+                        )
+                        unet = functools.partial(feature_cache.run, step_keys, unet)
+                    noise_pred, prv_features = unet(
                         latent_model_input,
                         t,
                         encoder_hidden_states=prompt_embeds,
@@ -481,6 +506,7 @@ class StableDiffusionPipeline(OrgStableDiffusionPipeline):
                         cache_block_id=cache_block_id,
                         return_dict=False,
                     )
+                    cache_schedule.update(i, noise_pred, prv_features)
                 else:
                     noise_pred, prv_features = self.fast_unet(
                         latent_model_input,
@@ -519,6 +545,9 @@ class StableDiffusionPipeline(OrgStableDiffusionPipeline):
                     progress_bar.update()
                     if callback is not None and i % callback_steps == 0:
                         callback(i, t, latents)
+        logger.info(f"DeepCache schedule: {cache_schedule.summary()}")
+        if feature_cache is not None:
+            logger.info(f"DeepCache feature cache: {feature_cache.summary()}")
 
         if not output_type == "latent":
             if output_all_sequence:
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
 import inspect
 import os
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
@@ -19,6 +20,7 @@ from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 import importlib.metadata
 from packaging import version
 
+import numpy as np
 import torch
 from transformers import CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer
 
@@ -52,9 +54,11 @@ from diffusers import StableDiffusionXLPipeline as OrgStableDiffusionXLPipeline
 
 from .models.unet_2d_condition import UNet2DConditionModel
 from .models.fast_unet_2d_condition import FastUNet2DConditionModel
+from .schedule import DeepCacheSchedule
+from .feature_cache import DeepCacheFeatureCache
 
 
-from .models.pipeline_utils import enable_deep_cache_pipeline
+from .models.pipeline_utils import enable_deep_cache_pipeline, full_step_unet
 
 
 enable_deep_cache_pipeline()
@@ -260,6 +264,8 @@ class StableDiffusionXLPipeline(OrgStableDiffusionXLPipeline):
         uniform: bool = True,
         pow: float = None,
         center: int = None,
+        cache_schedule: Optional[DeepCacheSchedule] = None,
+        feature_cache: Optional[DeepCacheFeatureCache] = None,
     ):
         r"""
         Function invoked when calling the pipeline for generation.
@@ -551,20 +557,34 @@ class StableDiffusionXLPipeline(OrgStableDiffusionXLPipeline):
             )
             timesteps = timesteps[:num_inference_steps]
 
-        if cache_interval == 1:
-            interval_seq = list(range(num_inference_steps))
-        else:
-            if uniform:
-                interval_seq = list(range(0, num_inference_steps, cache_interval))
+        if cache_schedule is None:
+            if cache_interval == 1:
+                interval_seq = list(range(num_inference_steps))
             else:
-                num_slow_step = num_inference_steps // cache_interval
-                if num_inference_steps % cache_interval != 0:
-                    num_slow_step += 1
-
-                interval_seq, pow = sample_from_quad_center(
-                    num_inference_steps, num_slow_step, center=center, pow=pow
-                )  # [0, 3, 6, 9, 12, 16, 22, 28, 35, 43,]
-        # print(interval_seq)
+                if uniform:
+                    interval_seq = list(range(0, num_inference_steps, cache_interval))
+                else:
+                    num_slow_step = num_inference_steps // cache_interval
+                    if num_inference_steps % cache_interval != 0:
+                        num_slow_step += 1
+
+                    interval_seq, pow = sample_from_quad_center(
+                        num_inference_steps, num_slow_step, center=center, pow=pow
+                    )  # [0, 3, 6, 9, 12, 16, 22, 28, 35, 43,]
+            cache_schedule = DeepCacheSchedule(interval_seq)
+        cache_schedule.reset(num_inference_steps)
+        self.deep_cache_schedule = cache_schedule
+
+        if feature_cache is not None:
+            conditioning_keys = feature_cache.conditioning_keys(
+                prompt_embeds.shape[0],
+                prompt_embeds,
+                add_text_embeds,
+                add_time_ids,
+                cross_attention_kwargs,
+                cache_layer_id,
+                cache_block_id,
+            )
 
         prv_features = None
         with self.progress_bar(total=num_inference_steps) as progress_bar:
@@ -583,11 +603,19 @@ class StableDiffusionXLPipeline(OrgStableDiffusionXLPipeline):
                     "time_ids": add_time_ids,
                 }
 
-                if i in interval_seq or cache_interval == 1:
+                if cache_schedule.is_full_step(i):
                     prv_features = None
                     # print(t, prv_features is None)
                     # predict the noise residual
-                    noise_pred, prv_features = self.unet(
+                    unet = full_step_unet(self.fast_unet)
+                    if feature_cache is not None:
+                        # samples cached by an earlier call, or repeated in the
+                        # batch, run the UNet once
+                        step_keys = feature_cache.step_keys(
+                            latent_model_input, t, conditioning_keys
+                        )
+                        unet = functools.partial(feature_cache.run, step_keys, unet)
+                    noise_pred, prv_features = unet(
                         latent_model_input,
                         t,
                         encoder_hidden_states=prompt_embeds,
@@ -598,6 +626,7 @@ class StableDiffusionXLPipeline(OrgStableDiffusionXLPipeline):
                         cache_block_id=cache_block_id,
                         return_dict=False,
                     )
+                    cache_schedule.update(i, noise_pred, prv_features)
                 else:
                     noise_pred, prv_features = self.fast_unet(
                         latent_model_input,
@@ -636,6 +665,9 @@ class StableDiffusionXLPipeline(OrgStableDiffusionXLPipeline):
                     progress_bar.update()
                     if callback is not None and i % callback_steps == 0:
                         callback(i, t, latents)
+        logger.info(f"DeepCache schedule: {cache_schedule.summary()}")
+        if feature_cache is not None:
+            logger.info(f"DeepCache feature cache: {feature_cache.summary()}")
 
         if not output_type == "latent":
             if self.needs_upcasting:
@@ -42,7 +42,7 @@ from .models.fast_unet_spatio_temporal_condition import (
 )
 
 
-from .models.pipeline_utils import enable_deep_cache_pipeline
+from .models.pipeline_utils import enable_deep_cache_pipeline, full_step_unet
 
 
 enable_deep_cache_pipeline()
@@ -345,7 +345,7 @@ class StableVideoDiffusionPipeline(OrgStableVideoDiffusionPipeline):
                 if i in interval_seq:
                     cache_features = None
                     # predict the noise residual
-                    noise_pred, cache_features = self.unet(
+                    noise_pred, cache_features = full_step_unet(self.fast_unet)(
                         latent_model_input,
                         t,
                         encoder_hidden_states=image_embeddings,
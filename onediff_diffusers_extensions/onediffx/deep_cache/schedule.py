@@ -0,0 +1,139 @@
+from typing import Dict, Iterable, List, Optional
+
+import torch
+
+__all__ = ["DeepCacheSchedule", "AdaptiveDeepCacheSchedule"]
+
+
+class DeepCacheSchedule:
+    r"""
+    The steps of a DeepCache denoising loop that run the full UNet. The other
+    steps run the shallow UNet on the features cached by the last full step.
+
+        >>> schedule = DeepCacheSchedule([0, 3, 6, 9, 12, 16, 22, 28, 35, 43])
+        >>> pipe(prompt, num_inference_steps=50, cache_schedule=schedule)
+        >>> schedule.full_steps
+
+    After a call, `full_steps` holds the steps that ran the full UNet, and
+    `changes` the relative change of the cached features measured at each of
+    them, when the schedule measures it.
+    """
+
+    def __init__(self, full_steps: Optional[Iterable[int]] = None):
+        self.planned_steps = None if full_steps is None else sorted(set(full_steps))
+        self.num_inference_steps = None
+        self.full_steps: List[int] = []
+        self.changes: Dict[int, float] = {}
+
+    def reset(self, num_inference_steps: int):
+        """Start a denoising loop of `num_inference_steps` steps."""
+        self.num_inference_steps = num_inference_steps
+        self.full_steps = []
+        self.changes = {}
+
+    def is_full_step(self, step: int) -> bool:
+        return self.planned_steps is None or step in self.planned_steps
+
+    def update(
+        self,
+        step: int,
+        noise_pred: torch.Tensor,
+        features: Optional[torch.Tensor] = None,
+    ):
+        """Record the outputs of the full UNet at `step`."""
+        self.full_steps.append(step)
+
+    def summary(self) -> str:
+        return (
+            f"{len(self.full_steps)} of {self.num_inference_steps} steps "
+            f"ran the full UNet: {self.full_steps}"
+        )
+
+
+class AdaptiveDeepCacheSchedule(DeepCacheSchedule):
+    r"""
+    Run the full UNet only when the cached features are estimated to be stale.
+
+    At each full step, the relative change of the cached features since the
+    previous full step (or of the noise prediction, with
+    `metric="noise_pred"`) is divided by the steps between them, an estimate
+    of their change per step. A step then runs the full UNet once that rate
+    times the steps since the last full step exceeds `threshold`, so full
+    steps get sparse as the features converge.
+
+    Parameters:
+        threshold (float, optional): The estimated relative change of the cached features that
+            triggers a full step. Default is 0.1.
+        max_full_steps (int, optional): The budget of full steps of a denoising loop. Once spent,
+            all the remaining steps are shallow.
+        max_interval (int, optional): The most steps between two full steps, within the budget.
+        warmup_steps (int, optional): The first steps, which are all full, to measure the first rate.
+            Default is 2.
+        metric (str, optional): "features" or "noise_pred", what to measure the change of.
+            Default is "features".
+
+    Reading the measured change syncs with the device once per full step.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.1,
+        *,
+        max_full_steps: Optional[int] = None,
+        max_interval: Optional[int] = None,
+        warmup_steps: int = 2,
+        metric: str = "features",
+    ):
+        super().__init__()
+        if metric not in ("features", "noise_pred"):
+            raise ValueError(
+                f"[OneDiffX AdaptiveDeepCacheSchedule] metric {metric} is not supported, "
+                "expect 'features' or 'noise_pred'"
+            )
+        if warmup_steps < 1:
+            raise ValueError(
+                "[OneDiffX AdaptiveDeepCacheSchedule] warmup_steps must be at least 1"
+            )
+        self.threshold = threshold
+        self.max_full_steps = max_full_steps
+        self.max_interval = max_interval
+        self.warmup_steps = warmup_steps
+        self.metric = metric
+        self._reference = None
+        self._rate = None
+
+    def reset(self, num_inference_steps: int):
+        super().reset(num_inference_steps)
+        self._reference = None
+        self._rate = None
+
+    def is_full_step(self, step: int) -> bool:
+        if self.max_full_steps is not None and len(self.full_steps) >= self.max_full_steps:
+            return False
+        if step < self.warmup_steps or self._rate is None:
+            return True
+        since = step - self.full_steps[-1]
+        if self.max_interval is not None and since >= self.max_interval:
+            return True
+        return self._rate * since > self.threshold
+
+    def update(
+        self,
+        step: int,
+        noise_pred: torch.Tensor,
+        features: Optional[torch.Tensor] = None,
+    ):
+        measured = noise_pred
+        if self.metric == "features" and isinstance(features, torch.Tensor):
+            measured = features
+        if self._reference is not None and len(self.full_steps) > 0:
+            reference = self._reference.float()
+            change = (measured.float() - reference).norm() / reference.norm().clamp(
+                min=torch.finfo(torch.float32).tiny
+            )
+            change = change.item()
+            self.changes[step] = change
+            self._rate = change / (step - self.full_steps[-1])
+        # The outputs of a compiled UNet may reuse their buffers
+        self._reference = measured.detach().clone()
+        super().update(step, noise_pred, features)
@@ -1 +1,20 @@
-from .lora import load_and_fuse_lora, unfuse_lora, set_and_fuse_adapters, delete_adapters
+from .lora import (
+    load_and_fuse_lora,
+    unfuse_lora,
+    set_and_fuse_adapters,
+    delete_adapters,
+    measure_lora_drift,
+)
+from onediff.lora import LoRADeltaCache
+from .delta_cache import lora_delta_cache
+from .snapshot import LoRABaseSnapshot, lora_base_snapshot
+from .lora_store import LoRAStore, lora_store
+from .prefetch import prefetch_lora, cancel_prefetch
+from .multi_lora import (
+    enable_multi_lora,
+    disable_multi_lora,
+    set_lora_indices,
+    MultiLoRALinear,
+    MultiLoRAConv2d,
+)
+from .prompt_cache import PromptEmbeddingCache, prompt_embedding_cache
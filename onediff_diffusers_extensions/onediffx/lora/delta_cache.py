@@ -0,0 +1,5 @@
+from onediff.lora import LoRADeltaCache
+
+# The deltas of `set_and_fuse_adapters` and `unfuse_lora`, disabled until
+# configured, see `LoRADeltaCache`.
+lora_delta_cache = LoRADeltaCache()
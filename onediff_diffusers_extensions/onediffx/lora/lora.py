@@ -1,6 +1,5 @@
 from pathlib import Path
 from typing import Optional, Union, Dict, Tuple, List
-from collections import OrderedDict, defaultdict
 from packaging import version
 
 import torch
@@ -11,8 +10,22 @@ import diffusers
 from diffusers.loaders import LoraLoaderMixin
 from diffusers.models.lora import PatchedLoraProjection
 
-
-from .utils import _unfuse_lora, _set_adapter, _delete_adapter
+from onediff.lora import is_quantized_module
+
+
+from .delta_cache import lora_delta_cache
+from .multi_lora import is_multi_lora_enabled
+from .prompt_cache import prompt_embedding_cache
+from .lora_store import lora_store
+from .prefetch import pop_prefetched_lora
+from .snapshot import lora_base_snapshot
+from .utils import (
+    get_adapter_names,
+    _delete_adapter,
+    _lora_layer,
+    _set_adapters_batched,
+    _unfuse_lora_batched,
+)
 from .text_encoder import load_lora_into_text_encoder
 from .unet import load_lora_into_unet
 
@@ -44,8 +57,24 @@ def load_and_fuse_lora(
         )
 
     self = pipeline
+    _check_multi_lora_disabled(pipeline, "load_and_fuse_lora")
+
+    if adapter_name is not None:
+        lora_delta_cache.invalidate(adapter_name)
+
+    prefetched = None
+    if isinstance(pretrained_model_name_or_path_or_dict, (str, Path)):
+        prefetched = pop_prefetched_lora(
+            self,
+            pretrained_model_name_or_path_or_dict,
+            device=offload_device,
+            use_cache=use_cache,
+            **kwargs,
+        )
 
-    if use_cache:
+    if prefetched is not None:
+        state_dict, network_alphas = prefetched
+    elif use_cache:
         state_dict, network_alphas = load_state_dict_cached(
             pretrained_model_name_or_path_or_dict,
             unet_config=self.unet.config,
@@ -75,6 +104,7 @@ def load_and_fuse_lora(
     )
 
     # load lora weights into text encoder
+    defer_text_encoder_fusion = prompt_embedding_cache.defers_text_encoder_fusion(self)
     text_encoder_state_dict = {
         k: v for k, v in state_dict.items() if "text_encoder." in k
     }
@@ -87,6 +117,7 @@ def load_and_fuse_lora(
             prefix="text_encoder",
             lora_scale=lora_scale,
             adapter_name=adapter_name,
+            fuse=not defer_text_encoder_fusion,
             _pipeline=self,
         )
 
@@ -102,24 +133,69 @@ def load_and_fuse_lora(
             prefix="text_encoder_2",
             lora_scale=lora_scale,
             adapter_name=adapter_name,
+            fuse=not defer_text_encoder_fusion,
             _pipeline=self,
         )
 
+    if len(text_encoder_state_dict) > 0 or len(text_encoder_2_state_dict) > 0:
+        if adapter_name is None:
+            adapter_name = get_adapter_names(self.text_encoder)
+        prompt_embedding_cache.invalidate(adapter_name)
+        text_encoder_adapters = prompt_embedding_cache.text_encoder_adapters(self)
+        text_encoder_adapters[adapter_name] = 1.0
+        prompt_embedding_cache.set_text_encoder_adapters(
+            self, text_encoder_adapters, fused=not defer_text_encoder_fusion
+        )
 
-def unfuse_lora(pipeline: LoraLoaderMixin):
-    def _unfuse_lora_apply(m: torch.nn.Module):
-        if isinstance(m, (torch.nn.Linear, PatchedLoraProjection, torch.nn.Conv2d)):
-            _unfuse_lora(m)
+
+def _check_multi_lora_disabled(pipeline: LoraLoaderMixin, name: str):
+    if is_multi_lora_enabled(pipeline):
+        raise RuntimeError(
+            f"[OneDiffX {name}] LoRAs are selected per sample, "
+            "call disable_multi_lora(pipeline) first"
+        )
+
+
+def _lora_layers(
+    pipeline: LoraLoaderMixin, text_encoders: bool = True
+) -> List[torch.nn.Module]:
+    layers = []
+
+    def collect_apply(m: torch.nn.Module):
+        if isinstance(
+            m, (torch.nn.Linear, PatchedLoraProjection, torch.nn.Conv2d)
+        ) or is_quantized_module(m):
+            layers.append(m)
         elif is_peft_available() and isinstance(
             m, (peft.tuners.lora.layer.Linear, peft.tuners.lora.layer.Conv2d),
         ):
-            _unfuse_lora(m.base_layer)
+            layers.append(m.base_layer)
 
-    pipeline.unet.apply(_unfuse_lora_apply)
+    pipeline.unet.apply(collect_apply)
+    if not text_encoders:
+        return layers
     if hasattr(pipeline, "text_encoder"):
-        pipeline.text_encoder.apply(_unfuse_lora_apply)
+        pipeline.text_encoder.apply(collect_apply)
     if hasattr(pipeline, "text_encoder_2"):
-        pipeline.text_encoder_2.apply(_unfuse_lora_apply)
+        pipeline.text_encoder_2.apply(collect_apply)
+    return layers
+
+
+def unfuse_lora(pipeline: LoraLoaderMixin):
+    # With deferred text encoder fusion, the text encoders are unfused on the
+    # next prompt embedding cache miss, see `PromptEmbeddingCache`.
+    deferred = prompt_embedding_cache.defers_text_encoder_fusion(pipeline)
+    _unfuse_lora_batched(_lora_layers(pipeline, text_encoders=not deferred))
+    prompt_embedding_cache.set_text_encoder_adapters(pipeline, {}, fused=not deferred)
+
+
+def measure_lora_drift(pipeline: LoraLoaderMixin) -> Dict:
+    r"""
+    Compare the weights of the layers with no fused LoRA against the copies
+    of their base weights taken by `lora_base_snapshot`, see `LoRABaseSnapshot.drift`.
+    """
+    layers = [_lora_layer(m) for m in _lora_layers(pipeline)]
+    return lora_base_snapshot.drift(layers)
 
 
 def set_and_fuse_adapters(
@@ -129,28 +205,32 @@ def set_and_fuse_adapters(
 ):
     if isinstance(adapter_names, str):
         adapter_names = [adapter_names]
-
-    def set_adapters_apply(m):
-        if isinstance(m, (torch.nn.Linear, torch.nn.Conv2d, PatchedLoraProjection)):
-            _set_adapter(m, adapter_names, adapter_weights)
-        elif is_peft_available() and isinstance(
-            m, (peft.tuners.lora.layer.Linear, peft.tuners.lora.layer.Conv2d),
-        ):
-            _set_adapter(m.base_layer, adapter_names, adapter_weights)
-
-    pipeline.unet.apply(set_adapters_apply)
-    if hasattr(pipeline, "text_encoder"):
-        pipeline.text_encoder.apply(set_adapters_apply)
-    if hasattr(pipeline, "text_encoder_2"):
-        pipeline.text_encoder_2.apply(set_adapters_apply)
+    _check_multi_lora_disabled(pipeline, "set_and_fuse_adapters")
+    if adapter_weights is None:
+        adapter_weights = 1.0
+    if isinstance(adapter_weights, float):
+        adapter_weights = [adapter_weights] * len(adapter_names)
+
+    deferred = prompt_embedding_cache.defers_text_encoder_fusion(pipeline)
+    _set_adapters_batched(
+        _lora_layers(pipeline, text_encoders=not deferred),
+        adapter_names,
+        adapter_weights,
+    )
+    prompt_embedding_cache.set_text_encoder_adapters(
+        pipeline, dict(zip(adapter_names, adapter_weights)), fused=not deferred
+    )
 
 
 def delete_adapters(self, adapter_names: Union[List[str], str]):
     if isinstance(adapter_names, str):
         adapter_names = [adapter_names]
+    lora_delta_cache.invalidate(adapter_names)
 
     def delete_adapters_apply(m):
-        if isinstance(m, (torch.nn.Linear, torch.nn.Conv2d, PatchedLoraProjection)):
+        if isinstance(
+            m, (torch.nn.Linear, torch.nn.Conv2d, PatchedLoraProjection)
+        ) or is_quantized_module(m):
             _delete_adapter(m, adapter_names)
         elif is_peft_available() and isinstance(
             m, (peft.tuners.lora.layer.Linear, peft.tuners.lora.layer.Conv2d),
@@ -162,47 +242,10 @@ def delete_adapters(self, adapter_names: Union[List[str], str]):
         self.text_encoder.apply(delete_adapters_apply)
     if hasattr(self, "text_encoder_2"):
         self.text_encoder_2.apply(delete_adapters_apply)
-
-
-class LRUCacheDict(OrderedDict):
-    def __init__(self, capacity):
-        super().__init__()
-        self.capacity = capacity
-
-    def __getitem__(self, key):
-        value = super().__getitem__(key)
-        self.move_to_end(key)
-        return value
-
-    def __setitem__(self, key, value):
-        if len(self) >= self.capacity:
-            oldest_key = next(iter(self))
-            del self[oldest_key]
-        super().__setitem__(key, value)
+    prompt_embedding_cache.delete_text_encoder_adapters(self, adapter_names)
 
 
 def load_state_dict_cached(
     lora: Union[str, Path, Dict[str, torch.Tensor]], **kwargs,
 ) -> Tuple[Dict, Dict]:
-    assert isinstance(lora, (str, Path, dict))
-    if isinstance(lora, dict):
-        state_dict, network_alphas = LoraLoaderMixin.lora_state_dict(lora, **kwargs)
-        return state_dict, network_alphas
-
-    global CachedLoRAs
-    weight_name = kwargs.get("weight_name", None)
-
-    lora_name = str(lora) + (f"/{weight_name}" if weight_name else "")
-    if lora_name in CachedLoRAs:
-        logger.debug(
-            f"[OneDiffX Cached LoRA] get cached lora of name: {str(lora_name)}"
-        )
-        return CachedLoRAs[lora_name]
-
-    state_dict, network_alphas = LoraLoaderMixin.lora_state_dict(lora, **kwargs,)
-    CachedLoRAs[lora_name] = (state_dict, network_alphas)
-    logger.debug(f"[OneDiffX Cached LoRA] create cached lora of name: {str(lora_name)}")
-    return state_dict, network_alphas
-
-
-CachedLoRAs = LRUCacheDict(100)
+    return lora_store.load(lora, **kwargs)
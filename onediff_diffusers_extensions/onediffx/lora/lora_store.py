@@ -0,0 +1,202 @@
+import json
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+
+import torch
+from diffusers.loaders import LoraLoaderMixin
+
+from onediff.infer_compiler.utils.log_utils import logger
+
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+if hasattr(torch, "float8_e4m3fn"):
+    _SAFETENSORS_DTYPES["F8_E4M3"] = torch.float8_e4m3fn
+    _SAFETENSORS_DTYPES["F8_E5M2"] = torch.float8_e5m2
+
+
+def mmap_safetensors(path: Union[str, Path]) -> Dict[str, torch.Tensor]:
+    r"""
+    Load a safetensors file as CPU tensors backed by a memory map of the file.
+
+    Nothing is read until a tensor is used, and the pages read are held by
+    the page cache, shared by every process mapping the same file. The map is
+    private (copy-on-write), so in-place updates never reach the file.
+    """
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    (header_size,) = struct.unpack("<Q", mapped[:8])
+    header = json.loads(mapped[8 : 8 + header_size])
+    header.pop("__metadata__", None)
+    data_offset = 8 + header_size
+
+    state_dict = {}
+    for name, info in header.items():
+        dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        count = (end - begin) // torch.empty((), dtype=dtype).element_size()
+        if count == 0:
+            state_dict[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        tensor = torch.frombuffer(
+            mapped, dtype=dtype, count=count, offset=data_offset + begin
+        )
+        state_dict[name] = tensor.reshape(info["shape"])
+    return state_dict
+
+
+def _heap_bytes(state_dict: Dict, mapped: Dict[str, torch.Tensor]) -> int:
+    """The bytes of the tensors of `state_dict` that are not views of the map of `mapped`."""
+    ranges = [
+        (t.data_ptr(), t.data_ptr() + t.numel() * t.element_size())
+        for t in mapped.values()
+        if t.numel() > 0
+    ]
+    if len(ranges) == 0:
+        begin = end = 0
+    else:
+        begin, end = min(r[0] for r in ranges), max(r[1] for r in ranges)
+    return sum(
+        v.numel() * v.element_size()
+        for v in state_dict.values()
+        if isinstance(v, torch.Tensor) and not begin <= v.data_ptr() < end
+    )
+
+
+def _resolve_safetensors_file(
+    lora: Union[str, Path], weight_name: Optional[str]
+) -> Optional[Path]:
+    path = Path(lora)
+    if weight_name is not None and path.is_dir():
+        path = path / weight_name
+    if path.is_file() and path.suffix == ".safetensors":
+        return path.resolve()
+    return None
+
+
+class LoRAStore:
+    r"""
+    LRU cache of LoRA state dicts, converted to the diffusers format, under a byte budget.
+
+    Local safetensors files are memory-mapped rather than read into the heap
+    of each process, see `mmap_safetensors`, and keyed by path, modification
+    time and size, so a file replaced on disk is loaded again. Their keys are
+    converted once, on the first load. Other LoRAs (e.g. from the hub) are
+    loaded with `LoraLoaderMixin.lora_state_dict` and keyed by name.
+
+    The conversion to the diffusers format is eager because it can't be done
+    per key: `LoraLoaderMixin.lora_state_dict` detects the format and maps
+    the SGM block ids from all the keys of the file. It renames keys and
+    moves the tensors, which stay views of the map, so no weight is read
+    before it is fused, except the alphas it reads as scalars. The tensors
+    a conversion does copy are counted in the byte budget on top of the
+    file size.
+
+        >>> from onediffx.lora import lora_store
+        >>> lora_store.max_bytes = 16 << 30
+        >>> load_and_fuse_lora(pipe, "/path/to/lora.safetensors", use_cache=True)
+        >>> lora_store.stats()
+    """
+
+    def __init__(self, max_bytes: int = 8 << 30):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self._hits,
+            "misses": self._misses,
+        }
+
+    def load(
+        self, lora: Union[str, Path, Dict[str, torch.Tensor]], **kwargs
+    ) -> Tuple[Dict, Dict]:
+        r"""
+        Returns the (state_dict, network_alphas) of `LoraLoaderMixin.lora_state_dict`.
+        Both are shallow copies, so callers may pop their keys.
+        """
+        assert isinstance(lora, (str, Path, dict))
+        if isinstance(lora, dict):
+            return LoraLoaderMixin.lora_state_dict(lora, **kwargs)
+
+        weight_name = kwargs.get("weight_name", None)
+        file = _resolve_safetensors_file(lora, weight_name)
+        if file is not None:
+            stat = os.stat(file)
+            name = str(file)
+            key = (name, stat.st_mtime_ns, stat.st_size)
+        else:
+            name = str(lora) + (f"/{weight_name}" if weight_name else "")
+            key = (name,)
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                logger.debug(f"[OneDiffX LoRAStore] get cached lora of name: {name}")
+                state_dict, network_alphas, _ = self._entries[key]
+                return _copy(state_dict), _copy(network_alphas)
+            self._misses += 1
+
+        if file is not None:
+            mapped = mmap_safetensors(file)
+            state_dict, network_alphas = LoraLoaderMixin.lora_state_dict(
+                dict(mapped), **kwargs
+            )
+            nbytes = stat.st_size + _heap_bytes(state_dict, mapped)
+        else:
+            state_dict, network_alphas = LoraLoaderMixin.lora_state_dict(
+                lora, **kwargs
+            )
+            nbytes = sum(
+                v.numel() * v.element_size()
+                for v in state_dict.values()
+                if isinstance(v, torch.Tensor)
+            )
+
+        with self._lock:
+            # Drop the versions of the file that were replaced on disk
+            for stale_key in [k for k in self._entries if k[0] == name]:
+                self._remove(stale_key)
+            self._entries[key] = (state_dict, network_alphas, nbytes)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                self._remove(next(iter(self._entries)))
+        logger.debug(f"[OneDiffX LoRAStore] create cached lora of name: {name}")
+        return _copy(state_dict), _copy(network_alphas)
+
+    def _remove(self, key):
+        _, _, nbytes = self._entries.pop(key)
+        self._bytes -= nbytes
+
+
+def _copy(d):
+    return None if d is None else dict(d)
+
+
+lora_store = LoRAStore()
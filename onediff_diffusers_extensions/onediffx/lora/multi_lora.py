@@ -0,0 +1,298 @@
+import weakref
+from typing import Dict, List, Optional, Union
+
+import torch
+import torch.nn.functional as F
+from diffusers.loaders import LoraLoaderMixin
+
+from onediff.infer_compiler.with_oneflow_compile import DeployableModule
+from onediff.infer_compiler.utils.metrics import RECOMPILES
+from onediff.lora import is_quantized_module
+
+from .utils import _unfuse_lora_batched
+
+# torch UNet -> MultiLoRAState
+_multi_lora_states = weakref.WeakKeyDictionary()
+
+
+class MultiLoRALinear(torch.nn.Module):
+    r"""
+    A Linear layer with unfused LoRAs, selected per sample.
+
+    The LoRAs are stacked into `lora_A` (adapters + 1, rank, in_features) and
+    `lora_B` (adapters + 1, out_features, rank), slot 0 being a zero LoRA, and
+    sample i of the batch takes the LoRA of slot `lora_index[i]`: the factors
+    are gathered per sample and applied with two bmm.
+    """
+
+    def __init__(self, base, lora_A, lora_B, lora_index):
+        super().__init__()
+        self.base = base
+        self.register_buffer("lora_A", lora_A, persistent=False)
+        self.register_buffer("lora_B", lora_B, persistent=False)
+        self.register_buffer("lora_index", lora_index, persistent=False)
+
+    @property
+    def weight(self):
+        return self.base.weight
+
+    @property
+    def bias(self):
+        return self.base.bias
+
+    def forward(self, x, *args, **kwargs):
+        out = self.base(x, *args, **kwargs)
+        batch = x.shape[0]
+        index = self.lora_index[:batch]
+        lora_A = self.lora_A.index_select(0, index)
+        lora_B = self.lora_B.index_select(0, index)
+        hidden = torch.bmm(x.reshape(batch, -1, x.shape[-1]), lora_A.transpose(1, 2))
+        delta = torch.bmm(hidden, lora_B.transpose(1, 2))
+        return out + delta.reshape(out.shape)
+
+
+class MultiLoRAConv2d(torch.nn.Module):
+    r"""
+    A Conv2d layer with unfused LoRAs, selected per sample, see `MultiLoRALinear`.
+
+    `lora_A` is (adapters + 1, rank, in_channels, kh, kw) and `lora_B`
+    (adapters + 1, out_channels, rank, 1, 1). The factors gathered per sample
+    are applied with two grouped convolutions, one group per sample.
+    """
+
+    def __init__(self, base, lora_A, lora_B, lora_index):
+        super().__init__()
+        self.base = base
+        self.register_buffer("lora_A", lora_A, persistent=False)
+        self.register_buffer("lora_B", lora_B, persistent=False)
+        self.register_buffer("lora_index", lora_index, persistent=False)
+
+    @property
+    def weight(self):
+        return self.base.weight
+
+    @property
+    def bias(self):
+        return self.base.bias
+
+    def forward(self, x, *args, **kwargs):
+        out = self.base(x, *args, **kwargs)
+        batch = x.shape[0]
+        index = self.lora_index[:batch]
+        lora_A = self.lora_A.index_select(0, index).flatten(0, 1)
+        lora_B = self.lora_B.index_select(0, index).flatten(0, 1)
+        hidden = F.conv2d(
+            x.reshape(1, -1, x.shape[2], x.shape[3]),
+            lora_A,
+            None,
+            self.base.stride,
+            self.base.padding,
+            self.base.dilation,
+            groups=batch,
+        )
+        delta = F.conv2d(hidden, lora_B, groups=batch)
+        return out + delta.reshape(out.shape)
+
+
+class MultiLoRAState:
+    def __init__(self, adapter_names, lora_index, wrapped):
+        self.adapter_names = adapter_names
+        self.lora_index = lora_index
+        # (parent, name, base layer) of each layer replaced by a wrapper
+        self.wrapped = wrapped
+
+
+def _torch_unet(pipeline):
+    unet = pipeline.unet
+    if isinstance(unet, DeployableModule):
+        return unet._torch_module
+    return unet
+
+
+def _reset_compiled_unet(pipeline):
+    # The module tree changed, so the converted module and its graph are stale.
+    # The fast_unet of the DeepCache pipelines holds the same UNet.
+    for unet in (pipeline.unet, getattr(pipeline, "fast_unet", None)):
+        if isinstance(unet, DeployableModule):
+            RECOMPILES.inc(
+                reason="multi_lora", module=type(unet._torch_module).__name__
+            )
+            del unet._deployable_module_model.oneflow_module
+            unet._reset_graphs()
+
+
+def _stack_factors(layer, adapter_names, adapter_weights):
+    # Slot 0 is the zero LoRA, the ranks are padded to the largest one.
+    downs, ups = [], []
+    for name, weight in zip(adapter_names, adapter_weights):
+        if name not in layer.adapter_names:
+            downs.append(None)
+            ups.append(None)
+            continue
+        down = layer.lora_A[name].float().flatten(start_dim=1)
+        up = layer.lora_B[name].float().flatten(start_dim=1)
+        downs.append(down)
+        ups.append(up * (weight / layer.scaling[name]))
+    rank = max([d.shape[0] for d in downs if d is not None], default=1)
+    out_features = layer.weight.shape[0]
+    in_features = layer.weight[0].numel()
+    lora_A = torch.zeros(len(adapter_names) + 1, rank, in_features)
+    lora_B = torch.zeros(len(adapter_names) + 1, out_features, rank)
+    for slot, (down, up) in enumerate(zip(downs, ups), start=1):
+        if down is not None:
+            lora_A[slot, : down.shape[0]] = down.cpu()
+            lora_B[slot, :, : up.shape[1]] = up.cpu()
+    lora_A = lora_A.reshape(-1, rank, *layer.weight.shape[1:])
+    if isinstance(layer, torch.nn.Conv2d):
+        lora_B = lora_B[..., None, None]
+    dtype, device = layer.weight.dtype, layer.weight.device
+    return lora_A.to(device, dtype), lora_B.to(device, dtype)
+
+
+def _multi_lora_layers(unet, adapter_names):
+    layers = []
+    for layer in unet.modules():
+        if not isinstance(layer, (torch.nn.Linear, torch.nn.Conv2d)):
+            continue
+        if is_quantized_module(layer) or not hasattr(layer, "adapter_names"):
+            continue
+        if not layer.adapter_names.isdisjoint(adapter_names):
+            layers.append(layer)
+    return layers
+
+
+def enable_multi_lora(
+    pipeline: LoraLoaderMixin,
+    adapter_names: Union[List[str], str],
+    adapter_weights: Optional[List[float]] = None,
+    *,
+    max_batch_size: int = 16,
+):
+    r"""
+    Keep the LoRAs of the UNet unfused and select them per sample, so one batch
+    can mix samples with different LoRAs, see `set_lora_indices`.
+
+    The fused LoRAs of the UNet are unfused, and each Linear and Conv2d layer
+    with one of `adapter_names` is wrapped by a `MultiLoRALinear` or
+    `MultiLoRAConv2d` holding the stacked LoRAs. A compiled UNet is compiled
+    again on its next call, since its module tree changed. Calling it again,
+    with the same number of adapters of the same ranks, updates the stacked
+    LoRAs in place, without a recompilation.
+
+    Parameters:
+        pipeline (`LoraLoaderMixin`): The pipeline the LoRAs were loaded into, by `load_and_fuse_lora`.
+        adapter_names (`str` or `List[str]`): The LoRAs that samples can select.
+        adapter_weights (`List[float]`, optional): The strength of each LoRA. Default is 1.0.
+        max_batch_size (`int`, optional): The largest batch of the UNet, with the classifier-free guidance
+            samples. Default is 16.
+    """
+    if isinstance(adapter_names, str):
+        adapter_names = [adapter_names]
+    if adapter_weights is None:
+        adapter_weights = 1.0
+    if isinstance(adapter_weights, float):
+        adapter_weights = [adapter_weights] * len(adapter_names)
+
+    unet = _torch_unet(pipeline)
+    layers = _multi_lora_layers(unet, adapter_names)
+    state = _multi_lora_states.get(unet)
+    if state is not None:
+        # Update the stacked LoRAs in place if their shapes are unchanged
+        wrappers = [getattr(parent, name) for parent, name, _ in state.wrapped]
+        stacks = [
+            _stack_factors(layer, adapter_names, adapter_weights)
+            for _, _, layer in state.wrapped
+        ]
+        if (
+            {id(layer) for layer in layers}
+            == {id(layer) for _, _, layer in state.wrapped}
+            and state.lora_index.shape[0] >= max_batch_size
+            and all(
+                lora_A.shape == wrapper.lora_A.shape
+                and lora_B.shape == wrapper.lora_B.shape
+                for wrapper, (lora_A, lora_B) in zip(wrappers, stacks)
+            )
+        ):
+            for wrapper, (lora_A, lora_B) in zip(wrappers, stacks):
+                wrapper.lora_A.copy_(lora_A)
+                wrapper.lora_B.copy_(lora_B)
+            state.adapter_names = adapter_names
+            return
+        disable_multi_lora(pipeline)
+
+    layer_ids = {id(layer) for layer in layers}
+    wrapped = [
+        (parent, name, layer)
+        for parent in unet.modules()
+        for name, layer in parent._modules.items()
+        if id(layer) in layer_ids
+    ]
+
+    _unfuse_lora_batched([layer for _, _, layer in wrapped])
+    lora_index = torch.zeros(
+        max_batch_size, dtype=torch.int64, device=next(unet.parameters()).device
+    )
+    for parent, name, layer in wrapped:
+        lora_A, lora_B = _stack_factors(layer, adapter_names, adapter_weights)
+        wrapper_cls = (
+            MultiLoRAConv2d if isinstance(layer, torch.nn.Conv2d) else MultiLoRALinear
+        )
+        setattr(parent, name, wrapper_cls(layer, lora_A, lora_B, lora_index))
+    _multi_lora_states[unet] = MultiLoRAState(adapter_names, lora_index, wrapped)
+    _reset_compiled_unet(pipeline)
+
+
+def disable_multi_lora(pipeline: LoraLoaderMixin):
+    """Put back the layers wrapped by `enable_multi_lora`. The LoRAs stay unfused."""
+    unet = _torch_unet(pipeline)
+    state = _multi_lora_states.pop(unet, None)
+    if state is None:
+        return
+    for parent, name, layer in state.wrapped:
+        setattr(parent, name, layer)
+    _reset_compiled_unet(pipeline)
+
+
+def is_multi_lora_enabled(pipeline: LoraLoaderMixin) -> bool:
+    return _torch_unet(pipeline) in _multi_lora_states
+
+
+def set_lora_indices(
+    pipeline: LoraLoaderMixin,
+    adapters: List[Optional[str]],
+    *,
+    do_classifier_free_guidance: bool = True,
+):
+    r"""
+    Select the LoRA of each sample of the next UNet calls.
+
+    Parameters:
+        pipeline (`LoraLoaderMixin`): The pipeline of `enable_multi_lora`.
+        adapters (`List[Optional[str]]`): The adapter name of each sample of the batch, or None for no LoRA.
+            With `num_images_per_prompt` > 1, repeat the name of a prompt for each of its images.
+        do_classifier_free_guidance (`bool`, optional): Whether the pipeline doubles the batch for
+            classifier-free guidance, so the samples take the LoRAs of `adapters` twice. Default is True.
+    """
+    state = _multi_lora_states.get(_torch_unet(pipeline))
+    if state is None:
+        raise RuntimeError(
+            "[OneDiffX set_lora_indices] call enable_multi_lora(pipeline, ...) first"
+        )
+    slots: Dict[Optional[str], int] = {None: 0}
+    slots.update({name: i + 1 for i, name in enumerate(state.adapter_names)})
+    for adapter in adapters:
+        if adapter not in slots:
+            raise ValueError(
+                f"[OneDiffX set_lora_indices] adapter {adapter} is not enabled, "
+                f"expect one of {state.adapter_names}"
+            )
+    indices = [slots[adapter] for adapter in adapters]
+    if do_classifier_free_guidance:
+        indices = indices * 2
+    if len(indices) > state.lora_index.shape[0]:
+        raise ValueError(
+            f"[OneDiffX set_lora_indices] batch of {len(indices)} samples exceeds "
+            f"the max_batch_size {state.lora_index.shape[0]} of enable_multi_lora"
+        )
+    indices += [0] * (state.lora_index.shape[0] - len(indices))
+    state.lora_index.copy_(torch.tensor(indices, dtype=torch.int64))
@@ -0,0 +1,183 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import torch
+from diffusers.loaders import LoraLoaderMixin
+
+from onediff.infer_compiler.utils.log_utils import logger
+
+from .lora_store import lora_store
+
+_executor = None
+_executor_lock = threading.Lock()
+# The pending prefetches, oldest first, at most `max_prefetched` of them
+_prefetched: "OrderedDict[Tuple, Future]" = OrderedDict()
+_prefetched_lock = threading.Lock()
+max_prefetched = 16
+
+
+def _get_executor(max_workers: int) -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="onediffx_lora_prefetch"
+            )
+        return _executor
+
+
+def _normalize_device(device: Optional[str]) -> Optional[torch.device]:
+    # "cuda" and "cuda:<current device>" are one device. The index is taken in
+    # the calling thread, the current device of the workers may differ.
+    if device is None:
+        return None
+    device = torch.device(device)
+    if device.type == "cuda" and device.index is None:
+        device = torch.device("cuda", torch.cuda.current_device())
+    return device
+
+
+def _prefetch_key(
+    lora: Union[str, Path], device: Optional[str], use_cache: bool, kwargs: Dict
+) -> Tuple:
+    # kwargs includes the `unet_config` of the pipeline, which the conversion depends on
+    device = _normalize_device(device)
+    device = None if device is None else str(device)
+    kwargs = repr(sorted(kwargs.items(), key=lambda item: item[0]))
+    return str(lora), device, use_cache, kwargs
+
+
+def _drop(key):
+    # The staged tensors of a started prefetch are freed once it finishes
+    future = _prefetched.pop(key)
+    future.cancel()
+
+
+def _stage(state_dict: Dict, device: Optional[str], pin_memory: bool) -> Dict:
+    if device is not None and torch.device(device).type == "cuda":
+        # Copy on a side stream, so the copies overlap with the denoising loop
+        stream = torch.cuda.Stream(device=device)
+        with torch.cuda.stream(stream):
+            state_dict = {
+                k: (
+                    v.to(device, non_blocking=True)
+                    if isinstance(v, torch.Tensor)
+                    else v
+                )
+                for k, v in state_dict.items()
+            }
+        stream.synchronize()
+    elif pin_memory:
+        state_dict = {
+            k: v.pin_memory() if isinstance(v, torch.Tensor) else v
+            for k, v in state_dict.items()
+        }
+    return state_dict
+
+
+def _load(lora, device, pin_memory, use_cache, kwargs) -> Tuple[Dict, Dict]:
+    if use_cache:
+        state_dict, network_alphas = lora_store.load(lora, **kwargs)
+    else:
+        state_dict, network_alphas = LoraLoaderMixin.lora_state_dict(lora, **kwargs)
+    return _stage(state_dict, device, pin_memory), network_alphas
+
+
+def prefetch_lora(
+    pipeline: LoraLoaderMixin,
+    names: Union[List[Union[str, Path]], str, Path],
+    *,
+    device: Optional[str] = None,
+    pin_memory: bool = False,
+    use_cache: bool = False,
+    max_workers: int = 4,
+    **kwargs,
+) -> List[Future]:
+    r"""
+    Read and convert LoRA state dicts in a thread pool, ahead of the
+    `load_and_fuse_lora` calls that need them.
+
+    A later `load_and_fuse_lora(pipeline, name, ...)` with the same name (and
+    arguments) takes the prefetched state dict instead of loading it,
+    waiting for the prefetch if it is still running. Its `offload_device`
+    must be the `device` of the prefetch, unless the weights were staged on
+    CPU (`device=None`).
+
+    At most `onediffx.lora.prefetch.max_prefetched` prefetches are kept, the
+    oldest ones are dropped beyond it. Use `cancel_prefetch` to drop the
+    prefetches that won't be loaded, which hold their staged weights.
+
+    Parameters:
+        pipeline (`LoraLoaderMixin`): The pipeline the LoRAs will be fused into.
+        names (`str` or `List[str]`): Paths or hub ids of the LoRAs.
+        device (`str`, optional): The device to stage the LoRA weights on, e.g. the
+            `offload_device` passed to `load_and_fuse_lora`. Default is None, which keeps them on CPU.
+        pin_memory (`bool`, optional): Whether to pin the weights staged on CPU.
+        use_cache (`bool`, optional): Whether to load through `lora_store`, like `load_and_fuse_lora`.
+        max_workers (`int`, optional): The number of threads of the pool, set by the first call.
+        kwargs: See `LoraLoaderMixin.lora_state_dict`, e.g. `weight_name`.
+
+    Returns:
+        The futures of the (state_dict, network_alphas) of each LoRA.
+    """
+    if isinstance(names, (str, Path)):
+        names = [names]
+    executor = _get_executor(max_workers)
+    device = _normalize_device(device)
+    kwargs = {"unet_config": pipeline.unet.config, **kwargs}
+    futures = []
+    with _prefetched_lock:
+        for name in names:
+            key = _prefetch_key(name, device, use_cache, kwargs)
+            future = _prefetched.get(key)
+            if future is None or (future.done() and future.exception() is not None):
+                future = executor.submit(
+                    _load, name, device, pin_memory, use_cache, kwargs
+                )
+                _prefetched[key] = future
+            _prefetched.move_to_end(key)
+            futures.append(future)
+        while len(_prefetched) > max_prefetched:
+            _drop(next(iter(_prefetched)))
+    return futures
+
+
+def cancel_prefetch(names: Optional[Union[List[Union[str, Path]], str, Path]] = None):
+    """Drop the prefetches of `names`, with any arguments, or all of them if None."""
+    if isinstance(names, (str, Path)):
+        names = [names]
+    names = None if names is None else {str(name) for name in names}
+    with _prefetched_lock:
+        for key in list(_prefetched):
+            if names is None or key[0] in names:
+                _drop(key)
+
+
+def pop_prefetched_lora(
+    pipeline: LoraLoaderMixin,
+    lora: Union[str, Path],
+    *,
+    device: Optional[str] = None,
+    use_cache: bool = False,
+    **kwargs,
+) -> Optional[Tuple[Dict, Dict]]:
+    """The (state_dict, network_alphas) of `lora` prefetched with the same arguments,
+    on `device` or on CPU, or None if it was not prefetched."""
+    kwargs = {"unet_config": pipeline.unet.config, **kwargs}
+    with _prefetched_lock:
+        future = None
+        for staged_device in (device, None):
+            key = _prefetch_key(lora, staged_device, use_cache, kwargs)
+            future = _prefetched.pop(key, None)
+            if future is not None:
+                break
+    if future is None or future.cancelled():
+        return None
+    try:
+        return future.result()
+    except Exception as e:
+        logger.warning(f"[OneDiffX prefetch_lora] prefetch of {lora} failed: {e=}")
+        return None
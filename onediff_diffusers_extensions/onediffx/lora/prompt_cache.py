@@ -0,0 +1,295 @@
+import inspect
+import itertools
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Dict, List, Optional, Union
+
+import torch
+
+from onediff.infer_compiler.utils.log_utils import logger
+
+from .utils import _set_adapters_batched, _unfuse_lora_batched
+
+
+class _PipelineState:
+    def __init__(self, pipeline, encode_prompt, defer_text_encoder_fusion):
+        self.pipeline = weakref.ref(pipeline)
+        # The state is the value of its pipeline in a WeakKeyDictionary, so it
+        # holds no strong reference to the pipeline, bound methods included
+        if inspect.ismethod(encode_prompt):
+            self._encode_prompt = weakref.WeakMethod(encode_prompt)
+        else:
+            self._encode_prompt = lambda: encode_prompt
+        self.signature = inspect.signature(encode_prompt)
+        self.defer_text_encoder_fusion = defer_text_encoder_fusion
+        # adapter name -> weight, of the text encoder LoRAs the embeddings are
+        # encoded with, and of the LoRAs fused into the text encoders
+        self.adapters = _fused_text_encoder_adapters(pipeline)
+        self.fused_adapters = dict(self.adapters)
+        # The cached embeddings of the pipeline, least recently used first:
+        # key -> (output, nbytes, tick of the last use)
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+    def encode_prompt(self, *args, **kwargs):
+        return self._encode_prompt()(*args, **kwargs)
+
+    def remove(self, key):
+        _, nbytes, _ = self.entries.pop(key)
+        self.bytes -= nbytes
+
+
+def _text_encoder_layers(pipeline) -> List[torch.nn.Module]:
+    layers = []
+    for name in ("text_encoder", "text_encoder_2"):
+        text_encoder = getattr(pipeline, name, None)
+        if text_encoder is None:
+            continue
+        for m in text_encoder.modules():
+            if hasattr(m, "active_adapter_names"):
+                layers.append(m)
+    return layers
+
+
+def _fused_text_encoder_adapters(pipeline) -> Dict[str, float]:
+    adapters = {}
+    for layer in _text_encoder_layers(pipeline):
+        adapters.update(layer.active_adapter_names)
+    return adapters
+
+
+def _hashable(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(v) for v in value)
+    if isinstance(value, torch.device):
+        return str(value)
+    return value
+
+
+class PromptEmbeddingCache:
+    r"""
+    LRU cache of the outputs of `encode_prompt`, under a byte budget.
+
+    Each pipeline has its own entries, dropped with the pipeline, keyed by the
+    arguments of `encode_prompt` (prompts, negative prompts, clip skip, ...)
+    and the LoRAs of the text encoders, so a repeated prompt with the same
+    text encoder LoRAs skips the text encoder forward. The byte budget is
+    shared, and the least recently used entry of any pipeline is evicted
+    first. Calls with precomputed `prompt_embeds` are not cached.
+
+    With `defer_text_encoder_fusion`, `load_and_fuse_lora`,
+    `set_and_fuse_adapters` and `unfuse_lora` only record the LoRAs of the text
+    encoders, and they are fused on the first cache miss that needs them. A
+    LoRA switch whose prompts are all cached then never touches the text
+    encoders.
+
+        >>> from onediffx.lora import prompt_embedding_cache
+        >>> prompt_embedding_cache.enable(pipe, max_bytes=512 << 20, defer_text_encoder_fusion=True)
+        >>> set_and_fuse_adapters(pipe, "a")
+        >>> pipe("a cat", ...)  # miss, fuses "a" into the text encoders
+        >>> set_and_fuse_adapters(pipe, "b")
+        >>> set_and_fuse_adapters(pipe, "a")
+        >>> pipe("a cat", ...)  # hit, the text encoders still hold "b"
+        >>> prompt_embedding_cache.stats()
+
+    The cached embeddings are returned as is, so they must not be modified
+    in place.
+    """
+
+    def __init__(self, max_bytes: int = 256 << 20):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._pipelines = weakref.WeakKeyDictionary()
+        self._ticks = itertools.count()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def enable(
+        self,
+        pipeline,
+        *,
+        max_bytes: Optional[int] = None,
+        defer_text_encoder_fusion: bool = False,
+    ):
+        r"""
+        Cache the `encode_prompt` calls of `pipeline`.
+
+        Parameters:
+            pipeline (`LoraLoaderMixin`): A pipeline with an `encode_prompt` method.
+            max_bytes (int, optional): The byte budget of the cached embeddings, shared by all pipelines.
+            defer_text_encoder_fusion (bool, optional): Whether to fuse the LoRAs of the text encoders
+                only when an embedding that needs them is not cached. Default is False.
+        """
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        if pipeline in self._pipelines:
+            self._pipelines[pipeline].defer_text_encoder_fusion = (
+                defer_text_encoder_fusion
+            )
+            return
+        state = _PipelineState(
+            pipeline, pipeline.encode_prompt, defer_text_encoder_fusion
+        )
+        self._pipelines[pipeline] = state
+
+        def encode_prompt(*args, **kwargs):
+            return self._encode_prompt(state, *args, **kwargs)
+
+        pipeline.encode_prompt = encode_prompt
+
+    def disable(self, pipeline):
+        """Stop caching the `encode_prompt` calls of `pipeline`, and fuse its pending LoRAs."""
+        state = self._pipelines.pop(pipeline, None)
+        if state is None:
+            return
+        self._sync_text_encoders(state)
+        pipeline.encode_prompt = state._encode_prompt()
+        with self._lock:
+            state.entries.clear()
+            state.bytes = 0
+
+    def clear(self):
+        with self._lock:
+            for state in self._states():
+                state.entries.clear()
+                state.bytes = 0
+
+    def stats(self):
+        states = self._states()
+        return {
+            "entries": sum(len(state.entries) for state in states),
+            "bytes": sum(state.bytes for state in states),
+            "hits": self._hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+        }
+
+    def defers_text_encoder_fusion(self, pipeline) -> bool:
+        state = self._pipelines.get(pipeline)
+        return state is not None and state.defer_text_encoder_fusion
+
+    def set_text_encoder_adapters(
+        self, pipeline, adapters: Dict[str, float], *, fused: bool
+    ):
+        r"""
+        Record the LoRAs of the text encoders of `pipeline`, by the LoRA API.
+        `fused` tells whether they were fused already or are pending.
+        """
+        state = self._pipelines.get(pipeline)
+        if state is None:
+            return
+        # LoRAs without text encoder layers don't change the embeddings
+        names = set()
+        for layer in _text_encoder_layers(pipeline):
+            names.update(layer.adapter_names)
+        state.adapters = {k: v for k, v in adapters.items() if k in names}
+        if fused:
+            state.fused_adapters = dict(state.adapters)
+
+    def delete_text_encoder_adapters(self, pipeline, adapter_names: List[str]):
+        """Forget `adapter_names`, deleted from the text encoders of `pipeline`."""
+        self.invalidate(adapter_names)
+        state = self._pipelines.get(pipeline)
+        if state is None:
+            return
+        for name in adapter_names:
+            state.adapters.pop(name, None)
+            state.fused_adapters.pop(name, None)
+
+    def text_encoder_adapters(self, pipeline) -> Dict[str, float]:
+        state = self._pipelines.get(pipeline)
+        if state is None:
+            return _fused_text_encoder_adapters(pipeline)
+        return dict(state.adapters)
+
+    def invalidate(self, adapter_names: Union[str, List[str]]):
+        r"""
+        Drop the embeddings encoded with one of `adapter_names`, e.g. when
+        they are deleted or loaded again with other weights.
+        """
+        if isinstance(adapter_names, str):
+            adapter_names = [adapter_names]
+        adapter_names = set(adapter_names)
+        stale = []
+        with self._lock:
+            for state in self._states():
+                for key in list(state.entries):
+                    if any(name in adapter_names for name, _ in key[0]):
+                        state.remove(key)
+                        stale.append(key)
+        if len(stale) > 0:
+            logger.debug(
+                f"[OneDiffX PromptEmbeddingCache] invalidated {len(stale)} embeddings"
+            )
+
+    def _encode_prompt(self, state: _PipelineState, *args, **kwargs):
+        bound = state.signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        if any(isinstance(v, torch.Tensor) for v in bound.arguments.values()):
+            self._sync_text_encoders(state)
+            return state.encode_prompt(*args, **kwargs)
+
+        key = (
+            tuple(sorted(state.adapters.items())),
+            tuple((k, _hashable(v)) for k, v in bound.arguments.items()),
+        )
+        try:
+            hash(key)
+        except TypeError:
+            self._sync_text_encoders(state)
+            return state.encode_prompt(*args, **kwargs)
+
+        with self._lock:
+            entry = state.entries.get(key)
+            if entry is not None:
+                state.entries[key] = (entry[0], entry[1], next(self._ticks))
+                state.entries.move_to_end(key)
+                self._hits += 1
+                return entry[0]
+            self._misses += 1
+
+        self._sync_text_encoders(state)
+        output = state.encode_prompt(*args, **kwargs)
+        tensors = output if isinstance(output, tuple) else (output,)
+        nbytes = sum(
+            t.numel() * t.element_size()
+            for t in tensors
+            if isinstance(t, torch.Tensor)
+        )
+        if nbytes <= self.max_bytes:
+            with self._lock:
+                if key in state.entries:
+                    state.remove(key)
+                state.entries[key] = (output, nbytes, next(self._ticks))
+                state.bytes += nbytes
+                states = self._states()
+                while sum(s.bytes for s in states) > self.max_bytes:
+                    # The least recently used entry of all the pipelines
+                    lru = min(
+                        (s for s in states if len(s.entries) > 0),
+                        key=lambda s: next(iter(s.entries.values()))[2],
+                    )
+                    lru.remove(next(iter(lru.entries)))
+                    self._evictions += 1
+        return output
+
+    def _sync_text_encoders(self, state: _PipelineState):
+        # Fuse the pending LoRAs of the text encoders
+        if state.fused_adapters == state.adapters:
+            return
+        layers = _text_encoder_layers(state.pipeline())
+        if len(state.adapters) == 0:
+            _unfuse_lora_batched(layers)
+        else:
+            _set_adapters_batched(
+                layers, list(state.adapters), list(state.adapters.values())
+            )
+        state.fused_adapters = dict(state.adapters)
+
+    def _states(self) -> List[_PipelineState]:
+        return list(self._pipelines.values())
+
+
+prompt_embedding_cache = PromptEmbeddingCache()
@@ -0,0 +1,125 @@
+import weakref
+from collections import defaultdict
+
+import torch
+from onediff.lora.engine import bulk_copy_, is_quantized_module
+
+
+def _snapshot_names(layer):
+    # An int8 layer is restored with its quantization scales, so its snapshot
+    # takes a quarter of the memory of a float16 copy.
+    if is_quantized_module(layer):
+        return ("weight", "weight_scale", "weight_acc")
+    return ("weight",)
+
+
+def _tensor(layer, name):
+    tensor = getattr(layer, name)
+    return tensor.data if isinstance(tensor, torch.nn.Parameter) else tensor
+
+
+class LoRABaseSnapshot:
+    r"""
+    Copies of the base weights of the layers LoRAs are fused into.
+
+    With snapshots enabled, the weight of a layer is copied (on CPU, optionally
+    pinned) before its first LoRA is fused. Unfusing then restores the copy with
+    a bulk in-place copy instead of subtracting the recomputed deltas, so the
+    base weights are restored bit-exactly however many times LoRAs are switched.
+    This costs host memory of the size of the touched weights, so it is
+    disabled by default:
+
+        >>> from onediffx.lora import lora_base_snapshot, measure_lora_drift
+        >>> lora_base_snapshot.enable(pin_memory=True)
+        >>> load_and_fuse_lora(pipe, ...)  # snapshots the base weights
+        >>> unfuse_lora(pipe)  # restores them
+        >>> measure_lora_drift(pipe)  # {"layers": ..., "drifted_layers": 0, "max_abs_diff": 0.0}
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.pin_memory = False
+        self.restore_on_unfuse = True
+        self._weights = weakref.WeakKeyDictionary()
+
+    def enable(self, pin_memory: bool = False, restore_on_unfuse: bool = True):
+        r"""
+        Parameters:
+            pin_memory (bool, optional): Whether to pin the copies, for faster restores to cuda.
+            restore_on_unfuse (bool, optional): Whether unfusing restores the copies. If False,
+                unfusing subtracts the deltas as usual and the copies are only used to measure drift.
+        """
+        self.enabled = True
+        self.pin_memory = pin_memory
+        self.restore_on_unfuse = restore_on_unfuse
+
+    def disable(self):
+        self.enabled = False
+        self.clear()
+
+    def clear(self):
+        self._weights.clear()
+
+    def stats(self):
+        return {
+            "layers": len(self._weights),
+            "bytes": sum(
+                t.numel() * t.element_size()
+                for tensors in self._weights.values()
+                for t in tensors
+            ),
+        }
+
+    def __contains__(self, layer) -> bool:
+        return layer in self._weights
+
+    def save(self, layer):
+        """Copy the weight of `layer`, which must hold its base weight."""
+        if not self.enabled or layer in self._weights:
+            return
+        tensors = []
+        for name in _snapshot_names(layer):
+            tensor = _tensor(layer, name).detach().to("cpu", copy=True)
+            if self.pin_memory:
+                tensor = tensor.pin_memory()
+            tensors.append(tensor)
+        self._weights[layer] = tensors
+
+    def restore(self, layers):
+        """Copy the saved base weights back into `layers`, in place."""
+        groups = defaultdict(list)
+        for layer in layers:
+            names = _snapshot_names(layer)
+            for name, base in zip(names, self._weights[layer]):
+                tensor = _tensor(layer, name)
+                groups[tensor.device].append((tensor, base))
+        for device, entries in groups.items():
+            weights, bases = zip(*entries)
+            bases = [b.to(device, non_blocking=True) for b in bases]
+            bulk_copy_(list(weights), bases)
+
+    def drift(self, layers):
+        r"""
+        Compare the weight of each of `layers` that has a snapshot and no fused
+        adapter with its base weight.
+
+        Returns a dict with the number of layers compared, of layers that
+        differ from their base weight, and the max absolute difference.
+        """
+        report = {"layers": 0, "drifted_layers": 0, "max_abs_diff": 0.0}
+        for layer in layers:
+            if layer not in self._weights or len(
+                getattr(layer, "active_adapter_names", {})
+            ) > 0:
+                continue
+            base = self._weights[layer][0]
+            weight = layer.weight.data.to(base.device)
+            report["layers"] += 1
+            if not torch.equal(weight, base):
+                report["drifted_layers"] += 1
+                diff = (weight.float() - base.float()).abs().max().item()
+                report["max_abs_diff"] = max(report["max_abs_diff"], diff)
+        return report
+
+
+lora_base_snapshot = LoRABaseSnapshot()
@@ -14,7 +14,7 @@ from diffusers.utils import is_accelerate_available
 from diffusers.models.modeling_utils import _LOW_CPU_MEM_USAGE_DEFAULT
 from onediff.infer_compiler.utils.log_utils import logger
 
-from .utils import fuse_lora, get_adapter_names
+from .utils import fuse_lora, get_adapter_names, _fuse_adapter_batched
 
 USE_PEFT_BACKEND = False
 
@@ -31,6 +31,7 @@ def load_lora_into_text_encoder(
     lora_scale=1.0,
     low_cpu_mem_usage=None,
     adapter_name=None,
+    fuse=True,
     _pipeline=None,
 ):
     """
@@ -59,7 +60,16 @@ def load_lora_into_text_encoder(
         adapter_name (`str`, *optional*):
             Adapter name to be used for referencing the loaded adapter model. If not specified, it will use
             `default_{i}` where i is the total number of adapters being loaded.
+        fuse (`bool`, *optional*):
+            Whether to fuse the LoRA layers, all at once like the UNet layers. If False, they are loaded
+            inactive, to be fused later by `set_and_fuse_adapters` or the prompt embedding cache.
+            Default is True.
     """
+    lora_layers = []
+
+    def load_layer(module, *args, **kwargs):
+        lora_layers.append(fuse_lora(module, *args, fuse=False, **kwargs))
+
     low_cpu_mem_usage = (
         low_cpu_mem_usage
         if low_cpu_mem_usage is not None
@@ -227,7 +237,7 @@ def load_lora_into_text_encoder(
                     else:
                         current_rank = rank
 
-                    fuse_lora(
+                    load_layer(
                         attn_module.q_proj,
                         te_lora_grouped_dict.pop(f"{name}.q_proj"),
                         lora_scale,
@@ -236,7 +246,7 @@ def load_lora_into_text_encoder(
                         adapter_name=adapter_name,
                         prefix="lora_linear_layer",
                     )
-                    fuse_lora(
+                    load_layer(
                         attn_module.k_proj,
                         te_lora_grouped_dict.pop(f"{name}.k_proj"),
                         lora_scale,
@@ -245,7 +255,7 @@ def load_lora_into_text_encoder(
                         adapter_name=adapter_name,
                         prefix="lora_linear_layer",
                     )
-                    fuse_lora(
+                    load_layer(
                         attn_module.v_proj,
                         te_lora_grouped_dict.pop(f"{name}.v_proj"),
                         lora_scale,
@@ -254,7 +264,7 @@ def load_lora_into_text_encoder(
                         adapter_name=adapter_name,
                         prefix="lora_linear_layer",
                     )
-                    fuse_lora(
+                    load_layer(
                         attn_module.out_proj,
                         te_lora_grouped_dict.pop(f"{name}.out_proj"),
                         lora_scale,
@@ -280,7 +290,7 @@ def load_lora_into_text_encoder(
                             f"{name}.fc2.lora_linear_layer.up.weight"
                         )
 
-                        fuse_lora(
+                        load_layer(
                             mlp_module.fc1,
                             te_lora_grouped_dict.pop(f"{name}.fc1"),
                             lora_scale,
@@ -289,7 +299,7 @@ def load_lora_into_text_encoder(
                             adapter_name=adapter_name,
                             prefix="lora_linear_layer",
                         )
-                        fuse_lora(
+                        load_layer(
                             mlp_module.fc2,
                             te_lora_grouped_dict.pop(f"{name}.fc2"),
                             lora_scale,
@@ -299,6 +309,12 @@ def load_lora_into_text_encoder(
                             prefix="lora_linear_layer",
                         )
 
+                if fuse:
+                    _fuse_adapter_batched(lora_layers, adapter_name)
+                else:
+                    for layer in lora_layers:
+                        layer.active_adapter_names.pop(adapter_name, None)
+
                 if is_network_alphas_populated and len(network_alphas) > 0:
                     raise ValueError(
                         f"The `network_alphas` has to be empty at this point but has the following keys \n\n {', '.join(network_alphas.keys())}"
@@ -4,12 +4,13 @@ from collections import defaultdict
 import torch
 from onediff.infer_compiler.with_oneflow_compile import DeployableModule
 from onediff.infer_compiler.utils.log_utils import logger
+from onediff.lora import is_quantized_module
 from diffusers.models.lora import (
     LoRACompatibleConv,
     LoRACompatibleLinear,
 )
 
-from .utils import fuse_lora, get_adapter_names
+from .utils import fuse_lora, get_adapter_names, _fuse_adapter_batched
 
 from diffusers.utils import is_accelerate_available
 from diffusers.utils.import_utils import is_peft_available
@@ -160,6 +161,7 @@ def _load_attn_procs(
                 f"[OneDiffX _load_attn_procs] The `state_dict` has to be empty at this point but has the following keys \n\n {', '.join(state_dict.keys())}"
             )
 
+        lora_layers = []
         for key, value_dict in lora_grouped_dict.items():
             if isinstance(self, DeployableModule):
                 attn_processor = self._torch_module
@@ -180,8 +182,8 @@ def _load_attn_procs(
                     LoRACompatibleLinear,
                     torch.nn.Linear,
                 ),
-            ):
-                fuse_lora(
+            ) or is_quantized_module(attn_processor):
+                layer = fuse_lora(
                     attn_processor,
                     value_dict,
                     lora_scale,
@@ -189,12 +191,14 @@ def _load_attn_procs(
                     rank,
                     offload_device=offload_device,
                     adapter_name=adapter_name,
+                    fuse=False,
                 )
+                lora_layers.append(layer)
             elif is_peft_available() and isinstance(
                 attn_processor,
                 (peft.tuners.lora.layer.Linear, peft.tuners.lora.layer.Conv2d),
             ):
-                fuse_lora(
+                layer = fuse_lora(
                     attn_processor.base_layer,
                     value_dict,
                     lora_scale,
@@ -202,11 +206,14 @@ def _load_attn_procs(
                     rank,
                     offload_device=offload_device,
                     adapter_name=adapter_name,
+                    fuse=False,
                 )
+                lora_layers.append(layer)
             else:
                 raise ValueError(
                     f"[OneDiffX _load_attn_procs] Module {key} is not a Conv2d or Linear module, got type {type(attn_processor)}"
                 )
+        _fuse_adapter_batched(lora_layers, adapter_name)
     else:
         raise ValueError(
             f"[OneDiffX _load_attn_procs] {pretrained_model_name_or_path_or_dict} does not seem to be in the correct format expected by LoRA training."
@@ -8,6 +8,11 @@ import diffusers
 from diffusers.utils.import_utils import is_peft_available
 from onediff.infer_compiler.with_oneflow_compile import DualModule
 
+from onediff.lora import LoRAUpdate, apply_lora_updates, is_quantized_module
+
+from .delta_cache import lora_delta_cache
+from .snapshot import lora_base_snapshot
+
 if version.parse(diffusers.__version__) <= version.parse("0.20.0"):
     from diffusers.loaders import PatchedLoraProjection
 else:
@@ -86,46 +91,20 @@ def offload_tensor(tensor, device):
         return tensor.to(device)
 
 
-def _set_adapter(self, adapter_names, adapter_weights):
-    if not isinstance(self, (torch.nn.Linear, torch.nn.Conv2d, PatchedLoraProjection)):
-        raise TypeError(f"[OneDiffX _set_adapter] Expect type Linear or Conv2d, got {type(self)}")
-    if isinstance(self, PatchedLoraProjection):
-        self = self.regular_linear_layer
-    if not hasattr(self, "adapter_names"):
-        return
-    if adapter_weights is None:
-        adapter_weights = 1.0
-    if isinstance(adapter_weights, float):
-        adapter_weights = [adapter_weights,] * len(adapter_names)
-    _unfuse_lora(self)
-
-    dtype, device = self.weight.data.dtype, self.weight.data.device
-
-    delta_weight = None
-    for adapter, weight in zip(adapter_names, adapter_weights):
-        if adapter not in self.adapter_names:
-            continue
+def _is_lora_layer(self) -> bool:
+    return isinstance(
+        self, (torch.nn.Linear, torch.nn.Conv2d, PatchedLoraProjection)
+    ) or is_quantized_module(self)
 
-        self.active_adapter_names[adapter] = weight
-        w_down = self.lora_A[adapter].float().to(device)
-        w_up = self.lora_B[adapter].float().to(device)
-        if delta_weight is None:
-            delta_weight = get_delta_weight(
-                self, w_up, w_down, weight / self.scaling[adapter]
-            )
-        else:
-            delta_weight += get_delta_weight(
-                self, w_up, w_down, weight / self.scaling[adapter]
-            )
-        self.active_adapter_names[adapter] = weight
 
-    if delta_weight is not None:
-        fused_weight = self.weight.data.float() + delta_weight
-        self.weight.data.copy_(fused_weight.to(device=device, dtype=dtype))
+def _set_adapter(self, adapter_names, adapter_weights):
+    if not _is_lora_layer(self):
+        raise TypeError(f"[OneDiffX _set_adapter] Expect type Linear or Conv2d, got {type(self)}")
+    _set_adapters_batched([self], adapter_names, adapter_weights)
 
 
 def _delete_adapter(self, adapter_names):
-    if not isinstance(self, (torch.nn.Linear, torch.nn.Conv2d, PatchedLoraProjection)):
+    if not _is_lora_layer(self):
         raise TypeError(f"[OneDiffX _delete_adapter] Expect type Linear or Conv2d, got {type(self)}")
     if isinstance(self, PatchedLoraProjection):
         self = self.regular_linear_layer
@@ -146,9 +125,11 @@ def fuse_lora(
     fuse=True,
     prefix="lora",
     offload_device="cpu",
-) -> None:
+) -> torch.nn.Module:
     r"""
     This will fuse the LoRA weights in `state_dict` into Linear or Conv2d module.
+    Returns the layer holding the LoRA weights, with `fuse=False` pass it to
+    `_fuse_adapter_batched` to fuse many layers at once.
 
     Parameters:
         self (Union[torch.nn.Linear, PatchedLoraProjection, torch.nn.Conv2d]):
@@ -165,8 +146,10 @@ def fuse_lora(
             Prefix for up and down weight keys in the LoRA weight dictionary. Default is "lora".
         offload_device (str, optional):
             Offload Device for backuping weight, can be "cpu" or "cuda". Default is "cpu".
+        fuse (bool, optional):
+            Whether to fuse the LoRA weights now. Default is True.
     """
-    if not isinstance(self, (torch.nn.Linear, PatchedLoraProjection, torch.nn.Conv2d)):
+    if not _is_lora_layer(self):
         if is_peft_available() and isinstance(
             self, (peft.tuners.lora.layer.Linear, peft.tuners.lora.layer.Conv2d)
         ):
@@ -196,6 +179,9 @@ def fuse_lora(
 
     adapter_name = adapter_name if adapter_name is not None else get_adapter_names(self)
 
+    if len(self.active_adapter_names) == 0:
+        lora_base_snapshot.save(self)
+
     self.r[adapter_name] = rank
     self.lora_alpha[adapter_name] = alpha
     self.scaling[adapter_name] = lora_scale
@@ -205,45 +191,120 @@ def fuse_lora(
     self.active_adapter_names[adapter_name] = 1.0
 
     if fuse:
-        lora_weight = get_delta_weight(self, w_up, w_down, 1.0)
-        fused_weight = self.weight.data.float() + lora_weight
-        self.weight.data.copy_(fused_weight.to(device=device, dtype=dtype))
+        if is_quantized_module(self):
+            _apply_lora_deltas([(self, [(adapter_name, 1.0)])])
+        else:
+            lora_weight = get_delta_weight(self, w_up, w_down, 1.0)
+            fused_weight = self.weight.data.float() + lora_weight
+            self.weight.data.copy_(fused_weight.to(device=device, dtype=dtype))
+    return self
 
 
 def _unfuse_lora(
     self: Union[torch.nn.Linear, PatchedLoraProjection, torch.nn.Conv2d],
     adapter_names: Union[str, List[str]] = None,
 ):
-    assert isinstance(self, (torch.nn.Linear, PatchedLoraProjection, torch.nn.Conv2d))
-    if not hasattr(self, "adapter_names"):
-        return
+    assert _is_lora_layer(self)
+    _unfuse_lora_batched([self], adapter_names)
+
+
+def _lora_layer(self):
+    if is_peft_available() and isinstance(
+        self, (peft.tuners.lora.layer.Linear, peft.tuners.lora.layer.Conv2d)
+    ):
+        self = self.base_layer
     if isinstance(self, DualModule):
         self = self._torch_module
     if isinstance(self, PatchedLoraProjection):
         self = self.regular_linear_layer
+    return self
 
-    fused_weight = self.weight.data
-    dtype, device = fused_weight.dtype, fused_weight.device
 
-    delta_weight = None
-    if adapter_names is None:
-        adapter_names = self.active_adapter_names.copy()
+def _set_adapters_batched(layers, adapter_names, adapter_weights):
+    """Batched `_set_adapter` of many layers, see `_apply_lora_deltas`."""
+    if adapter_weights is None:
+        adapter_weights = 1.0
+    if isinstance(adapter_weights, float):
+        adapter_weights = [adapter_weights,] * len(adapter_names)
+    layers = [_lora_layer(layer) for layer in layers]
+    _unfuse_lora_batched(layers)
 
-    for name in adapter_names:
-        if name not in self.active_adapter_names:
+    updates = []
+    for layer in layers:
+        if not hasattr(layer, "adapter_names"):
             continue
-        weight = self.active_adapter_names[name]
-        w_down = self.lora_A[name].to(device=device).float()
-        w_up = self.lora_B[name].to(device).float()
-        if delta_weight is None:
-            delta_weight = get_delta_weight(self, w_up, w_down, weight).to(
-                dtype=dtype, device=device
-            )
+        lora_base_snapshot.save(layer)
+        factors = []
+        for adapter, weight in zip(adapter_names, adapter_weights):
+            if adapter not in layer.adapter_names:
+                continue
+            layer.active_adapter_names[adapter] = weight
+            factors.append((adapter, weight / layer.scaling[adapter]))
+        if len(factors) > 0:
+            updates.append((layer, factors))
+    _apply_lora_deltas(updates)
+
+
+def _fuse_adapter_batched(layers, adapter_name):
+    """Fuse an adapter loaded by `fuse_lora(..., fuse=False)` into many layers."""
+    updates = [(_lora_layer(layer), [(adapter_name, 1.0)]) for layer in layers]
+    _apply_lora_deltas(updates)
+
+
+def _unfuse_lora_batched(layers, adapter_names: Union[str, List[str]] = None):
+    """Batched `_unfuse_lora` of many layers, see `_apply_lora_deltas`."""
+    if isinstance(adapter_names, str):
+        adapter_names = [adapter_names]
+    restore = lora_base_snapshot.enabled and lora_base_snapshot.restore_on_unfuse
+    updates, restored_layers, refuse_updates = [], [], []
+    for layer in layers:
+        layer = _lora_layer(layer)
+        if not hasattr(layer, "adapter_names"):
+            continue
+        names = (
+            layer.active_adapter_names.copy()
+            if adapter_names is None
+            else adapter_names
+        )
+        factors = [
+            (name, layer.active_adapter_names.pop(name))
+            for name in names
+            if name in layer.active_adapter_names
+        ]
+        if len(factors) == 0:
+            continue
+        if restore and layer in lora_base_snapshot:
+            # Restore the base weight, then fuse the adapters that stay active.
+            restored_layers.append(layer)
+            if len(layer.active_adapter_names) > 0:
+                refuse_updates.append((layer, list(layer.active_adapter_names.items())))
         else:
-            delta_weight += get_delta_weight(self, w_up, w_down, weight).to(
-                dtype=dtype, device=device
-            )
-        self.active_adapter_names.pop(name)
+            updates.append((layer, factors))
+    _apply_lora_deltas(updates, alpha=-1.0)
+    lora_base_snapshot.restore(restored_layers)
+    _apply_lora_deltas(refuse_updates)
 
-    if delta_weight is not None:
-        self.weight.data -= delta_weight
+
+def _apply_lora_deltas(updates, alpha: float = 1.0):
+    """Add `alpha` times the LoRA deltas to the weights of many layers at once.
+
+    `updates` is a list of (layer, [(adapter_name, scale), ...]), applied by
+    `onediff.lora.apply_lora_updates` in batches, with `lora_delta_cache`.
+    The int8 weights of quantized layers are requantized in place.
+    """
+    lora_updates = []
+    for layer, factors in updates:
+        quantized = is_quantized_module(layer)
+        lora_updates.append(
+            LoRAUpdate(
+                layer.weight.data,
+                [
+                    (layer.lora_B[name], layer.lora_A[name], scale)
+                    for name, scale in factors
+                ],
+                cache_owner=layer,
+                cache_key=None if quantized else tuple(factors),
+                quant_module=layer if quantized else None,
+            )
+        )
+    apply_lora_updates(lora_updates, alpha, delta_cache=lora_delta_cache)
@@ -0,0 +1,275 @@
+"""
+Benchmark the onediffx.lora operations on CPU, with regression thresholds.
+
+Each operation (load, fuse, set_adapters, unfuse, delete) runs on a synthetic
+UNet and CLIP text encoder, with the layer shapes of SDXL divided by
+`--width-divisor`, for 1..`--max-adapters` random LoRAs of each of `--ranks`.
+It reports the median wall time, the peak growth of the RSS of the process
+during the operation (sampled from /proc, so Linux only) and the drift of the
+base weights from an unfused reference after unfuse and delete, as JSON.
+
+Usage:
+    # record a baseline
+    python3 tests/benchmark_lora_switching.py --output baseline.json
+    # compare with it, exits with status 1 on a regression
+    python3 tests/benchmark_lora_switching.py --output current.json --baseline baseline.json
+
+Times are compared with `--time-tolerance` (relative), drift with
+`--drift-tolerance` (absolute). Baselines are only comparable on the same
+machine and arguments, so none is checked in.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import threading
+import time
+
+import torch
+import pandas as pd
+
+from onediffx.lora import set_and_fuse_adapters, unfuse_lora, delete_adapters
+from onediffx.lora.utils import fuse_lora, _fuse_adapter_batched
+
+from profile_lora_fusion import SDXL_LINEAR_SHAPES
+
+OPERATIONS = ["load", "fuse", "set_adapters", "unfuse", "delete"]
+# (in_channels, out_channels, kernel, count) of the SDXL UNet LoRA Conv2d targets
+SDXL_CONV_SHAPES = [(320, 320, 3, 10), (640, 640, 3, 12), (1280, 1280, 3, 22)]
+CLIP_LAYERS, CLIP_WIDTH = 12, 768
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ranks", type=int, nargs="+", default=[4, 16, 64, 128])
+    parser.add_argument("--max-adapters", type=int, default=4)
+    parser.add_argument("--width-divisor", type=int, default=4)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--dtype", default="float32", choices=["float16", "float32"])
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--baseline", type=str, default=None)
+    parser.add_argument("--time-tolerance", type=float, default=0.2)
+    parser.add_argument("--drift-tolerance", type=float, default=1e-3)
+    return parser.parse_args()
+
+
+class SyntheticPipeline:
+    """The LoRA targets of an SDXL-like pipeline, narrowed by `divisor`."""
+
+    def __init__(self, divisor, dtype):
+        unet = []
+        for in_features, out_features, count in SDXL_LINEAR_SHAPES:
+            unet += [
+                torch.nn.Linear(in_features // divisor, out_features // divisor)
+                for _ in range(count)
+            ]
+        for in_channels, out_channels, kernel, count in SDXL_CONV_SHAPES:
+            unet += [
+                torch.nn.Conv2d(
+                    in_channels // divisor, out_channels // divisor, kernel
+                )
+                for _ in range(count)
+            ]
+        width = CLIP_WIDTH // divisor
+        text_encoder = []
+        for _ in range(CLIP_LAYERS):
+            # q_proj, k_proj, v_proj, out_proj, fc1, fc2
+            text_encoder += [torch.nn.Linear(width, width) for _ in range(4)]
+            text_encoder += [
+                torch.nn.Linear(width, width * 4),
+                torch.nn.Linear(width * 4, width),
+            ]
+        self.unet = torch.nn.ModuleList(unet).to(dtype)
+        self.text_encoder = torch.nn.ModuleList(text_encoder).to(dtype)
+
+    def layers(self):
+        return list(self.unet) + list(self.text_encoder)
+
+
+def random_lora(layer, rank):
+    if isinstance(layer, torch.nn.Conv2d):
+        down = torch.randn(rank, *layer.weight.shape[1:]) * 0.01
+        up = torch.randn(layer.weight.shape[0], rank, 1, 1) * 0.01
+    else:
+        down = torch.randn(rank, layer.weight.shape[1]) * 0.01
+        up = torch.randn(layer.weight.shape[0], rank) * 0.01
+    return {"lora.down.weight": down, "lora.up.weight": up}
+
+
+def rss_mb():
+    # The second field of statm is the resident set size in pages
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+class PeakRSS:
+    """The peak growth of the RSS within the context, sampled every `interval` seconds.
+
+    ru_maxrss is the high-water mark of the whole process, which the first
+    runs already reach, so it doesn't show the memory of later operations.
+    """
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.growth_mb = 0.0
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            self._peak = max(self._peak, rss_mb())
+
+    def __enter__(self):
+        self._done = threading.Event()
+        self._start = self._peak = rss_mb()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._done.set()
+        self._thread.join()
+        self._peak = max(self._peak, rss_mb())
+        self.growth_mb = self._peak - self._start
+
+
+def max_drift(pipeline, references):
+    return max(
+        (layer.weight.data.float() - reference.float()).abs().max().item()
+        for layer, reference in zip(pipeline.layers(), references)
+    )
+
+
+def run_case(args, dtype, rank, num_adapters):
+    pipeline = SyntheticPipeline(args.width_divisor, dtype)
+    references = [layer.weight.data.clone() for layer in pipeline.layers()]
+    loras = [
+        [random_lora(layer, rank) for layer in pipeline.layers()]
+        for _ in range(num_adapters)
+    ]
+    adapter_names = [f"lora_{i}" for i in range(num_adapters)]
+    adapter_weights = [1.0 / num_adapters] * num_adapters
+
+    def load():
+        # Like `load_and_fuse_lora`, without the state dict conversion
+        for name, lora in zip(adapter_names, loras):
+            layers = [
+                fuse_lora(
+                    layer, state_dict, 1.0, rank, rank, adapter_name=name, fuse=False
+                )
+                for layer, state_dict in zip(pipeline.layers(), lora)
+            ]
+            _fuse_adapter_batched(layers, name)
+
+    operations = {
+        "load": load,
+        "fuse": lambda: set_and_fuse_adapters(
+            pipeline, adapter_names, adapter_weights
+        ),
+        "set_adapters": lambda: set_and_fuse_adapters(
+            pipeline, adapter_names[:1], [0.5]
+        ),
+        "unfuse": lambda: unfuse_lora(pipeline),
+        "delete": lambda: delete_adapters(pipeline, adapter_names),
+    }
+
+    results = []
+    for name in OPERATIONS:
+        times, peaks = [], []
+        for _ in range(args.repeats):
+            if name != "load":
+                # Every operation but load starts from the loaded LoRAs
+                unfuse_lora(pipeline)
+                delete_adapters(pipeline, adapter_names)
+                load()
+                if name in ("set_adapters", "unfuse"):
+                    operations["fuse"]()
+            else:
+                delete_adapters(pipeline, adapter_names)
+            with PeakRSS() as peak, torch.no_grad():
+                start = time.perf_counter()
+                operations[name]()
+                times.append(time.perf_counter() - start)
+            peaks.append(peak.growth_mb)
+
+        # Drift after the operation, against the weights it should leave
+        if name in ("unfuse", "delete"):
+            drift = max_drift(pipeline, references)
+        else:
+            drift = None
+        results.append(
+            {
+                "operation": name,
+                "rank": rank,
+                "adapters": num_adapters,
+                "time_ms": statistics.median(times) * 1000,
+                "peak_memory_growth_mb": max(peaks),
+                "max_drift": drift,
+            }
+        )
+    delete_adapters(pipeline, adapter_names)
+    return results
+
+
+def compare(results, baseline, args):
+    baseline = {
+        (r["operation"], r["rank"], r["adapters"]): r for r in baseline["results"]
+    }
+    regressions = []
+    for result in results:
+        key = (result["operation"], result["rank"], result["adapters"])
+        if key not in baseline:
+            continue
+        base = baseline[key]
+        if result["time_ms"] > base["time_ms"] * (1 + args.time_tolerance):
+            regressions.append(
+                f"{key}: time {result['time_ms']:.1f} ms, baseline {base['time_ms']:.1f} ms"
+            )
+        if result["max_drift"] is not None and result["max_drift"] > (
+            (base["max_drift"] or 0.0) + args.drift_tolerance
+        ):
+            regressions.append(
+                f"{key}: drift {result['max_drift']:.2e}, baseline {base['max_drift']}"
+            )
+    return regressions
+
+
+def main():
+    args = parse_args()
+    dtype = getattr(torch, args.dtype)
+    results = []
+    for rank in args.ranks:
+        for num_adapters in range(1, args.max_adapters + 1):
+            results += run_case(args, dtype, rank, num_adapters)
+
+    print(pd.DataFrame(results).to_string(index=False))
+    report = {
+        "config": {
+            "ranks": args.ranks,
+            "max_adapters": args.max_adapters,
+            "width_divisor": args.width_divisor,
+            "repeats": args.repeats,
+            "dtype": args.dtype,
+            "torch": torch.__version__,
+            "machine": platform.machine(),
+            "threads": torch.get_num_threads(),
+        },
+        "results": results,
+    }
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args)
+        for regression in regressions:
+            print(f"Regression {regression}")
+        if len(regressions) > 0:
+            sys.exit(1)
+        print("No regression against the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Profile LoRA switching on CPU, per-layer versus batched fusion.
+
+Unlike profile_lora.py this needs no checkpoint or GPU: the layers have the
+shapes of the SDXL UNet LoRA targets and the LoRAs are random.
+
+Usage:
+    python3 tests/profile_lora_fusion.py --rank 8 --repeats 3
+"""
+import argparse
+import time
+
+import torch
+import pandas as pd
+
+from onediffx.lora.utils import (
+    fuse_lora,
+    _set_adapter,
+    _unfuse_lora,
+    _set_adapters_batched,
+    _unfuse_lora_batched,
+)
+
+# (in_features, out_features, count) of the SDXL UNet LoRA target layers
+SDXL_LINEAR_SHAPES = [
+    (640, 640, 40),  # to_q, to_out, attn1 to_k/to_v of 640 channel blocks
+    (2048, 640, 8),  # attn2 to_k/to_v of 640 channel blocks
+    (640, 5120, 4),  # ff.net.0.proj
+    (2560, 640, 4),  # ff.net.2
+    (640, 640, 8),  # proj_in, proj_out
+    (1280, 1280, 400),
+    (2048, 1280, 120),
+    (1280, 10240, 60),
+    (5120, 1280, 60),
+    (1280, 1280, 24),
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rank", type=int, default=8)
+    parser.add_argument("--num-loras", type=int, default=3)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--dtype", default="float16", choices=["float16", "float32"])
+    return parser.parse_args()
+
+
+class TimerContextManager:
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed_time = time.perf_counter() - self.start_time
+        print(f"Time cost {self.elapsed_time:.3f}, of method {self.msg}")
+
+
+def build_layers(rank, num_loras, dtype):
+    layers = []
+    for in_features, out_features, count in SDXL_LINEAR_SHAPES:
+        for _ in range(count):
+            layer = torch.nn.Linear(in_features, out_features, bias=False)
+            layer.to(dtype)
+            for i in range(num_loras):
+                lora = {
+                    "lora.down.weight": torch.randn(rank, in_features) * 0.01,
+                    "lora.up.weight": torch.randn(out_features, rank) * 0.01,
+                }
+                fuse_lora(
+                    layer, lora, 1.0, rank, rank, adapter_name=f"lora_{i}", fuse=False
+                )
+            layers.append(layer)
+    return layers
+
+
+def main():
+    args = parse_args()
+    dtype = getattr(torch, args.dtype)
+    layers = build_layers(args.rank, args.num_loras, dtype)
+    adapter_names = [f"lora_{i}" for i in range(args.num_loras)]
+    adapter_weights = [0.5] * args.num_loras
+    print(f"{len(layers)} layers, {args.num_loras} LoRAs of rank {args.rank}")
+
+    results = {"per-layer": [], "batched": []}
+    with torch.no_grad():
+        for _ in range(args.repeats):
+            with TimerContextManager("per-layer set_adapter + unfuse") as t:
+                for layer in layers:
+                    _set_adapter(layer, adapter_names, adapter_weights)
+                for layer in layers:
+                    _unfuse_lora(layer)
+            results["per-layer"].append(t.elapsed_time)
+
+            with TimerContextManager("batched set_adapters + unfuse") as t:
+                _set_adapters_batched(layers, adapter_names, adapter_weights)
+                _unfuse_lora_batched(layers)
+            results["batched"].append(t.elapsed_time)
+
+    df = pd.DataFrame(
+        {
+            "method": list(results.keys()),
+            "mean": [f"{sum(v) / len(v):.3f} s" for v in results.values()],
+            "min": [f"{min(v):.3f} s" for v in results.values()],
+        }
+    )
+    print(df)
+
+
+if __name__ == "__main__":
+    main()
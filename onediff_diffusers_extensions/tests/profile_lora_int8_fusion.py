@@ -0,0 +1,184 @@
+"""
+Profile LoRA fusion into int8 quantized layers on CPU: latency of per-layer
+versus batched fusion, and accuracy against a float32 reference.
+
+The layers stand in for the dynamic quant modules of onediff_quant: an int8
+weight quantized per output channel, with its `weight_scale` and `weight_acc`.
+They have the shapes of the SDXL UNet LoRA targets and the LoRAs are random.
+
+Usage:
+    python3 tests/profile_lora_int8_fusion.py --rank 8 --repeats 3
+
+The accuracy columns compare the dequantized fused weights, and the outputs
+of the layers, with the float32 base weights plus the LoRA deltas. "cycles"
+fuses and unfuses `--cycles` times before measuring the drift of the base
+weights, with and without `lora_base_snapshot`.
+"""
+import argparse
+import time
+
+import torch
+import pandas as pd
+
+from onediff.lora import dequantize_weight, requantize_weight_
+from onediffx.lora import lora_base_snapshot
+from onediffx.lora.utils import (
+    fuse_lora,
+    _set_adapter,
+    _unfuse_lora,
+    _set_adapters_batched,
+    _unfuse_lora_batched,
+)
+
+from profile_lora_fusion import SDXL_LINEAR_SHAPES, TimerContextManager
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rank", type=int, default=8)
+    parser.add_argument("--num-loras", type=int, default=3)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--cycles", type=int, default=10)
+    parser.add_argument("--scale", type=float, default=0.1)
+    return parser.parse_args()
+
+
+class QuantLinear(torch.nn.Module):
+    def __init__(self, in_features, out_features):
+        super().__init__()
+        weight = torch.randn(out_features, in_features) / in_features ** 0.5
+        self.weight_scale = torch.nn.Parameter(
+            torch.empty(out_features), requires_grad=False
+        )
+        self.weight_acc = torch.nn.Parameter(
+            torch.empty(out_features), requires_grad=False
+        )
+        self.weight = torch.nn.Parameter(
+            requantize_weight_(weight, self).to(torch.int8), requires_grad=False
+        )
+
+    def forward(self, x):
+        return torch.nn.functional.linear(x, dequantize_weight(self.weight, self))
+
+
+def build_layers(rank, num_loras, scale):
+    layers = []
+    for in_features, out_features, count in SDXL_LINEAR_SHAPES:
+        for _ in range(count):
+            layer = QuantLinear(in_features, out_features)
+            for i in range(num_loras):
+                lora = {
+                    "lora.down.weight": torch.randn(rank, in_features) * scale,
+                    "lora.up.weight": torch.randn(out_features, rank) * scale,
+                }
+                fuse_lora(
+                    layer, lora, 1.0, rank, rank, adapter_name=f"lora_{i}", fuse=False
+                )
+            layers.append(layer)
+    return layers
+
+
+def reference_weights(layers, adapter_names, adapter_weights):
+    references = []
+    for layer in layers:
+        weight = dequantize_weight(layer.weight, layer)
+        for name, scale in zip(adapter_names, adapter_weights):
+            weight += scale * layer.lora_B[name] @ layer.lora_A[name]
+        references.append(weight)
+    return references
+
+
+def relative_errors(layers, references):
+    weight_errors, output_errors = [], []
+    for layer, reference in zip(layers, references):
+        weight = dequantize_weight(layer.weight, layer)
+        weight_errors.append(
+            ((weight - reference).norm() / reference.norm()).item()
+        )
+        x = torch.randn(16, weight.shape[1])
+        output, expected = x @ weight.t(), x @ reference.t()
+        output_errors.append(
+            ((output - expected).norm() / expected.norm()).item()
+        )
+    return weight_errors, output_errors
+
+
+def base_drift(layers, bases):
+    return max(
+        (dequantize_weight(layer.weight, layer) - base).abs().max().item()
+        for layer, base in zip(layers, bases)
+    )
+
+
+def main():
+    args = parse_args()
+    layers = build_layers(args.rank, args.num_loras, args.scale)
+    adapter_names = [f"lora_{i}" for i in range(args.num_loras)]
+    adapter_weights = [0.5] * args.num_loras
+    print(f"{len(layers)} int8 layers, {args.num_loras} LoRAs of rank {args.rank}")
+
+    results = {"per-layer": [], "batched": []}
+    with torch.no_grad():
+        for _ in range(args.repeats):
+            with TimerContextManager("per-layer set_adapter + unfuse") as t:
+                for layer in layers:
+                    _set_adapter(layer, adapter_names, adapter_weights)
+                for layer in layers:
+                    _unfuse_lora(layer)
+            results["per-layer"].append(t.elapsed_time)
+
+            with TimerContextManager("batched set_adapters + unfuse") as t:
+                _set_adapters_batched(layers, adapter_names, adapter_weights)
+                _unfuse_lora_batched(layers)
+            results["batched"].append(t.elapsed_time)
+
+        df = pd.DataFrame(
+            {
+                "method": list(results.keys()),
+                "mean": [f"{sum(v) / len(v):.3f} s" for v in results.values()],
+                "min": [f"{min(v):.3f} s" for v in results.values()],
+            }
+        )
+        print(df)
+
+        # Accuracy of one fusion, from fresh layers
+        layers = build_layers(args.rank, args.num_loras, args.scale)
+        bases = [dequantize_weight(layer.weight, layer) for layer in layers]
+        references = reference_weights(layers, adapter_names, adapter_weights)
+        _set_adapters_batched(layers, adapter_names, adapter_weights)
+        weight_errors, output_errors = relative_errors(layers, references)
+        _unfuse_lora_batched(layers)
+        accuracy = {
+            "weight rel err": weight_errors,
+            "output rel err": output_errors,
+        }
+        print(
+            pd.DataFrame(
+                {
+                    "metric": list(accuracy.keys()),
+                    "max": [f"{max(v):.2e}" for v in accuracy.values()],
+                    "mean": [f"{sum(v) / len(v):.2e}" for v in accuracy.values()],
+                }
+            )
+        )
+
+        drifts = {}
+        for _ in range(args.cycles - 1):
+            _set_adapters_batched(layers, adapter_names, adapter_weights)
+            _unfuse_lora_batched(layers)
+        drifts["without snapshot"] = base_drift(layers, bases)
+
+        layers = build_layers(args.rank, args.num_loras, args.scale)
+        bases = [dequantize_weight(layer.weight, layer) for layer in layers]
+        lora_base_snapshot.enable()
+        for _ in range(args.cycles):
+            _set_adapters_batched(layers, adapter_names, adapter_weights)
+            _unfuse_lora_batched(layers)
+        drifts["with snapshot"] = base_drift(layers, bases)
+        lora_base_snapshot.disable()
+        for name, drift in drifts.items():
+            print(f"Base weight drift after {args.cycles} cycles {name}: {drift:.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import pytest
+import torch
+
+from onediffx.deep_cache.feature_cache import DeepCacheFeatureCache
+
+
+class FakeUNet:
+    """Returns (noise_pred, features) computed per sample, records its batch sizes."""
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def __call__(self, sample, timestep, encoder_hidden_states=None, return_dict=False):
+        self.batch_sizes.append(sample.shape[0])
+        conditioning = encoder_hidden_states.mean(dim=(1, 2))[:, None, None, None]
+        noise_pred = sample * 2 + conditioning
+        return noise_pred, sample + 1
+
+
+def make_inputs(batch_size=4, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    sample = torch.randn(batch_size, 4, 8, 8, generator=generator)
+    encoder_hidden_states = torch.randn(batch_size, 7, 16, generator=generator)
+    return sample, encoder_hidden_states
+
+
+def keys_of(cache, sample, encoder_hidden_states, timestep=torch.tensor(999)):
+    conditioning_keys = cache.conditioning_keys(
+        sample.shape[0], encoder_hidden_states, 0, 0
+    )
+    return cache.step_keys(sample, timestep, conditioning_keys)
+
+
+def row_bytes(sample):
+    return 2 * sample[0].numel() * sample.element_size()
+
+
+def test_keys_depend_on_each_sample():
+    cache = DeepCacheFeatureCache()
+    sample, encoder_hidden_states = make_inputs()
+    keys = keys_of(cache, sample, encoder_hidden_states)
+    assert len(set(keys)) == 4
+    assert keys == keys_of(cache, sample.clone(), encoder_hidden_states.clone())
+
+    other_sample = sample.clone()
+    other_sample[1] += 1
+    other_keys = keys_of(cache, other_sample, encoder_hidden_states)
+    assert [a == b for a, b in zip(keys, other_keys)] == [True, False, True, True]
+
+    other_conditioning = encoder_hidden_states.clone()
+    other_conditioning[2] += 1
+    other_keys = keys_of(cache, sample, other_conditioning)
+    assert [a == b for a, b in zip(keys, other_keys)] == [True, True, False, True]
+
+    assert set(keys).isdisjoint(
+        keys_of(cache, sample, encoder_hidden_states, torch.tensor(981))
+    )
+    assert set(keys).isdisjoint(
+        keys_of(cache, sample.half(), encoder_hidden_states)
+    )
+
+
+def test_get_counts_hits_and_misses_per_key():
+    cache = DeepCacheFeatureCache()
+    sample, encoder_hidden_states = make_inputs()
+    keys = keys_of(cache, sample, encoder_hidden_states)
+    cache.put(keys[:3], sample[:3] * 2, sample[:3] + 1)
+
+    assert cache.get(keys) is None
+    assert (cache.hits, cache.misses) == (3, 1)
+
+    noise_pred, features = cache.get(keys[:2])
+    assert torch.equal(noise_pred, sample[:2] * 2)
+    assert torch.equal(features, sample[:2] + 1)
+    assert (cache.hits, cache.misses) == (5, 1)
+    assert cache.hit_rate == pytest.approx(5 / 6)
+
+
+def test_lru_eviction_under_max_memory():
+    sample, encoder_hidden_states = make_inputs()
+    cache = DeepCacheFeatureCache(max_memory=2 * row_bytes(sample))
+    keys = keys_of(cache, sample, encoder_hidden_states)
+
+    cache.put(keys[:2], sample[:2], sample[:2])
+    assert len(cache) == 2
+    assert cache.memory == 2 * row_bytes(sample)
+
+    # keys[0] is used again, so keys[1] is the least recently used one
+    assert cache.get(keys[:1]) is not None
+    cache.put(keys[2:3], sample[2:3], sample[2:3])
+    assert len(cache) == 2
+    assert cache.get(keys[1:2]) is None
+    assert cache.get([keys[0], keys[2]]) is not None
+    assert cache.memory <= cache.max_memory
+
+    cache.clear()
+    assert len(cache) == 0 and cache.memory == 0
+
+
+def test_run_computes_repeated_samples_once():
+    cache = DeepCacheFeatureCache()
+    unet = FakeUNet()
+    sample, encoder_hidden_states = make_inputs()
+    # Samples 0 and 2 are the same request
+    sample[2] = sample[0]
+    encoder_hidden_states[2] = encoder_hidden_states[0]
+    keys = keys_of(cache, sample, encoder_hidden_states)
+    expected = FakeUNet()(sample, 999, encoder_hidden_states=encoder_hidden_states)
+
+    noise_pred, features = cache.run(
+        keys, unet, sample, 999, encoder_hidden_states=encoder_hidden_states
+    )
+    assert unet.batch_sizes == [3]
+    assert torch.allclose(noise_pred, expected[0])
+    assert torch.allclose(features, expected[1])
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+def test_run_skips_cached_samples():
+    cache = DeepCacheFeatureCache()
+    unet = FakeUNet()
+    sample, encoder_hidden_states = make_inputs()
+    keys = keys_of(cache, sample, encoder_hidden_states)
+    expected = FakeUNet()(sample, 999, encoder_hidden_states=encoder_hidden_states)
+
+    # All distinct and missing: the whole batch runs
+    cache.run(keys, unet, sample, 999, encoder_hidden_states=encoder_hidden_states)
+    assert unet.batch_sizes == [4]
+
+    # A later call with two of the samples and a new one
+    new_sample, new_conditioning = make_inputs(batch_size=1, seed=1)
+    batch = torch.cat([sample[1:3], new_sample])
+    conditioning = torch.cat([encoder_hidden_states[1:3], new_conditioning])
+    batch_keys = keys_of(cache, batch, conditioning)
+    noise_pred, _ = cache.run(
+        batch_keys, unet, batch, 999, encoder_hidden_states=conditioning
+    )
+    assert unet.batch_sizes == [4, 1]
+    assert torch.allclose(noise_pred[:2], expected[0][1:3])
+
+    # The same call again runs nothing
+    cache.run(batch_keys, unet, batch, 999, encoder_hidden_states=conditioning)
+    assert unet.batch_sizes == [4, 1]
+    assert (cache.hits, cache.misses) == (5, 5)
@@ -0,0 +1,199 @@
+import gc
+
+import pytest
+import torch
+
+from onediffx.lora import prompt_cache
+from onediffx.lora.prompt_cache import PromptEmbeddingCache
+
+EMBEDDING_SHAPE = (1, 77, 8)
+
+
+class StubLoRALayer(torch.nn.Module):
+    """The attributes of a text encoder layer with LoRAs read by the cache."""
+
+    def __init__(self, adapter_names):
+        super().__init__()
+        self.adapter_names = set(adapter_names)
+        self.active_adapter_names = {}
+
+
+class StubPipeline:
+    """Encodes a prompt to embeddings that depend on the LoRAs fused into its text encoder."""
+
+    def __init__(self, adapter_names=("a", "b")):
+        self.text_encoder = torch.nn.ModuleList(
+            [StubLoRALayer(adapter_names) for _ in range(2)]
+        )
+        self.encoded = []
+
+    def encode_prompt(self, prompt, device=None, negative_prompt=None):
+        fused = dict(self.text_encoder[0].active_adapter_names)
+        self.encoded.append((prompt, fused))
+        value = len(prompt) + sum(fused.values())
+        embeds = torch.full(EMBEDDING_SHAPE, float(value))
+        return embeds, -embeds
+
+
+@pytest.fixture
+def fusions(monkeypatch):
+    """Replace the batched LoRA fusion of the text encoders, record its calls."""
+    calls = []
+
+    def set_adapters(layers, adapter_names, adapter_weights):
+        calls.append(dict(zip(adapter_names, adapter_weights)))
+        for layer in layers:
+            layer.active_adapter_names = dict(zip(adapter_names, adapter_weights))
+
+    def unfuse(layers):
+        calls.append({})
+        for layer in layers:
+            layer.active_adapter_names = {}
+
+    monkeypatch.setattr(prompt_cache, "_set_adapters_batched", set_adapters)
+    monkeypatch.setattr(prompt_cache, "_unfuse_lora_batched", unfuse)
+    return calls
+
+
+def embedding_bytes():
+    return 2 * torch.zeros(EMBEDDING_SHAPE).numel() * 4
+
+
+def set_adapters(cache, pipe, adapters):
+    # What `set_and_fuse_adapters` does with deferred text encoder fusion
+    cache.set_text_encoder_adapters(pipe, adapters, fused=False)
+
+
+def test_hit_after_adapter_switch_and_back(fusions):
+    cache = PromptEmbeddingCache()
+    pipe = StubPipeline()
+    cache.enable(pipe, defer_text_encoder_fusion=True)
+
+    set_adapters(cache, pipe, {"a": 1.0})
+    embeds, _ = pipe.encode_prompt("a cat")
+    set_adapters(cache, pipe, {"b": 0.5})
+    pipe.encode_prompt("a cat")
+    assert pipe.encoded == [("a cat", {"a": 1.0}), ("a cat", {"b": 0.5})]
+
+    set_adapters(cache, pipe, {"a": 1.0})
+    cached, _ = pipe.encode_prompt("a cat")
+    assert cached is embeds
+    # The switch back to "a" didn't touch the text encoders, which hold "b"
+    assert len(pipe.encoded) == 2
+    assert fusions == [{"a": 1.0}, {"b": 0.5}]
+    assert pipe.text_encoder[0].active_adapter_names == {"b": 0.5}
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+
+def test_keys_include_the_arguments(fusions):
+    cache = PromptEmbeddingCache()
+    pipe = StubPipeline()
+    cache.enable(pipe)
+
+    pipe.encode_prompt("a cat")
+    pipe.encode_prompt("a cat", negative_prompt="blurry")
+    pipe.encode_prompt(prompt="a cat")
+    assert [prompt for prompt, _ in pipe.encoded] == ["a cat", "a cat"]
+
+    # Precomputed tensors are not cached
+    pipe.encode_prompt(torch.zeros(1))
+    pipe.encode_prompt(torch.zeros(1))
+    assert len(pipe.encoded) == 4
+    assert cache.stats()["entries"] == 2
+
+
+def test_reload_and_delete_invalidate(fusions):
+    cache = PromptEmbeddingCache()
+    pipe = StubPipeline()
+    cache.enable(pipe, defer_text_encoder_fusion=True)
+    set_adapters(cache, pipe, {"a": 1.0})
+    pipe.encode_prompt("a cat")
+    set_adapters(cache, pipe, {"b": 1.0})
+    pipe.encode_prompt("a dog")
+    assert cache.stats()["entries"] == 2
+
+    # `load_and_fuse_lora` of "a" again, maybe with other weights
+    cache.invalidate("a")
+    assert cache.stats()["entries"] == 1
+    set_adapters(cache, pipe, {"a": 1.0})
+    pipe.encode_prompt("a cat")
+    assert len(pipe.encoded) == 3
+
+    # `delete_adapters` of "b"
+    cache.delete_text_encoder_adapters(pipe, ["b"])
+    assert cache.stats()["entries"] == 1
+    assert cache.text_encoder_adapters(pipe) == {"a": 1.0}
+
+
+def test_byte_budget_evicts_least_recently_used(fusions):
+    cache = PromptEmbeddingCache(max_bytes=2 * embedding_bytes())
+    pipe = StubPipeline()
+    cache.enable(pipe)
+
+    pipe.encode_prompt("one")
+    pipe.encode_prompt("two")
+    pipe.encode_prompt("one")
+    pipe.encode_prompt("three")
+    stats = cache.stats()
+    assert stats["entries"] == 2 and stats["evictions"] == 1
+    assert stats["bytes"] == 2 * embedding_bytes()
+
+    # "two" was the least recently used one
+    pipe.encode_prompt("one")
+    pipe.encode_prompt("two")
+    assert [prompt for prompt, _ in pipe.encoded] == ["one", "two", "three", "two"]
+
+
+def test_entries_of_each_pipeline(fusions):
+    cache = PromptEmbeddingCache(max_bytes=2 * embedding_bytes())
+    first, second = StubPipeline(), StubPipeline()
+    cache.enable(first)
+    cache.enable(second)
+
+    first.encode_prompt("a cat")
+    second.encode_prompt("a cat")
+    assert len(first.encoded) == 1 and len(second.encoded) == 1
+    # The budget is shared, the least recently used entry of both goes first
+    first.encode_prompt("a cat")
+    second.encode_prompt("a dog")
+    first.encode_prompt("a cat")
+    second.encode_prompt("a cat")
+    assert len(first.encoded) == 1 and len(second.encoded) == 3
+
+    # The entries of a collected pipeline are dropped, and a new pipeline,
+    # maybe with the same id, doesn't hit them
+    del second
+    gc.collect()
+    assert cache.stats()["entries"] == 1
+    third = StubPipeline()
+    cache.enable(third)
+    third.encode_prompt("a cat")
+    assert len(third.encoded) == 1
+
+
+def test_deferred_fusion_on_miss(fusions):
+    cache = PromptEmbeddingCache()
+    pipe = StubPipeline()
+    cache.enable(pipe, defer_text_encoder_fusion=True)
+    assert cache.defers_text_encoder_fusion(pipe)
+
+    set_adapters(cache, pipe, {"a": 0.5, "c": 1.0})
+    # Only the pending LoRAs of the text encoder, "c" has no layer there
+    assert cache.text_encoder_adapters(pipe) == {"a": 0.5}
+    assert fusions == []
+
+    pipe.encode_prompt("a cat")
+    assert fusions == [{"a": 0.5}]
+    assert pipe.encoded[-1] == ("a cat", {"a": 0.5})
+
+    # `unfuse_lora` is deferred too
+    set_adapters(cache, pipe, {})
+    pipe.encode_prompt("a cat")
+    assert fusions == [{"a": 0.5}, {}]
+    assert pipe.encoded[-1] == ("a cat", {})
+
+    # Disabling fuses the pending LoRAs
+    set_adapters(cache, pipe, {"b": 1.0})
+    cache.disable(pipe)
+    assert fusions[-1] == {"b": 1.0}
+    assert cache.stats()["entries"] == 0
@@ -1,5 +1,6 @@
 import torch
 from onediff.infer_compiler.with_oneflow_compile import DeployableModule
+from onediff.lora import preserve_weight_storage
 
 
 class HijackLoraActivate:
@@ -36,8 +37,10 @@ def hijacked_activate(activate_func):
         activate_func(self, p, params_list)
         if isinstance(p.sd_model.model.diffusion_model, DeployableModule):
             onediff_sd_model: DeployableModule = p.sd_model.model.diffusion_model
-            for sub_module in onediff_sd_model.modules():
-                if not isinstance(
+            sub_modules = [
+                sub_module
+                for sub_module in onediff_sd_model.modules()
+                if isinstance(
                     sub_module,
                     (
                         torch.nn.Linear,
@@ -45,9 +48,13 @@ def hijacked_activate(activate_func):
                         torch.nn.GroupNorm,
                         torch.nn.LayerNorm,
                     ),
-                ):
-                    continue
-                networks.network_apply_weights(sub_module)
+                )
+            ]
+            # The compiled graph shares the storage of these weights, keep it
+            # even if the networks replace a weight tensor.
+            with preserve_weight_storage(sub_modules):
+                for sub_module in sub_modules:
+                    networks.network_apply_weights(sub_module)
 
     activate._onediff_hijacked = True
     return activate
@@ -1,6 +1,8 @@
 import os
 import sys
 import importlib
+from contextlib import contextmanager
+from functools import lru_cache
 from typing import Optional, Union
 from types import FunctionType, ModuleType
 from oneflow.mock_torch import DynamicMockModule
@@ -9,13 +11,35 @@ from importlib.metadata import requires
 from .format_utils import MockEntityNameFormatter
 from ..utils.log_utils import logger
 
-__all__ = ["import_module_from_path", "LazyMocker", "is_need_mock"]
+__all__ = ["import_module_from_path", "LazyMocker", "is_need_mock", "mock_cache"]
+
+_MOCK_CACHE = True
+
+
+@contextmanager
+def mock_cache(enabled=True):
+    """Enable or disable the caches of `is_need_mock` and `LazyMocker`, e.g. to
+    time the uncached conversion."""
+    global _MOCK_CACHE
+    prev_mode = _MOCK_CACHE
+    _MOCK_CACHE = enabled
+    try:
+        yield
+    finally:
+        _MOCK_CACHE = prev_mode
 
 
 def is_need_mock(cls) -> bool:
     assert isinstance(cls, (type, str))
     main_pkg = cls.__module__.split(".")[0]
+    if not _MOCK_CACHE:
+        return _is_package_need_mock.__wrapped__(main_pkg)
+    return _is_package_need_mock(main_pkg)
 
+
+@lru_cache(maxsize=None)
+def _is_package_need_mock(main_pkg: str) -> bool:
+    # Reading the package metadata hits the disk, so the result is cached per package.
     try:
         if main_pkg == "torch":
             return True
@@ -62,6 +86,10 @@ class LazyMocker:
         self.tmp_dir = tmp_dir
         self.mocked_packages = set()
         self.cleanup_list = []
+        self.formatter = MockEntityNameFormatter(prefix=prefix, suffix=suffix)
+        self._entity_name_cache = {}
+        self._mock_package_cache = {}
+        self._mock_entity_cache = {}
 
     def mock_package(self, package: str):
         pass
@@ -70,10 +98,19 @@ class LazyMocker:
         pass
 
     def get_mock_entity_name(self, entity: Union[str, type, FunctionType]):
-        formatter = MockEntityNameFormatter(prefix=self.prefix, suffix=self.suffix)
-        full_obj_name = formatter.format(entity)
+        if not _MOCK_CACHE:
+            return self.formatter.format(entity)
+        full_obj_name = self._entity_name_cache.get(entity)
+        if full_obj_name is None:
+            full_obj_name = self.formatter.format(entity)
+            self._entity_name_cache[entity] = full_obj_name
         return full_obj_name
 
+    def clear_cache(self):
+        self._entity_name_cache.clear()
+        self._mock_package_cache.clear()
+        self._mock_entity_cache.clear()
+
     def mock_entity(self, entity: Union[str, type, FunctionType]):
         """Mock the entity and return the mocked entity
 
@@ -102,14 +139,27 @@ class LazyMocker:
                 sys.path.append(str(pkg_path))
 
     def load_entity_with_mock(self, entity: Union[str, type, FunctionType]):
-        formatter = MockEntityNameFormatter(prefix=self.prefix, suffix=self.suffix)
-        full_obj_name = formatter.format(entity)
+        full_obj_name = self.get_mock_entity_name(entity)
+        if not _MOCK_CACHE:
+            return self._load_entity(full_obj_name)
+        if full_obj_name in self._mock_entity_cache:
+            return self._mock_entity_cache[full_obj_name]
+        mock_entity = self._load_entity(full_obj_name)
+        self._mock_entity_cache[full_obj_name] = mock_entity
+        return mock_entity
+
+    def _load_entity(self, full_obj_name: str):
+
         attrs = full_obj_name.split(".")
 
         # add package path to sys.path to avoid mock error
         self.add_mocked_package(attrs[0])
 
-        mock_pkg = DynamicMockModule.from_package(attrs[0], verbose=False)
+        mock_pkg = self._mock_package_cache.get(attrs[0]) if _MOCK_CACHE else None
+        if mock_pkg is None:
+            mock_pkg = DynamicMockModule.from_package(attrs[0], verbose=False)
+            if _MOCK_CACHE:
+                self._mock_package_cache[attrs[0]] = mock_pkg
         for name in attrs[1:]:
             mock_pkg = getattr(mock_pkg, name)
         return mock_pkg
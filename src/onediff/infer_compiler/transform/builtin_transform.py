@@ -4,6 +4,8 @@ import os
 import importlib
 import types
 import inspect
+import weakref
+from contextlib import contextmanager
 from functools import singledispatch, partial
 from collections import OrderedDict
 from collections.abc import Iterable
@@ -14,7 +16,8 @@ import oneflow as flow
 from .manager import transform_mgr
 from ..utils.log_utils import logger
 from ..utils.patch_for_diffusers import diffusers_checker
-from ..import_tools.importer import is_need_mock
+from ..utils.tensor_registry import tensor_registry
+from ..import_tools.importer import is_need_mock, mock_cache, _is_package_need_mock
 from functools import singledispatch
 
 __all__ = [
@@ -160,19 +163,96 @@ def _(mod: type):
     return proxy_class(mod)
 
 
+# The oneflow classes created by `default_converter` and `torch2oflow(nn.Module)`,
+# keyed by the proxy class they derive from, so `type(...)` runs once per class
+# instead of once per converted instance.
+_converted_cls_cache = {}
+_converted_module_cls_cache = {}
+# The `ProxySubmodule` of each converted module, for attributes it doesn't copy.
+_module_proxies = weakref.WeakKeyDictionary()
+# The torch children of each module converted lazily, not converted yet.
+_pending_children = weakref.WeakKeyDictionary()
+# The owner in `tensor_registry` of the pending children of each module.
+_pending_owners = weakref.WeakKeyDictionary()
+_LAZY_CONVERSION = False
+_CONVERSION_CACHE = True
+
+
+@contextmanager
+def conversion_cache(enabled=True):
+    """Enable or disable the caches of the conversion: the converted classes
+    above, and the mocked entities of `transform_mgr.mocker`. Disabled, each
+    converted instance builds its class and mocked entities again, as before
+    they were cached, e.g. to time the conversion without them."""
+    global _CONVERSION_CACHE
+    prev_mode = _CONVERSION_CACHE
+    _CONVERSION_CACHE = enabled
+    try:
+        with mock_cache(enabled):
+            yield
+    finally:
+        _CONVERSION_CACHE = prev_mode
+
+
+@contextmanager
+def lazy_module_conversion(enabled=True):
+    """Convert the children of a torch module only when they are first accessed.
+
+    Within this context `torch2oflow(nn.Module)` leaves the child modules out of
+    `_modules` and converts them (lazily too) on attribute access, so subtrees
+    that forward never touches are never converted.
+
+    Until then, the pending children are missing from the iterators of the
+    oneflow module: `children()`, `modules()`, `parameters()`, `state_dict()`,
+    `to()`, ... (`nn.Graph` builds its blocks from `named_children()`, so they
+    are not converted there). Call `convert_pending_children` before using
+    them on the whole tree, e.g. for diffusers' `attn_processors`.
+    """
+    global _LAZY_CONVERSION
+    prev_mode = _LAZY_CONVERSION
+    _LAZY_CONVERSION = enabled
+    try:
+        yield
+    finally:
+        _LAZY_CONVERSION = prev_mode
+
+
+def convert_pending_children(module):
+    """Convert the children of a oneflow module (and of its descendants) left
+    pending by `lazy_module_conversion`."""
+    pending = _pending_children.pop(module, None)
+    owner = _pending_owners.pop(module, None)
+    if pending:
+        with lazy_module_conversion(), tensor_registry.owned_by(owner):
+            for name, child in pending.items():
+                module._modules[name] = torch2oflow(child)
+    for child in list(module._modules.values()):
+        if child is not None:
+            convert_pending_children(child)
+
+
+def _get_converted_cls(new_obj_cls):
+    of_obj_cls = _converted_cls_cache.get(new_obj_cls) if _CONVERSION_CACHE else None
+    if of_obj_cls is not None:
+        return of_obj_cls
+
+    def init(self, obj):
+        for k, _ in obj.__dict__.items():
+            attr = getattr(obj, k)
+            self.__dict__[k] = torch2oflow(attr)
+
+    of_obj_cls = type(str(new_obj_cls), (new_obj_cls,), {"__init__": init})
+    if _CONVERSION_CACHE:
+        _converted_cls_cache[new_obj_cls] = of_obj_cls
+    return of_obj_cls
+
+
 def default_converter(obj, verbose=False, *, proxy_cls=None):
     if not is_need_mock(type(obj)):
         return obj
     try:
         new_obj_cls = proxy_class(type(obj)) if proxy_cls is None else proxy_cls
-
-        def init(self):
-            for k, _ in obj.__dict__.items():
-                attr = getattr(obj, k)
-                self.__dict__[k] = torch2oflow(attr)
-
-        of_obj_cls = type(str(new_obj_cls), (new_obj_cls,), {"__init__": init})
-        of_obj = of_obj_cls()
+        of_obj = _get_converted_cls(new_obj_cls)(obj)
 
         if verbose:
             logger.info(f"convert {type(obj)} to {type(of_obj)}")
@@ -182,25 +262,47 @@ def default_converter(obj, verbose=False, *, proxy_cls=None):
         return obj
 
 
-@torch2oflow.register
-def _(mod: torch.nn.Module, verbose=False):
-    proxy_md = ProxySubmodule(mod)
-    new_md_cls = proxy_class(type(mod))
+def clear_conversion_cache():
+    """Drop the cached converted classes, mocked entities and entity names."""
+    _converted_cls_cache.clear()
+    _converted_module_cls_cache.clear()
+    _is_package_need_mock.cache_clear()
+    transform_mgr.mocker.clear_cache()
+
 
-    def init(self):
-        nonlocal proxy_md
+def _convert_tensors(tensors, convert):
+    return OrderedDict((n, convert(t)) for n, t in tensors.items() if t is not None)
 
+
+def _get_converted_module_cls(new_md_cls):
+    of_mod_cls = (
+        _converted_module_cls_cache.get(new_md_cls) if _CONVERSION_CACHE else None
+    )
+    if of_mod_cls is not None:
+        return of_mod_cls
+
+    def init(self, proxy_md):
+        _module_proxies[self] = proxy_md
         flow.nn.Module.__init__(self)
 
-        self._parameters = OrderedDict()
-        self._buffers = OrderedDict()
+        torch_mod = proxy_md._oflow_proxy_submod
+        # Parameters and buffers are converted in one pass over the dicts,
+        # skipping the dispatch and proxy lookups of `torch2oflow`.
+        self._parameters = _convert_tensors(torch_mod._parameters, _convert_parameter)
+        self._buffers = _convert_tensors(
+            torch_mod._buffers,
+            lambda b: flow.utils.tensor.from_torch(tensor_registry.dedup(b).data),
+        )
         self._modules = OrderedDict()
-        for n, p in list(proxy_md.named_parameters("", False)):
-            self._parameters[n] = torch2oflow(p)
-        for n, b in list(proxy_md.named_buffers("", False)):
-            self._buffers[n] = flow.utils.tensor.from_torch(b.data)
+        pending = OrderedDict()
         for n, m in proxy_md._modules.items():
-            self._modules[n] = torch2oflow(m)
+            if _LAZY_CONVERSION and m is not None:
+                pending[n] = m
+            else:
+                self._modules[n] = torch2oflow(m)
+        if pending:
+            _pending_children[self] = pending
+            _pending_owners[self] = tensor_registry.owner
 
         for k, _ in proxy_md.__dict__.items():
             if k not in self.__dict__:
@@ -212,24 +314,41 @@ def _(mod: torch.nn.Module, verbose=False):
                     raise NotImplementedError(f"Unsupported type: {type(attr)}")
 
     def proxy_getattr(self, attr):
-        nonlocal proxy_md
-
-        try:
-            return super().__getattribute__(attr)
-        except Exception as e:
-            if attr in self._modules:
-                return self._modules[attr]
-            if attr in self._parameters:
-                return self._parameters[attr]
-            elif attr in self._buffers:
-                return self._buffers[attr]
-            else:
-                return getattr(proxy_md, attr)
+        if attr in self._modules:
+            return self._modules[attr]
+        if attr in self._parameters:
+            return self._parameters[attr]
+        if attr in self._buffers:
+            return self._buffers[attr]
+        pending = _pending_children.get(self)
+        if pending is not None and attr in pending:
+            with lazy_module_conversion(), tensor_registry.owned_by(
+                _pending_owners.get(self)
+            ):
+                self._modules[attr] = torch2oflow(pending.pop(attr))
+            return self._modules[attr]
+        proxy_md = _module_proxies.get(self)
+        if proxy_md is None:
+            raise AttributeError(f"{type(self).__name__} has no attribute {attr}")
+        return getattr(proxy_md, attr)
 
     of_mod_cls = type(
         str(new_md_cls), (new_md_cls,), {"__init__": init, "__getattr__": proxy_getattr}
     )
-    of_mod = of_mod_cls()
+    if _CONVERSION_CACHE:
+        _converted_module_cls_cache[new_md_cls] = of_mod_cls
+    return of_mod_cls
+
+
+def _convert_parameter(param):
+    return torch2oflow.dispatch(type(param))(param)
+
+
+@torch2oflow.register
+def _(mod: torch.nn.Module, verbose=False):
+    proxy_md = ProxySubmodule(mod)
+    new_md_cls = proxy_class(type(mod))
+    of_mod = _get_converted_module_cls(new_md_cls)(proxy_md)
 
     if of_mod.training:
         of_mod.training = False
@@ -363,7 +482,7 @@ def _(mod: torch.nn.Sequential, verbose=False):
 
 @torch2oflow.register
 def _(mod: torch.nn.parameter.Parameter, verbose=False) -> flow.nn.Parameter:
-    data = flow.utils.tensor.from_torch(mod.data)
+    data = flow.utils.tensor.from_torch(tensor_registry.dedup(mod).data)
     if mod.data.dtype == torch.int8:
         mod.requires_grad_(False)
         return flow.nn.Parameter(data.to(flow.int8), requires_grad=False)
@@ -372,7 +491,7 @@ def _(mod: torch.nn.parameter.Parameter, verbose=False) -> flow.nn.Parameter:
 
 @torch2oflow.register
 def _(mod: torch.Tensor, verbose=False) -> flow.Tensor:
-    return flow.utils.tensor.from_torch(mod)
+    return flow.utils.tensor.from_torch(tensor_registry.dedup(mod))
 
 
 _dtype_map = {
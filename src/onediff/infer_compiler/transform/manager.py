@@ -55,7 +55,7 @@ class TransformManager:
         self.logger.debug(debug_message)
 
     def _transform_entity(self, entity):
-        # TODO: Optimize _transform_entity for faster SDXL conversion (1.47s)
+        # The mocker caches the formatted names and mocked entities.
         result = self.mocker.mock_entity(entity)
         if result is None:
             RuntimeError(f"Failed to transform entity: {entity}")
@@ -98,7 +98,6 @@ class TransformManager:
             return getattr(mod, cls.__qualname__)
 
     def transform_func(self, func: types.FunctionType):
-        # TODO: support transform function cache
         return self._transform_entity(func)
 
     def transform_package(self, package_name):
@@ -6,6 +6,12 @@ from .env_var import (
     set_integer_env_var,
 )
 from .model_inplace_assign import TensorInplaceAssign
+from .graph_cache_store import GraphCacheStore
+from .shape_bucket import ShapeBucketer
+from .metrics import metrics_registry
+from .shared_storage import verify_shared_storage, alias_shared_storage
+from .tensor_registry import tensor_registry
+from .async_compile import AsyncGraphCompiler
 from .version_util import (
     get_support_message,
     is_quantization_enabled,
@@ -1,39 +1,100 @@
+from collections import OrderedDict
+from functools import wraps
 import torch
 import oneflow as flow
 from oneflow.framework.args_tree import ArgsTree
 from .log_utils import logger
+from .metrics import (
+    metrics_registry,
+    GRAPH_BUILD_SECONDS,
+    GRAPH_CACHE_HITS,
+    GRAPH_CACHE_MISSES,
+    RECOMPILES,
+)
 
 
-def input_output_processor(func):
-    def process_input(*args, **kwargs):
-        def input_fn(value):
-            if isinstance(value, torch.Tensor):
-                # TODO: https://github.com/siliconflow/sd-team/issues/109
-                return flow.utils.tensor.from_torch(value.contiguous())
-            else:
-                return value
-
-        args_tree = ArgsTree((args, kwargs), False, tensor_type=torch.Tensor)
-        input_count = len(
-            [v for v in args_tree.iter_nodes() if isinstance(v, torch.Tensor)]
+def _input_signature(args, kwargs):
+    args_tree = ArgsTree((args, kwargs), False)
+    return tuple(
+        (tuple(v.shape), str(v.dtype))
+        for v in args_tree.iter_nodes()
+        if isinstance(v, flow.Tensor)
+    )
+
+
+def _call_with_graph_metrics(self, func, args, kwargs):
+    """Count dynamic graph cache hits/misses and time the calls that compile.
+
+    The graph cache is mirrored by an LRU of the input signatures seen by the
+    current graph, so this only runs while metrics are enabled. The mirror has
+    the size of the graph cache, including the size `precompile` sets, and
+    sees the same calls in the same order, so it evicts the same inputs.
+    """
+    module_name = type(self._deployable_module_model._torch_module).__name__
+    signature = _input_signature(args, kwargs)
+    graph = self._deployable_module_dpl_graph
+    seen = getattr(graph, "_onediff_seen_inputs", None)
+    if seen is not None and signature in seen:
+        GRAPH_CACHE_HITS.inc(module=module_name)
+        seen.move_to_end(signature)
+        return func(self, *args, **kwargs)
+
+    GRAPH_CACHE_MISSES.inc(module=module_name)
+    with metrics_registry.measure(GRAPH_BUILD_SECONDS, module=module_name):
+        output = func(self, *args, **kwargs)
+
+    graph = self._deployable_module_dpl_graph
+    if graph is not None:
+        if getattr(graph, "_onediff_seen_inputs", None) is None:
+            graph._onediff_seen_inputs = OrderedDict()
+        seen = graph._onediff_seen_inputs
+        seen[signature] = True
+        size = getattr(
+            graph,
+            "_onediff_cache_size",
+            self._deployable_module_options.get("size", 9),
         )
-        out = args_tree.map_leaf(input_fn)
-        mapped_args = out[0]
-        mapped_kwargs = out[1]
-        return mapped_args, mapped_kwargs, input_count
-
-    def process_output(output):
-        def output_fn(value):
-            if isinstance(value, flow.Tensor):
-                return flow.utils.tensor.to_torch(value)
-            else:
-                return value
-
-        out_tree = ArgsTree((output, None), False)
-        out = out_tree.map_leaf(output_fn)
-        return out[0]
+        while len(seen) > size:
+            seen.popitem(last=False)
+    return output
+
+
+def process_input(*args, **kwargs):
+    def input_fn(value):
+        if isinstance(value, torch.Tensor):
+            # TODO: https://github.com/siliconflow/sd-team/issues/109
+            return flow.utils.tensor.from_torch(value.contiguous())
+        else:
+            return value
 
+    args_tree = ArgsTree((args, kwargs), False, tensor_type=torch.Tensor)
+    input_count = len(
+        [v for v in args_tree.iter_nodes() if isinstance(v, torch.Tensor)]
+    )
+    out = args_tree.map_leaf(input_fn)
+    mapped_args = out[0]
+    mapped_kwargs = out[1]
+    return mapped_args, mapped_kwargs, input_count
+
+
+def process_output(output):
+    def output_fn(value):
+        if isinstance(value, flow.Tensor):
+            return flow.utils.tensor.to_torch(value)
+        else:
+            return value
+
+    out_tree = ArgsTree((output, None), False)
+    out = out_tree.map_leaf(output_fn)
+    return out[0]
+
+
+def input_output_processor(func):
+    @wraps(func)
     def wrapper(self: "DeployableModule", *args, **kwargs):
+        shape_buckets = self._deployable_module_options.get("shape_buckets", None)
+        if shape_buckets is not None:
+            args, kwargs, restore_output = shape_buckets.pad_inputs(args, kwargs)
         mapped_args, mapped_kwargs, input_count = process_input(*args, **kwargs)
         if (
             self._deployable_module_use_graph
@@ -46,8 +107,18 @@ def input_output_processor(func):
                 )
                 self._deployable_module_dpl_graph = None
                 self._load_graph_first_run = True
+                RECOMPILES.inc(
+                    reason="input_count",
+                    module=type(self._deployable_module_model._torch_module).__name__,
+                )
 
-        output = func(self, *mapped_args, **mapped_kwargs)
-        return process_output(output)
+        if metrics_registry.enabled and self._deployable_module_use_graph:
+            output = _call_with_graph_metrics(self, func, mapped_args, mapped_kwargs)
+        else:
+            output = func(self, *mapped_args, **mapped_kwargs)
+        output = process_output(output)
+        if shape_buckets is not None:
+            output = restore_output(output)
+        return output
 
     return wrapper
@@ -0,0 +1,156 @@
+"""Compile graphs in a background thread while calls run in eager mode.
+
+Usage:
+    >>> unet = oneflow_compile(unet, options={"async_compile": True})
+    >>> unet(*inputs)  # returns the eager result, the graph compiles in the background
+    >>> handle = unet.async_compile_handle()
+    >>> handle.wait()  # optional, e.g. in a readiness probe
+    >>> unet(*inputs)  # now runs the compiled graph
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Optional
+import torch
+from oneflow.framework.args_tree import ArgsTree
+from .log_utils import logger
+
+__all__ = ["AsyncGraphCompiler", "in_async_compile"]
+
+_local = threading.local()
+
+
+def in_async_compile() -> bool:
+    """Whether the current thread is compiling a graph for `AsyncGraphCompiler`.
+
+    The recompile-on-exception handler of `DeployableModule` re-raises then,
+    so a failed compile is recorded instead of retried against the oneflow
+    module that the eager fallback may be running.
+    """
+    return getattr(_local, "compiling", False)
+
+
+def _input_signature(args, kwargs):
+    args_tree = ArgsTree((args, kwargs), False, tensor_type=torch.Tensor)
+    return tuple(
+        (tuple(v.shape), v.dtype, v.device)
+        for v in args_tree.iter_nodes()
+        if isinstance(v, torch.Tensor)
+    )
+
+
+def _clone_inputs(args, kwargs):
+    def clone_fn(value):
+        return value.clone() if isinstance(value, torch.Tensor) else value
+
+    args_tree = ArgsTree((args, kwargs), False, tensor_type=torch.Tensor)
+    out = args_tree.map_leaf(clone_fn)
+    return out[0], out[1]
+
+
+class AsyncGraphCompiler:
+    """Route the calls of a `DeployableModule` between its graph and eager mode.
+
+    A call whose input signature (tensor shapes, dtypes and devices) has a
+    compiled graph runs the graph. Any other call runs `eager_fn` and, the
+    first time the signature is seen, queues a compile of the graph for it.
+
+    Graph calls are serialized by a lock. While a compile holds it, calls
+    run in eager mode, even those whose graph is ready, so the request path
+    never waits for a compile. The oneflow eager fallback runs the module the
+    graph is built from, so it takes the lock too, and waits for a compile.
+    """
+
+    def __init__(self, module):
+        self._module = module
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="onediff_async_compile"
+        )
+        self._graph = None
+        self._ready = set()
+        self._failed = set()
+        self._futures = {}
+
+    def __call__(self, compiled_fn, eager_fn, args, kwargs):
+        if self._module._deployable_module_dpl_graph is not self._graph:
+            # The graph was dropped (e.g. a recompile), its shapes are cold again.
+            self._ready.clear()
+
+        signature = _input_signature(args, kwargs)
+        if signature in self._ready and self._lock.acquire(blocking=False):
+            try:
+                return compiled_fn(*args, **kwargs)
+            finally:
+                self._lock.release()
+
+        if (
+            signature not in self._ready
+            and signature not in self._failed
+            and not self._is_pending(signature)
+        ):
+            compile_args, compile_kwargs = _clone_inputs(args, kwargs)
+            self._futures[signature] = self._executor.submit(
+                self._compile, signature, compiled_fn, compile_args, compile_kwargs
+            )
+        return eager_fn(*args, **kwargs)
+
+    def _is_pending(self, signature):
+        future = self._futures.get(signature)
+        return future is not None and not future.done()
+
+    @property
+    def lock(self):
+        """Held by the graph calls and compiles."""
+        return self._lock
+
+    def _run_compile(self, signature, compiled_fn, args, kwargs):
+        _local.compiling = True
+        try:
+            output = compiled_fn(*args, **kwargs)
+        except Exception as e:
+            logger.error(f"Graph compilation failed for {signature}: {e=}")
+            self._failed.add(signature)
+            raise
+        finally:
+            _local.compiling = False
+        self._graph = self._module._deployable_module_dpl_graph
+        self._ready.add(signature)
+        self._failed.discard(signature)
+        return output
+
+    def _compile(self, signature, compiled_fn, args, kwargs):
+        with self._lock:
+            self._run_compile(signature, compiled_fn, args, kwargs)
+        logger.info(f"Async graph compilation done for {signature}")
+
+    def compile(self, compiled_fn, args, kwargs):
+        """Compile the graph of the signature of `args` and `kwargs` in the
+        calling thread, e.g. for `DeployableModule.precompile`, and return
+        the graph output. Errors are raised."""
+        signature = _input_signature(args, kwargs)
+        future = self._futures.get(signature)
+        if future is not None:
+            wait([future])
+        with self._lock:
+            return self._run_compile(signature, compiled_fn, args, kwargs)
+
+    def done(self) -> bool:
+        """Whether no compile is queued or running."""
+        return all(future.done() for future in self._futures.values())
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until the queued compiles finish, returns `done()`."""
+        wait(list(self._futures.values()), timeout=timeout)
+        return self.done()
+
+    @property
+    def futures(self):
+        """The `Future` of the compile of each input signature."""
+        return dict(self._futures)
+
+    def status(self):
+        return {
+            "ready": len(self._ready),
+            "pending": sum(1 for s in self._futures if self._is_pending(s)),
+            "failed": len(self._failed),
+        }
@@ -0,0 +1,338 @@
+"""A persistent, multi-entry store for compiled graph files.
+
+Usage:
+    >>> store = GraphCacheStore("/data/onediff_graphs", max_bytes=20 * 1024 ** 3)
+    >>> unet = oneflow_compile(unet, options={"graph_cache_store": store})
+
+CLI:
+    python -m onediff.infer_compiler.utils.graph_cache_store list /data/onediff_graphs
+    python -m onediff.infer_compiler.utils.graph_cache_store prune /data/onediff_graphs --max-bytes 10G
+    python -m onediff.infer_compiler.utils.graph_cache_store verify /data/onediff_graphs
+"""
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+from .log_utils import logger
+
+__all__ = ["GraphCacheStore", "path_size"]
+
+_INDEX_FILE = "index.json"
+_LOCK_FILE = "index.lock"
+_INDEX_VERSION = 1
+_TMP_PREFIX = ".tmp_"
+_TMP_EXPIRE_SECONDS = 24 * 3600
+
+
+def path_size(path: str) -> int:
+    """The size in bytes of a graph file, or of all the files of a graph directory."""
+    if os.path.isdir(path):
+        return sum(
+            os.path.getsize(os.path.join(root, f))
+            for root, _, files in os.walk(path)
+            for f in files
+        )
+    return os.path.getsize(path)
+
+
+def _path_checksum(path: str) -> str:
+    hasher = hashlib.sha256()
+    if os.path.isdir(path):
+        files = sorted(
+            os.path.join(root, f) for root, _, names in os.walk(path) for f in names
+        )
+    else:
+        files = [path]
+    for file in files:
+        hasher.update(os.path.relpath(file, path).encode("utf-8"))
+        with open(file, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _remove_path(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _oneflow_version() -> Optional[str]:
+    try:
+        import oneflow as flow
+
+        return flow.__version__
+    except ImportError:
+        return None
+
+
+class GraphCacheStore:
+    """A directory of graph files indexed by cache key.
+
+    The store keeps a manifest (`index.json`) with per-entry metadata: file
+    size, creation time, last hit time, hit count and the compile seconds the
+    hits have saved. Entries are written atomically (temp file + rename) and
+    the least recently hit entries are evicted once `max_bytes` is exceeded.
+
+    All index updates happen under an exclusive `flock` on `index.lock`, so
+    several worker processes on one node can share a store.
+
+    Args:
+        cache_dir (str): Directory holding the graph files and the index.
+        max_bytes (int, optional): Byte budget of the store, None means unbounded.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: Optional[int] = None):
+        self.cache_dir = os.path.abspath(str(cache_dir))
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.cache_dir, _INDEX_FILE)
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.graph")
+
+    @contextmanager
+    def _locked(self):
+        with open(os.path.join(self.cache_dir, _LOCK_FILE), "a") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _read_index(self) -> Dict[str, dict]:
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (ValueError, OSError) as e:
+            logger.warning(f"Graph cache index {self.index_path} is unreadable: {e}")
+            return {}
+        if index.get("version") != _INDEX_VERSION:
+            return {}
+        return index.get("entries", {})
+
+    def _write_index(self, entries: Dict[str, dict]):
+        fd, tmp_path = tempfile.mkstemp(prefix=_TMP_PREFIX, dir=self.cache_dir)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"version": _INDEX_VERSION, "entries": entries}, f, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    def _evict(
+        self, entries: Dict[str, dict], max_bytes: Optional[int], keep: str = None
+    ) -> List[str]:
+        if max_bytes is None:
+            return []
+        evicted = []
+        total = sum(entry["size"] for entry in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]["last_hit"]):
+            if total <= max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= entries[key]["size"]
+            _remove_path(self.entry_path(key))
+            del entries[key]
+            evicted.append(key)
+        if evicted:
+            logger.info(f"Evicted {len(evicted)} graph(s) from {self.cache_dir}")
+        return evicted
+
+    def lookup(self, key: str) -> Optional[str]:
+        """Return the graph file path of `key` and record the hit, or None on a miss."""
+        with self._locked():
+            entries = self._read_index()
+            entry = entries.get(key)
+            if entry is None:
+                return None
+            path = self.entry_path(key)
+            if not os.path.exists(path):
+                del entries[key]
+                self._write_index(entries)
+                return None
+            entry["last_hit"] = time.time()
+            entry["hits"] = entry.get("hits", 0) + 1
+            entry["compile_seconds_saved"] = (
+                entry.get("compile_seconds_saved", 0.0) + entry["compile_seconds"]
+            )
+            self._write_index(entries)
+        return path
+
+    def put(
+        self, key: str, save_fn: Callable[[str], None], compile_seconds: float = 0.0
+    ) -> Optional[str]:
+        """Save a graph under `key` and return its path.
+
+        `save_fn(path)` writes the graph to a temporary path in the store,
+        which is renamed into place once complete, so readers never see a
+        partially written file. A graph larger than `max_bytes` is not
+        stored, and None is returned.
+        """
+        tmp_dir = tempfile.mkdtemp(prefix=_TMP_PREFIX, dir=self.cache_dir)
+        tmp_path = os.path.join(tmp_dir, "graph")
+        try:
+            save_fn(tmp_path)
+            size = path_size(tmp_path)
+            if self.max_bytes is not None and size > self.max_bytes:
+                logger.warning(
+                    f"Graph {key} of {size} bytes exceeds the budget of {self.cache_dir}, not storing it"
+                )
+                return None
+            checksum = _path_checksum(tmp_path)
+            path = self.entry_path(key)
+            with self._locked():
+                entries = self._read_index()
+                if key in entries and os.path.exists(path):
+                    # Another process stored the same graph first.
+                    return path
+                _remove_path(path)
+                os.replace(tmp_path, path)
+                now = time.time()
+                entries[key] = {
+                    "size": size,
+                    "sha256": checksum,
+                    "created": now,
+                    "last_hit": now,
+                    "hits": 0,
+                    "compile_seconds": compile_seconds,
+                    "compile_seconds_saved": 0.0,
+                    "oneflow_version": _oneflow_version(),
+                }
+                self._evict(entries, self.max_bytes, keep=key)
+                self._write_index(entries)
+            return path
+        finally:
+            _remove_path(tmp_dir)
+
+    def entries(self) -> Dict[str, dict]:
+        with self._locked():
+            return self._read_index()
+
+    def total_bytes(self) -> int:
+        return sum(entry["size"] for entry in self.entries().values())
+
+    def prune(
+        self, max_bytes: Optional[int] = None, stale_versions: bool = False
+    ) -> List[str]:
+        """Remove entries to fit `max_bytes` (defaults to the store budget).
+
+        With `stale_versions`, entries compiled by another oneflow version
+        are removed first. Temporary files left by crashed saves are cleaned up.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        removed = []
+        with self._locked():
+            entries = self._read_index()
+            if stale_versions:
+                current_version = _oneflow_version()
+                for key in list(entries):
+                    if entries[key].get("oneflow_version") != current_version:
+                        _remove_path(self.entry_path(key))
+                        del entries[key]
+                        removed.append(key)
+            removed += self._evict(entries, max_bytes)
+            self._write_index(entries)
+            # Temp files younger than this may belong to a save in progress.
+            expired = time.time() - _TMP_EXPIRE_SECONDS
+            for name in os.listdir(self.cache_dir):
+                tmp_path = os.path.join(self.cache_dir, name)
+                if name.startswith(_TMP_PREFIX) and os.path.getmtime(tmp_path) < expired:
+                    _remove_path(tmp_path)
+        return removed
+
+    def verify(self, remove_broken: bool = False) -> Dict[str, str]:
+        """Check every entry against its recorded size and checksum.
+
+        Returns a dict of broken keys to the reason, and drops them from the
+        store if `remove_broken` is set.
+        """
+        broken = {}
+        with self._locked():
+            entries = self._read_index()
+            for key, entry in entries.items():
+                path = self.entry_path(key)
+                if not os.path.exists(path):
+                    broken[key] = "missing"
+                elif path_size(path) != entry["size"]:
+                    broken[key] = "size mismatch"
+                elif _path_checksum(path) != entry.get("sha256"):
+                    broken[key] = "checksum mismatch"
+            if remove_broken and broken:
+                for key in broken:
+                    _remove_path(self.entry_path(key))
+                    del entries[key]
+                self._write_index(entries)
+        return broken
+
+
+def _parse_bytes(value: str) -> int:
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    value = value.strip().upper().rstrip("B")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage a onediff graph cache store.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = subparsers.add_parser("list", help="List the cached graphs.")
+    list_parser.add_argument("cache_dir")
+
+    prune_parser = subparsers.add_parser("prune", help="Evict cached graphs.")
+    prune_parser.add_argument("cache_dir")
+    prune_parser.add_argument(
+        "--max-bytes", type=_parse_bytes, default=None, help="e.g. 500M, 20G"
+    )
+    prune_parser.add_argument(
+        "--stale-versions",
+        action="store_true",
+        help="Remove graphs compiled by another oneflow version.",
+    )
+
+    verify_parser = subparsers.add_parser("verify", help="Check graph checksums.")
+    verify_parser.add_argument("cache_dir")
+    verify_parser.add_argument("--remove-broken", action="store_true")
+
+    args = parser.parse_args(argv)
+    store = GraphCacheStore(args.cache_dir)
+
+    if args.command == "list":
+        entries = store.entries()
+        for key, entry in sorted(entries.items(), key=lambda kv: -kv[1]["last_hit"]):
+            last_hit = time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.localtime(entry["last_hit"])
+            )
+            print(
+                f"{key}  {entry['size'] / 1024 ** 2:10.1f} MB  hits={entry['hits']:<5d} "
+                f"saved={entry['compile_seconds_saved']:.1f}s  last_hit={last_hit}  "
+                f"oneflow={entry.get('oneflow_version')}"
+            )
+        total = sum(entry["size"] for entry in entries.values())
+        print(f"{len(entries)} graph(s), {total / 1024 ** 2:.1f} MB")
+    elif args.command == "prune":
+        removed = store.prune(args.max_bytes, args.stale_versions)
+        print(f"Removed {len(removed)} graph(s)")
+    elif args.command == "verify":
+        broken = store.verify(args.remove_broken)
+        for key, reason in broken.items():
+            print(f"{key}: {reason}")
+        print(f"{len(broken)} broken graph(s)")
+        return 1 if broken and not args.remove_broken else 0
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
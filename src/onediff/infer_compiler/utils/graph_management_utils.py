@@ -1,9 +1,12 @@
 import hashlib
+import json
 import os
+import time
 import torch
 import oneflow as flow
 from pathlib import Path
 from functools import wraps
+from itertools import chain
 from oneflow.framework.args_tree import ArgsTree
 from ..transform.builtin_transform import torch2oflow
 from ..transform.manager import transform_mgr
@@ -11,8 +14,98 @@ from .log_utils import logger
 from .cost_util import cost_time
 
 
-def calculate_model_hash(model):
-    return hashlib.sha256(f"{model}".encode("utf-8")).hexdigest()
+# Number of elements read from each tensor when the weight fingerprint is enabled.
+_WEIGHT_FINGERPRINT_SAMPLES = 16
+
+
+def _full_name(obj):
+    cls = obj if isinstance(obj, type) else type(obj)
+    return f"{cls.__module__}.{cls.__qualname__}"
+
+
+def _module_signature(model):
+    """Describe the module class tree and the shape/dtype of every tensor in it."""
+    modules = [(name, _full_name(module)) for name, module in model.named_modules()]
+    tensors = [
+        (name, tuple(tensor.shape), str(tensor.dtype))
+        for name, tensor in chain(model.named_parameters(), model.named_buffers())
+    ]
+    return {"modules": modules, "tensors": tensors}
+
+
+def _input_signature(args, kwargs, with_shape=True):
+    """Describe the tensors in the call arguments.
+
+    The full shape is only recorded for static graphs, a dynamic graph is
+    reusable across shapes so only the rank is part of the key.
+    """
+    signature = []
+    args_tree = ArgsTree((args, kwargs), False, tensor_type=torch.Tensor)
+    for value in args_tree.iter_nodes():
+        if isinstance(value, (torch.Tensor, flow.Tensor)):
+            shape = tuple(value.shape) if with_shape else len(value.shape)
+            signature.append((shape, str(value.dtype), str(value.device)))
+    return signature
+
+
+def _compiler_env_signature():
+    from ..oneflow_compiler_config import OneFlowCompilerConfig
+
+    env_vars = sorted(OneFlowCompilerConfig.attr2env_var.values())
+    return [(env_var, os.environ.get(env_var)) for env_var in env_vars]
+
+
+def calculate_weight_fingerprint(model, num_samples=_WEIGHT_FINGERPRINT_SAMPLES):
+    """Hash a few evenly spaced elements of every parameter and buffer.
+
+    This tells apart checkpoints that share an architecture without reading
+    whole tensors, so it stays cheap for large models.
+    """
+    hasher = hashlib.sha256()
+    with torch.no_grad():
+        for name, tensor in chain(model.named_parameters(), model.named_buffers()):
+            flat = tensor.detach().reshape(-1)
+            numel = flat.numel()
+            if numel == 0:
+                continue
+            step = max(numel // num_samples, 1)
+            sampled = flat[::step][:num_samples]
+            hasher.update(name.encode("utf-8"))
+            hasher.update(sampled.cpu().contiguous().view(torch.uint8).numpy().tobytes())
+    return hasher.hexdigest()
+
+
+def calculate_model_hash(model, weight_fingerprint=False):
+    signature = _module_signature(model)
+    if weight_fingerprint:
+        signature["weights"] = calculate_weight_fingerprint(model)
+    return hashlib.sha256(
+        json.dumps(signature, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def calculate_graph_cache_key(deployable_module, args, kwargs, weight_fingerprint=False):
+    """Build the content-addressed key of the compiled graph for this call.
+
+    The key covers the module class tree, parameter shapes and dtypes, the
+    input tensor signature, the compiler env flags and the oneflow/onediff
+    versions. With `weight_fingerprint` sampled weight bytes are added too.
+    """
+    from onediff import __version__ as onediff_version
+
+    torch_module = deployable_module._deployable_module_model._torch_module
+    key = {
+        "model": calculate_model_hash(torch_module, weight_fingerprint),
+        "inputs": _input_signature(
+            args,
+            kwargs,
+            with_shape=not deployable_module._deployable_module_enable_dynamic,
+        ),
+        "compiler_env": _compiler_env_signature(),
+        "oneflow": flow.__version__,
+        "onediff": onediff_version,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
 
 
 @cost_time(debug=transform_mgr.debug_mode, message="generate graph file name")
@@ -26,16 +119,78 @@ def generate_graph_file_name(file_path, deployable_module, args, kwargs):
     args_tree = ArgsTree((args, kwargs), False, tensor_type=torch.Tensor)
     count = len([v for v in args_tree.iter_nodes() if isinstance(v, flow.Tensor)])
 
-    model = deployable_module._deployable_module_model.oneflow_module
-
-    cache_key = calculate_model_hash(model) + "_" + flow.__version__
+    compile_options = getattr(deployable_module, "_deployable_module_options", {})
+    weight_fingerprint = compile_options.get("graph_file_weight_fingerprint", False)
+    cache_key = calculate_graph_cache_key(
+        deployable_module, args, kwargs, weight_fingerprint
+    )
     return f"{file_path}_{count}_{cache_key}.graph"
 
 
+def _graph_cache_store_management(self, func, cache_store, args, kwargs):
+    key = calculate_graph_cache_key(
+        self,
+        args,
+        kwargs,
+        self._deployable_module_options.get("graph_file_weight_fingerprint", False),
+    )
+    graph_file = cache_store.lookup(key)
+    if graph_file is not None:
+        try:
+            graph_device = self._deployable_module_options.get("graph_file_device")
+            self.load_graph(graph_file, torch2oflow(graph_device))
+            logger.info(f"Loaded graph file from cache store: {graph_file}")
+            return func(self, *args, **kwargs)
+        except Exception as e:
+            logger.warning(f"Failed to load graph file: {graph_file}! {e}")
+            self._deployable_module_dpl_graph = None
+
+    start_time = time.time()
+    ret = func(self, *args, **kwargs)
+    compile_seconds = time.time() - start_time
+    try:
+        graph_file = cache_store.put(key, self.save_graph, compile_seconds)
+        if graph_file is not None:
+            logger.info(f"Saved graph file to cache store: {graph_file}")
+    except Exception as e:
+        logger.error(f"Failed to save graph to cache store {cache_store.cache_dir}! {e}")
+    return ret
+
+
+def has_saved_graph(deployable_module, args, kwargs) -> bool:
+    """Whether the next call of `deployable_module` loads its graph from a file,
+    of the 'graph_cache_store' or 'graph_file' option, instead of compiling it."""
+    if not getattr(deployable_module, "_load_graph_first_run", True):
+        return False
+    compile_options = getattr(deployable_module, "_deployable_module_options", {})
+    cache_store = compile_options.get("graph_cache_store", None)
+    if cache_store is not None:
+        key = calculate_graph_cache_key(
+            deployable_module,
+            args,
+            kwargs,
+            compile_options.get("graph_file_weight_fingerprint", False),
+        )
+        return key in cache_store.entries() and os.path.exists(
+            cache_store.entry_path(key)
+        )
+    graph_file = compile_options.get("graph_file", None)
+    if graph_file is None:
+        return False
+    return os.path.exists(
+        generate_graph_file_name(graph_file, deployable_module, args, kwargs)
+    )
+
+
 def graph_file_management(func):
     @wraps(func)
     def wrapper(self: "DeployableModule", *args, **kwargs):
         compile_options = getattr(self, "_deployable_module_options", {})
+        cache_store = compile_options.get("graph_cache_store", None)
+        if cache_store is not None and getattr(self, "_load_graph_first_run", True):
+            setattr(self, "_load_graph_first_run", False)
+            return _graph_cache_store_management(self, func, cache_store, args, kwargs)
+
         graph_file = compile_options.get("graph_file", None)
         is_first_load = (
             getattr(self, "_load_graph_first_run", True) and graph_file is not None
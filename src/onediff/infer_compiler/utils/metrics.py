@@ -0,0 +1,254 @@
+"""Counters and histograms for the infer compiler.
+
+Metrics are disabled by default, enable them with `ONEDIFF_METRICS=1` or
+`metrics_registry.enable()`. While disabled, recording is a no-op and no
+device sync is issued.
+
+Usage:
+    >>> from onediff.infer_compiler.utils import metrics_registry
+    >>> metrics_registry.enable()
+    >>> ...  # run the compiled pipeline
+    >>> metrics_registry.to_dict()
+    >>> metrics_registry.dump_jsonl("onediff_metrics.jsonl")
+    >>> print(metrics_registry.to_prometheus())
+"""
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Sequence, Tuple
+import oneflow as flow
+from .env_var import parse_boolean_from_env
+
+__all__ = ["Counter", "Histogram", "MetricsRegistry", "metrics_registry"]
+
+_DEFAULT_SECONDS_BUCKETS = (0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+_DEFAULT_MB_BUCKETS = (-1024, -64, 0, 64, 256, 1024, 4096, 16384)
+
+
+def _label_key(labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(label_key, extra=()) -> str:
+    items = list(label_key) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class Counter:
+    def __init__(self, registry: "MetricsRegistry", name: str, documentation: str):
+        self._registry = registry
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        if not self._registry.enabled:
+            return
+        key = _label_key(labels)
+        with self._registry._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+    def reset(self):
+        self._values = {}
+
+    def to_dict(self):
+        return {
+            "type": "counter",
+            "values": [
+                {"labels": dict(key), "value": value}
+                for key, value in self._values.items()
+            ],
+        }
+
+    def to_prometheus(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        registry: "MetricsRegistry",
+        name: str,
+        documentation: str,
+        buckets: Sequence[float] = _DEFAULT_SECONDS_BUCKETS,
+    ):
+        self._registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        if not self._registry.enabled:
+            return
+        key = _label_key(labels)
+        with self._registry._lock:
+            state = self._values.setdefault(
+                key, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            )
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    state["counts"][i] += 1
+                    break
+            state["sum"] += value
+            state["count"] += 1
+
+    def reset(self):
+        self._values = {}
+
+    def to_dict(self):
+        return {
+            "type": "histogram",
+            "buckets": [str(b) for b in self.buckets],
+            "values": [
+                {"labels": dict(key), **state} for key, state in self._values.items()
+            ],
+        }
+
+    def to_prometheus(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for key, state in self._values.items():
+            cumulative = 0
+            for upper, count in zip(self.buckets, state["counts"]):
+                cumulative += count
+                le = "+Inf" if math.isinf(upper) else str(upper)
+                labels = _format_labels(key, [("le", le)])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {state['sum']}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {state['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        if name not in self._metrics:
+            self._metrics[name] = Counter(self, name, documentation)
+        return self._metrics[name]
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        buckets: Sequence[float] = _DEFAULT_SECONDS_BUCKETS,
+    ) -> Histogram:
+        if name not in self._metrics:
+            self._metrics[name] = Histogram(self, name, documentation, buckets)
+        return self._metrics[name]
+
+    def reset(self):
+        with self._lock:
+            for metric in self._metrics.values():
+                metric.reset()
+
+    def to_dict(self):
+        with self._lock:
+            return {name: metric.to_dict() for name, metric in self._metrics.items()}
+
+    def dump_jsonl(self, file_path: str):
+        """Append a timestamped snapshot as one line of a JSON lines file."""
+        snapshot = {"timestamp": time.time(), "metrics": self.to_dict()}
+        with open(file_path, "a") as f:
+            f.write(json.dumps(snapshot) + "\n")
+
+    def to_prometheus(self) -> str:
+        """A snapshot in the Prometheus text exposition format."""
+        with self._lock:
+            lines = []
+            for metric in self._metrics.values():
+                lines += metric.to_prometheus()
+        return "\n".join(lines) + "\n"
+
+    @contextmanager
+    def measure(self, histogram: Histogram, **labels):
+        """Time a code range into `histogram` and record its memory deltas.
+
+        The device is synced before and after the range, only when enabled.
+        """
+        if not self.enabled:
+            yield
+            return
+        flow._oneflow_internal.eager.Sync()
+        before_used = flow._oneflow_internal.GetCUDAMemoryUsed()
+        before_host_used = flow._oneflow_internal.GetCPUMemoryUsed()
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            flow._oneflow_internal.eager.Sync()
+            histogram.observe(time.time() - start_time, **labels)
+            event = {"event": histogram.name, **labels}
+            CUDA_MEM_DELTA_MB.observe(
+                flow._oneflow_internal.GetCUDAMemoryUsed() - before_used, **event
+            )
+            HOST_MEM_DELTA_MB.observe(
+                flow._oneflow_internal.GetCPUMemoryUsed() - before_host_used, **event
+            )
+
+
+metrics_registry = MetricsRegistry(
+    enabled=parse_boolean_from_env("ONEDIFF_METRICS", False)
+)
+
+TORCH2OFLOW_SECONDS = metrics_registry.histogram(
+    "onediff_torch2oflow_seconds", "Time to convert a torch module to oneflow."
+)
+GRAPH_BUILD_SECONDS = metrics_registry.histogram(
+    "onediff_graph_build_seconds",
+    "Time of a graph call that compiled a new graph, including its first run.",
+)
+GRAPH_LOAD_SECONDS = metrics_registry.histogram(
+    "onediff_graph_load_seconds", "Time to load a graph file."
+)
+GRAPH_SAVE_SECONDS = metrics_registry.histogram(
+    "onediff_graph_save_seconds", "Time to save a graph file."
+)
+GRAPH_LOAD_BYTES = metrics_registry.counter(
+    "onediff_graph_load_bytes_total", "Bytes of graph files loaded."
+)
+GRAPH_SAVE_BYTES = metrics_registry.counter(
+    "onediff_graph_save_bytes_total", "Bytes of graph files saved."
+)
+GRAPH_CACHE_HITS = metrics_registry.counter(
+    "onediff_graph_cache_hits_total",
+    "Graph calls whose input shapes are held in the dynamic graph cache.",
+)
+GRAPH_CACHE_MISSES = metrics_registry.counter(
+    "onediff_graph_cache_misses_total",
+    "Graph calls whose input shapes needed a new graph.",
+)
+RECOMPILES = metrics_registry.counter(
+    "onediff_recompiles_total", "Graphs dropped and compiled again, by reason."
+)
+CUDA_MEM_DELTA_MB = metrics_registry.histogram(
+    "onediff_cuda_mem_delta_mb", "Device memory delta of an event.", _DEFAULT_MB_BUCKETS
+)
+HOST_MEM_DELTA_MB = metrics_registry.histogram(
+    "onediff_host_mem_delta_mb", "Host memory delta of an event.", _DEFAULT_MB_BUCKETS
+)
@@ -1,6 +1,9 @@
+import threading
 import oneflow as flow
 
-_ONEFLOW_EXEC_MODE = False
+# Thread local, so a graph compiling in a background thread (see the
+# 'async_compile' option) doesn't switch the mode of the serving thread.
+_ONEFLOW_EXEC_MODE = threading.local()
 
 
 class oneflow_exec_mode(object):
@@ -11,18 +14,15 @@ class oneflow_exec_mode(object):
             self.enabled = True
 
     def __enter__(self):
-        global _ONEFLOW_EXEC_MODE
-        self.prev_mode = _ONEFLOW_EXEC_MODE
-        _ONEFLOW_EXEC_MODE = self.enabled
+        self.prev_mode = oneflow_exec_mode_enabled()
+        _ONEFLOW_EXEC_MODE.enabled = self.enabled
         self.prev_grad_mode = flow.is_grad_enabled()
         _ = flow.set_grad_enabled(False)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        global _ONEFLOW_EXEC_MODE
-        _ONEFLOW_EXEC_MODE = self.prev_mode
+        _ONEFLOW_EXEC_MODE.enabled = self.prev_mode
         _ = flow.set_grad_enabled(self.prev_grad_mode)
 
 
 def oneflow_exec_mode_enabled():
-    global _ONEFLOW_EXEC_MODE
-    return _ONEFLOW_EXEC_MODE
+    return getattr(_ONEFLOW_EXEC_MODE, "enabled", False)
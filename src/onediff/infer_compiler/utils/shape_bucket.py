@@ -0,0 +1,184 @@
+"""Snap input resolutions to a fixed set of buckets.
+
+Usage:
+    >>> bucketer = ShapeBucketer([(128, 128), (96, 160), (160, 96)])
+    >>> unet = oneflow_compile(unet, options={"shape_buckets": bucketer})
+    >>> bucketer.stats()
+    {'hit': {'128x128': 3}, 'padded': {'96x160': 1}, 'unbucketed': {}}
+
+A call whose spatial size is not a bucket is padded up to the smallest bucket
+that fits and the outputs are cropped back, so a node holds at most one graph
+per bucket. Padding is not transparent: convolutions near the border, the
+statistics of GroupNorm and self-attention all see the padded region, so the
+outputs of a padded call differ from those of the unpadded one, and images
+may show artifacts near the bottom/right edges. Check the quality at the
+sizes that get padded. Pipelines that can change the requested size instead
+can use `nearest_resolution` to pick the bucket with the closest aspect
+ratio, which needs no padding.
+"""
+from collections import Counter
+from fractions import Fraction
+from typing import List, Optional, Sequence, Tuple
+import torch
+import torch.nn.functional as F
+from oneflow.framework.args_tree import ArgsTree
+
+__all__ = ["ShapeBucketer"]
+
+
+def _spatial_scale(shape, base_hw) -> Optional[Fraction]:
+    """The scale of a tensor's trailing (H, W) relative to `base_hw`, or None."""
+    if len(shape) < 4:
+        return None
+    h, w = shape[-2], shape[-1]
+    scale = Fraction(h, base_hw[0])
+    if Fraction(w, base_hw[1]) != scale:
+        return None
+    return scale
+
+
+def _scaled(hw, scale: Fraction) -> Optional[Tuple[int, int]]:
+    h, w = hw[0] * scale, hw[1] * scale
+    if h.denominator != 1 or w.denominator != 1:
+        return None
+    return int(h), int(w)
+
+
+class ShapeBucketer:
+    """Pad inputs to a configured set of latent (height, width) buckets.
+
+    The first tensor input with at least 4 dims decides the spatial size of a
+    call. Every tensor input whose trailing (H, W) is a multiple or fraction
+    of that size (e.g. ControlNet conditioning images and residuals) is padded
+    at the bottom/right by the same ratio, and outputs are cropped the same way.
+    A call is left unbucketed if no bucket fits or if a related tensor can't
+    be padded by the same ratio, e.g. a bucket that isn't a multiple of its
+    downsampling factor.
+
+    Padding changes the outputs, see the module docstring.
+
+    Args:
+        buckets (list): The (height, width) buckets in latent space.
+        pad_mode (str): The `torch.nn.functional.pad` mode, default "constant".
+    """
+
+    def __init__(self, buckets: Sequence[Tuple[int, int]], pad_mode: str = "constant"):
+        if len(buckets) == 0:
+            raise ValueError("ShapeBucketer needs at least one bucket.")
+        # Smallest area first, so the first bucket that fits wastes the least compute.
+        self.buckets = sorted(
+            {tuple(int(x) for x in b) for b in buckets}, key=lambda b: (b[0] * b[1], b)
+        )
+        self.pad_mode = pad_mode
+        self.reset()
+
+    def reset(self):
+        self._hit = Counter()
+        self._padded = Counter()
+        self._unbucketed = Counter()
+
+    def stats(self):
+        def _fmt(counter):
+            return {f"{h}x{w}": n for (h, w), n in counter.items()}
+
+        return {
+            "hit": _fmt(self._hit),
+            "padded": _fmt(self._padded),
+            "unbucketed": _fmt(self._unbucketed),
+        }
+
+    def find_bucket(self, height: int, width: int) -> Optional[Tuple[int, int]]:
+        """The smallest bucket that holds a (height, width) input."""
+        for bucket in self.buckets:
+            if bucket[0] >= height and bucket[1] >= width:
+                return bucket
+        return None
+
+    def nearest_resolution(self, height: int, width: int, scale: int = 8):
+        """The bucket with the aspect ratio closest to a requested image size.
+
+        `height` and `width` are in pixels and `scale` is the VAE scale
+        factor, the result is a pixel size a pipeline can render at directly.
+        """
+        ratio = height / width
+        area = height * width
+        bucket = min(
+            self.buckets,
+            key=lambda b: (
+                abs(b[0] / b[1] - ratio),
+                abs(b[0] * b[1] * scale * scale - area),
+            ),
+        )
+        return bucket[0] * scale, bucket[1] * scale
+
+    def _input_size(self, args, kwargs):
+        args_tree = ArgsTree((args, kwargs), False, tensor_type=torch.Tensor)
+        for value in args_tree.iter_nodes():
+            if isinstance(value, torch.Tensor) and value.dim() >= 4:
+                return tuple(value.shape[-2:])
+        return None
+
+    def _fits(self, args, kwargs, size, bucket) -> bool:
+        """Whether every tensor related to `size` scales to `bucket` by whole pixels."""
+        args_tree = ArgsTree((args, kwargs), False, tensor_type=torch.Tensor)
+        for value in args_tree.iter_nodes():
+            if not isinstance(value, torch.Tensor):
+                continue
+            scale = _spatial_scale(value.shape, size)
+            if scale is not None and _scaled(bucket, scale) is None:
+                return False
+        return True
+
+    def pad_inputs(self, args, kwargs):
+        """Pad the inputs of a call to its bucket.
+
+        Returns the new (args, kwargs) and a function restoring the original
+        size on the outputs.
+        """
+
+        def identity(output):
+            return output
+
+        size = self._input_size(args, kwargs)
+        if size is None:
+            return args, kwargs, identity
+        bucket = self.find_bucket(*size)
+        if bucket is None:
+            self._unbucketed[size] += 1
+            return args, kwargs, identity
+        if bucket == size:
+            self._hit[bucket] += 1
+            return args, kwargs, identity
+        if not self._fits(args, kwargs, size, bucket):
+            # Padding the other tensors partially would mismatch their shapes
+            self._unbucketed[size] += 1
+            return args, kwargs, identity
+        self._padded[bucket] += 1
+
+        def pad_fn(value):
+            if not isinstance(value, torch.Tensor):
+                return value
+            scale = _spatial_scale(value.shape, size)
+            target = None if scale is None else _scaled(bucket, scale)
+            if target is None:
+                return value
+            pad = (0, target[1] - value.shape[-1], 0, target[0] - value.shape[-2])
+            return F.pad(value, pad, mode=self.pad_mode)
+
+        args_tree = ArgsTree((args, kwargs), False, tensor_type=torch.Tensor)
+        out = args_tree.map_leaf(pad_fn)
+
+        def crop_fn(value):
+            if not isinstance(value, torch.Tensor):
+                return value
+            scale = _spatial_scale(value.shape, bucket)
+            target = None if scale is None else _scaled(size, scale)
+            if target is None:
+                return value
+            return value[..., : target[0], : target[1]]
+
+        def restore(output):
+            out_tree = ArgsTree((output, None), False, tensor_type=torch.Tensor)
+            return out_tree.map_leaf(crop_fn)[0]
+
+        return out[0], out[1], restore
@@ -0,0 +1,97 @@
+"""Check that torch and oneflow modules share their weights instead of copying them.
+
+Usage:
+    >>> unet = oneflow_compile(unet)
+    >>> ...  # run, move with .to(), patch LoRAs
+    >>> report = verify_shared_storage(unet)
+    >>> print(report)
+    >>> alias_shared_storage(unet)  # point diverged torch tensors back at oneflow storage
+"""
+import dataclasses
+from itertools import chain
+from typing import List, Tuple
+from oneflow.utils.tensor import to_torch
+
+__all__ = ["SharedStorageReport", "verify_shared_storage", "alias_shared_storage"]
+
+
+@dataclasses.dataclass
+class SharedStorageReport:
+    """Byte totals of the tensors shared, duplicated or only held by torch.
+
+    `diverged` lists (name, kind, nbytes) of each parameter or buffer whose
+    torch and oneflow data_ptr differ, i.e. which is held twice in memory.
+    """
+
+    shared_bytes: int = 0
+    duplicated_bytes: int = 0
+    unconverted_bytes: int = 0
+    diverged: List[Tuple[str, str, int]] = dataclasses.field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return len(self.diverged) == 0
+
+    def __str__(self) -> str:
+        lines = [
+            f"shared: {self.shared_bytes / 1024 ** 2:.1f} MB, "
+            f"duplicated: {self.duplicated_bytes / 1024 ** 2:.1f} MB, "
+            f"unconverted: {self.unconverted_bytes / 1024 ** 2:.1f} MB"
+        ]
+        for name, kind, nbytes in self.diverged:
+            lines.append(f"  {kind} {name}: {nbytes / 1024 ** 2:.1f} MB duplicated")
+        return "\n".join(lines)
+
+
+def _dual_modules(module):
+    dual_module = getattr(module, "_deployable_module_model", module)
+    return dual_module._torch_module, dual_module._oneflow_module
+
+
+def _tensor_pairs(torch_module, oneflow_module):
+    """Yield (name, kind, torch tensor, oneflow tensor or None)."""
+    of_tensors = {}
+    if oneflow_module is not None:
+        of_tensors.update(oneflow_module.named_parameters())
+        of_tensors.update(oneflow_module.named_buffers())
+    torch_tensors = chain(
+        (("parameter", n, t) for n, t in torch_module.named_parameters()),
+        (("buffer", n, t) for n, t in torch_module.named_buffers()),
+    )
+    for kind, name, tensor in torch_tensors:
+        yield name, kind, tensor, of_tensors.get(name)
+
+
+def verify_shared_storage(module) -> SharedStorageReport:
+    """Compare the data_ptr of every torch parameter/buffer of a
+    `DeployableModule` (or `DualModule`) with its oneflow counterpart.
+
+    Tensors of subtrees that are not converted (see the 'lazy_convert'
+    option) only exist on the torch side and are counted as unconverted.
+    """
+    report = SharedStorageReport()
+    for name, kind, tensor, of_tensor in _tensor_pairs(*_dual_modules(module)):
+        nbytes = tensor.numel() * tensor.element_size()
+        if of_tensor is None:
+            report.unconverted_bytes += nbytes
+        elif tensor.data_ptr() == of_tensor.data_ptr():
+            report.shared_bytes += nbytes
+        else:
+            report.duplicated_bytes += nbytes
+            report.diverged.append((name, kind, nbytes))
+    return report
+
+
+def alias_shared_storage(module) -> int:
+    """Point every diverged torch tensor at the storage of its oneflow
+    counterpart, freeing the torch copy. Returns the bytes freed."""
+    freed = 0
+    for name, kind, tensor, of_tensor in _tensor_pairs(*_dual_modules(module)):
+        if of_tensor is None or tensor.data_ptr() == of_tensor.data_ptr():
+            continue
+        aliased = to_torch(of_tensor.data)
+        if aliased.shape != tensor.shape or aliased.dtype != tensor.dtype:
+            continue
+        tensor.data = aliased
+        freed += tensor.numel() * tensor.element_size()
+    return freed
@@ -0,0 +1,189 @@
+"""A process-wide registry to hold identical weights only once.
+
+Compiling several models with the same weights (e.g. model patcher clones in
+ComfyUI) can convert and hold the same tensor more than once. With the registry
+enabled, a tensor being converted by `torch2oflow` (or loaded by
+`OneflowGraph.load_graph`) that equals one already registered by another model
+is aliased to it, and the copy is freed.
+
+Tensors are only aliased across models, never within one: the tensors of a
+model are registered under its root module (its owner), and two equal tensors
+of the same owner, e.g. zero biases, keep their own storage. Tensors converted
+outside of a model, e.g. the inputs of a call, are not registered.
+
+Tensors are looked up by storage first, so a tensor already registered costs
+no comparison. Other candidates are grouped by shape, dtype, stride and device,
+and confirmed with `torch.equal`, which syncs with the device once per
+candidate of another owner.
+
+Note that aliased tensors share storage: in-place updates of one model's weights
+(e.g. fusing a LoRA) are seen by every model sharing them. So the registry is
+disabled by default, enable it with `ONEDIFF_DEDUP_WEIGHTS=1` or `tensor_registry.enable()`.
+
+Usage:
+    >>> from onediff.infer_compiler.utils import tensor_registry
+    >>> tensor_registry.enable()
+    >>> unet = oneflow_compile(unet)
+    >>> unet_clone = oneflow_compile(unet_clone)
+    >>> tensor_registry.stats()  # {"tensors": ..., "aliased": ..., "saved_bytes": ...}
+"""
+import threading
+import weakref
+from contextlib import contextmanager
+
+import torch
+import oneflow as flow
+from .env_var import parse_boolean_from_env
+
+__all__ = ["TensorRegistry", "tensor_registry"]
+
+
+def _storage_key(tensor: torch.Tensor):
+    return (
+        tensor.device,
+        tensor.data_ptr(),
+        tensor.dtype,
+        tuple(tensor.shape),
+        tuple(tensor.stride()),
+    )
+
+
+def _layout_key(tensor: torch.Tensor):
+    """The tensors that can be equal to `tensor`, without reading its content."""
+    return (tuple(tensor.shape), tensor.dtype, tuple(tensor.stride()), tensor.device)
+
+
+class TensorRegistry:
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # storage key -> (tensor, owner) weak references of the registered tensor
+        self._storages = {}
+        # layout key -> (tensor, owner) weak references of the registered tensors
+        self._tensors = {}
+        self._aliased = 0
+        self._saved_bytes = 0
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        with self._lock:
+            self._storages.clear()
+            self._tensors.clear()
+            self._aliased = 0
+            self._saved_bytes = 0
+
+    @property
+    def owner(self):
+        """The root module whose tensors are being registered in this thread."""
+        return getattr(self._local, "owner", None)
+
+    @contextmanager
+    def owned_by(self, owner):
+        """Register the tensors converted or loaded in this context under `owner`."""
+        prev_owner = self.owner
+        self._local.owner = owner
+        try:
+            yield
+        finally:
+            self._local.owner = prev_owner
+
+    def stats(self):
+        with self._lock:
+            num_tensors = sum(
+                1
+                for entries in self._tensors.values()
+                for ref, _ in entries
+                if ref() is not None
+            )
+            return {
+                "tensors": num_tensors,
+                "aliased": self._aliased,
+                "saved_bytes": self._saved_bytes,
+            }
+
+    def _find(self, tensor: torch.Tensor, owner):
+        """The registered tensor `tensor` is or may be aliased to, else None."""
+        entry = self._storages.get(_storage_key(tensor))
+        if entry is not None:
+            registered = entry[0]()
+            # The storage may have been freed and reused by `tensor`
+            if registered is not None and registered.data_ptr() == tensor.data_ptr():
+                return registered
+        key = _layout_key(tensor)
+        entries = [e for e in self._tensors.get(key, []) if e[0]() is not None]
+        self._tensors[key] = entries
+        for ref, owner_ref in entries:
+            if owner_ref() is owner:
+                continue
+            registered = ref()
+            if torch.equal(registered, tensor):
+                return registered
+        return None
+
+    def _register(self, tensor: torch.Tensor, owner):
+        entry = (weakref.ref(tensor), weakref.ref(owner))
+        self._storages[_storage_key(tensor)] = entry
+        self._tensors.setdefault(_layout_key(tensor), []).append(entry)
+
+    def dedup(self, tensor: torch.Tensor) -> torch.Tensor:
+        """Register `tensor` under the current owner, or alias it to an equal
+        tensor registered by another owner.
+
+        A torch tensor that equals a registered one but has its own storage
+        has its `.data` pointed at the registered storage.
+        """
+        owner = self.owner
+        if not self.enabled or owner is None or tensor.numel() == 0:
+            return tensor
+        with self._lock:
+            registered = self._find(tensor, owner)
+            if registered is None:
+                self._register(tensor, owner)
+            elif registered.data_ptr() != tensor.data_ptr():
+                tensor.data = registered.data
+                self._aliased += 1
+                self._saved_bytes += tensor.numel() * tensor.element_size()
+        return tensor
+
+    def dedup_oneflow(self, tensor: flow.Tensor) -> flow.Tensor:
+        """Return a oneflow tensor sharing the storage of an equal tensor
+        registered by another owner, e.g. for a tensor loaded from a graph file.
+        Unlike `dedup`, `tensor` is not registered."""
+        owner = self.owner
+        if not self.enabled or owner is None or tensor.numel() == 0:
+            return tensor
+        torch_tensor = flow.utils.tensor.to_torch(tensor)
+        with self._lock:
+            registered = self._find(torch_tensor, owner)
+            if registered is None or registered.data_ptr() == tensor.data_ptr():
+                return tensor
+            self._aliased += 1
+            self._saved_bytes += tensor.numel() * tensor.element_size()
+        return flow.utils.tensor.from_torch(registered.data)
+
+    def dedup_state_dict(self, state_dict):
+        """Apply `dedup_oneflow` to every oneflow tensor in a nested state dict."""
+        if not self.enabled:
+            return state_dict
+        if isinstance(state_dict, flow.Tensor):
+            return self.dedup_oneflow(state_dict)
+        if isinstance(state_dict, dict):
+            for k, v in state_dict.items():
+                state_dict[k] = self.dedup_state_dict(v)
+            return state_dict
+        if isinstance(state_dict, list):
+            return [self.dedup_state_dict(v) for v in state_dict]
+        if isinstance(state_dict, tuple) and not hasattr(state_dict, "_fields"):
+            return tuple(self.dedup_state_dict(v) for v in state_dict)
+        return state_dict
+
+
+tensor_registry = TensorRegistry(
+    enabled=parse_boolean_from_env("ONEDIFF_DEDUP_WEIGHTS", False)
+)
@@ -1,30 +1,56 @@
 import os
+import time
 import types
 import torch
 import oneflow as flow
 from oneflow.utils.tensor import to_torch
-from typing import Any
-from functools import wraps
+from typing import Any, Dict
+from functools import partial, wraps
 from itertools import chain
 from .transform.manager import transform_mgr
 from .transform.custom_transform import set_default_registry
-from .transform.builtin_transform import torch2oflow, reverse_proxy_class
+from .transform.builtin_transform import (
+    torch2oflow,
+    reverse_proxy_class,
+    lazy_module_conversion,
+    convert_pending_children,
+)
 from .utils.oneflow_exec_mode import oneflow_exec_mode, oneflow_exec_mode_enabled
-from .utils.args_tree_util import input_output_processor
+from .utils.args_tree_util import (
+    input_output_processor,
+    process_input,
+    process_output,
+)
+from .utils.async_compile import AsyncGraphCompiler, in_async_compile
 from .utils.log_utils import logger
 from .utils.cost_util import cost_cnt
 from .utils.param_utils import parse_device, check_device
-from .utils.graph_management_utils import graph_file_management
+from .utils.graph_management_utils import graph_file_management, has_saved_graph
+from .utils.graph_cache_store import path_size
+from .utils.shared_storage import alias_shared_storage, verify_shared_storage
+from .utils.tensor_registry import tensor_registry
+from .utils.metrics import (
+    metrics_registry,
+    TORCH2OFLOW_SECONDS,
+    GRAPH_LOAD_SECONDS,
+    GRAPH_SAVE_SECONDS,
+    GRAPH_LOAD_BYTES,
+    GRAPH_SAVE_BYTES,
+    RECOMPILES,
+)
 
 
 class DualModule(torch.nn.Module):
-    def __init__(self, torch_module, oneflow_module):
+    def __init__(self, torch_module, oneflow_module, lazy_convert=False):
         torch.nn.Module.__init__(self)
         object.__setattr__(self, "_torch_module", torch_module)
         object.__setattr__(self, "_oneflow_module", oneflow_module)
         object.__setattr__(self, "_modules", torch_module._modules)
         object.__setattr__(self, "_parameters", torch_module._parameters)
         object.__setattr__(self, "_buffers", torch_module._buffers)
+        object.__setattr__(self, "_lazy_convert", lazy_convert)
+        # name -> (torch child, oneflow child, wrapper) of the child wrappers handed out
+        object.__setattr__(self, "_dual_children", {})
 
     @property
     def oneflow_module(self):
@@ -32,7 +58,12 @@ class DualModule(torch.nn.Module):
             return self._oneflow_module
 
         logger.debug(f"Convert {type(self._torch_module)} ...")
-        self._oneflow_module = torch2oflow(self._torch_module)
+        with metrics_registry.measure(
+            TORCH2OFLOW_SECONDS, module=type(self._torch_module).__name__
+        ), lazy_module_conversion(self._lazy_convert), tensor_registry.owned_by(
+            self._torch_module
+        ):
+            self._oneflow_module = torch2oflow(self._torch_module)
         logger.debug(f"Convert {type(self._torch_module)} done!")
         return self._oneflow_module
 
@@ -41,6 +72,7 @@ class DualModule(torch.nn.Module):
         if self._oneflow_module:
             del self._oneflow_module
             setattr(self, "_oneflow_module", None)
+            self._dual_children.clear()
 
     def to(self, *args, **kwargs):
         if oneflow_exec_mode_enabled():
@@ -56,21 +88,20 @@ class DualModule(torch.nn.Module):
 
     def _torch_module_to_with_check(self, *args, **kwargs):
         def _align_tensor(torch_module, oneflow_module):
-            oneflow_tensor_list = set(
-                [x for x, _ in oneflow_module.named_parameters()]
-                + [x for x, _ in oneflow_module.named_buffers()]
-            )
-            for name, tensor in chain.from_iterable(
-                [torch_module.named_parameters(), torch_module.named_buffers(),]
+            # Every submodule is visited by the loop below, so only the tensors
+            # owned directly by this module are aligned here. Buffers are looked
+            # up too, a buffer moved on the torch side would be held twice.
+            oneflow_tensors = {**oneflow_module._parameters, **oneflow_module._buffers}
+            for name, tensor in chain(
+                torch_module._parameters.items(), torch_module._buffers.items()
             ):
-                if name not in oneflow_tensor_list:
+                if tensor is None:
+                    continue
+                oneflow_tensor = oneflow_tensors.get(name)
+                if oneflow_tensor is None:
                     tensor.data = tensor.to(*args, **kwargs)
-                else:
-                    oneflow_tensor = oneflow_module.get_parameter(name)
-                    if oneflow_tensor is None:
-                        tensor.data = tensor.to(*args, **kwargs)
-                    elif tensor.data_ptr() != oneflow_tensor.data_ptr():
-                        tensor.data = to_torch(oneflow_tensor.data)
+                elif tensor.data_ptr() != oneflow_tensor.data_ptr():
+                    tensor.data = to_torch(oneflow_tensor.data)
 
         oneflow_module_list = set([x for x, _ in self._oneflow_module.named_modules()])
         for name, module in self._torch_module.named_modules():
@@ -89,13 +120,30 @@ class DualModule(torch.nn.Module):
             if self._oneflow_module is None
             else getattr(self._oneflow_module, name)
         )
-        if isinstance(torch_attr, torch.nn.ModuleList):
-            if oneflow_attr is None:
-                oneflow_attr = flow.nn.ModuleList([None] * len(torch_attr))
-            return DualModuleList(torch_attr, oneflow_attr)
-
-        elif isinstance(torch_attr, torch.nn.Module):
-            return get_mixed_dual_module(torch_attr.__class__)(torch_attr, oneflow_attr)
+        if isinstance(torch_attr, torch.nn.Module):
+            # Reuse the wrapper while both children are unchanged, patching code
+            # (LoRA, ComfyUI patchers) reads children in tight loops.
+            cached = self._dual_children.get(name)
+            if (
+                cached is not None
+                and cached[0] is torch_attr
+                and cached[1] is oneflow_attr
+            ):
+                return cached[2]
+
+            if isinstance(torch_attr, torch.nn.ModuleList):
+                dual_attr = DualModuleList(
+                    torch_attr,
+                    flow.nn.ModuleList([None] * len(torch_attr))
+                    if oneflow_attr is None
+                    else oneflow_attr,
+                )
+            else:
+                dual_attr = get_mixed_dual_module(torch_attr.__class__)(
+                    torch_attr, oneflow_attr
+                )
+            self._dual_children[name] = (torch_attr, oneflow_attr, dual_attr)
+            return dual_attr
         else:
             return oneflow_attr if oneflow_exec_mode_enabled() else torch_attr
 
@@ -103,6 +151,7 @@ class DualModule(torch.nn.Module):
         if name in ["_torch_module", "_oneflow_module"]:
             super().__setattr__(name, value)
         else:  # TODO: aviod memory up when set attr
+            self._dual_children.pop(name, None)
             if self._oneflow_module is not None:
                 v = torch2oflow(value)
                 if isinstance(v, flow.Tensor):
@@ -154,19 +203,25 @@ class DualModuleList(torch.nn.ModuleList):
         return object.__setattr__(self, key, value)
 
 
+_mixed_dual_module_cls_cache = {}
+
+
 def get_mixed_dual_module(module_cls):
     if issubclass(module_cls, DualModule) and "MixedDualModule" in module_cls.__name__:
         return module_cls
+    if module_cls in _mixed_dual_module_cls_cache:
+        return _mixed_dual_module_cls_cache[module_cls]
 
     class MixedDualModule(DualModule, module_cls):
-        def __init__(self, torch_module, oneflow_module):
+        def __init__(self, torch_module, oneflow_module, lazy_convert=False):
             while isinstance(torch_module, DualModule):
                 torch_module = torch_module._torch_module
-            DualModule.__init__(self, torch_module, oneflow_module)
+            DualModule.__init__(self, torch_module, oneflow_module, lazy_convert)
 
         def _get_name(self) -> str:
             return f"{self.__class__.__name__}(of {module_cls.__name__})"
 
+    _mixed_dual_module_cls_cache[module_cls] = MixedDualModule
     return MixedDualModule
 
 
@@ -178,7 +233,7 @@ def _(mod: DualModule, verbose=False):
 def handle_deployable_exception(func):
     @wraps(func)
     def wrapper(self, *args, **kwargs):
-        if transform_mgr.debug_mode:
+        if transform_mgr.debug_mode or in_async_compile():
             return func(self, *args, **kwargs)
         else:
             try:
@@ -186,13 +241,86 @@ def handle_deployable_exception(func):
             except Exception as e:
                 logger.error(f"Exception in {func.__name__}: {e=}")
                 logger.warning("Recompile oneflow module ...")
+                RECOMPILES.inc(
+                    reason="exception",
+                    module=type(self._deployable_module_model._torch_module).__name__,
+                )
                 del self._deployable_module_model.oneflow_module
-                self._deployable_module_dpl_graph = None
+                self._reset_graphs()
                 return func(self, *args, **kwargs)
 
     return wrapper
 
 
+def handle_lazy_convert(func):
+    """With the 'lazy_convert' option, run the method once in oneflow eager mode
+    before the graph is built, so the graph only holds the converted subtrees
+    that forward actually executes. Skipped when the graph is loaded from a
+    file, which doesn't trace forward."""
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if (
+            self._deployable_module_use_graph
+            and self._deployable_module_dpl_graph is None
+            and self._deployable_module_options.get("lazy_convert", False)
+            and not has_saved_graph(self, args, kwargs)
+        ):
+            oneflow_module = self._deployable_module_model.oneflow_module
+            with oneflow_exec_mode():
+                getattr(oneflow_module, func.__name__)(*args, **kwargs)
+        return func(self, *args, **kwargs)
+
+    return wrapper
+
+
+def handle_async_compile(func):
+    """With the 'async_compile' option, compile graphs in a background thread and
+    run calls with new input shapes in eager mode meanwhile."""
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if not (
+            self._deployable_module_use_graph
+            and self._deployable_module_options.get("async_compile", False)
+        ):
+            return func(self, *args, **kwargs)
+
+        handle = self.async_compile_handle()
+        fallback = self._deployable_module_options.get(
+            "async_compile_fallback", "torch"
+        )
+        if fallback == "torch":
+            eager_fn = getattr(
+                self._deployable_module_model._torch_module, func.__name__
+            )
+        elif fallback == "oneflow":
+            # Convert here, not in the compile thread, so both use the same module.
+            oneflow_fn = getattr(
+                self._deployable_module_model.oneflow_module, func.__name__
+            )
+
+            def eager_fn(*args, **kwargs):
+                mapped_args, mapped_kwargs, _ = process_input(*args, **kwargs)
+                # The compile thread builds the graph from this module (and
+                # converts its lazy children), so they take turns.
+                with handle.lock, oneflow_exec_mode():
+                    output = oneflow_fn(*mapped_args, **mapped_kwargs)
+                return process_output(output)
+
+        else:
+            raise ValueError(
+                f"Unknown async_compile_fallback {fallback!r}, expected 'torch' or 'oneflow'"
+            )
+
+        def compiled_fn(*args, **kwargs):
+            return func(self, *args, **kwargs)
+
+        return handle(compiled_fn, eager_fn, args, kwargs)
+
+    return wrapper
+
+
 class DeployableModule(torch.nn.Module):
     def __init__(
         self, torch_module, oneflow_module, use_graph=True, dynamic=True, options={},
@@ -201,7 +329,11 @@ class DeployableModule(torch.nn.Module):
         object.__setattr__(
             self,
             "_deployable_module_model",
-            get_mixed_dual_module(torch_module.__class__)(torch_module, oneflow_module),
+            get_mixed_dual_module(torch_module.__class__)(
+                torch_module,
+                oneflow_module,
+                lazy_convert=(options or {}).get("lazy_convert", False),
+            ),
         )
         object.__setattr__(self, "_modules", torch_module._modules)
         self._deployable_module_use_graph = use_graph
@@ -247,8 +379,10 @@ class DeployableModule(torch.nn.Module):
             )
         return self._deployable_module_dpl_graph
 
+    @handle_async_compile
     @input_output_processor
     @handle_deployable_exception
+    @handle_lazy_convert
     @graph_file_management
     def apply_model(self, *args, **kwargs):
         if self._deployable_module_use_graph:
@@ -262,8 +396,10 @@ class DeployableModule(torch.nn.Module):
                 )
         return output
 
+    @handle_async_compile
     @input_output_processor
     @handle_deployable_exception
+    @handle_lazy_convert
     @graph_file_management
     def __call__(self, *args, **kwargs):
         if self._deployable_module_use_graph:
@@ -278,6 +414,7 @@ class DeployableModule(torch.nn.Module):
     def to(self, *args, **kwargs):
         if self._deployable_module_dpl_graph is None:
             self._deployable_module_model.to(*args, **kwargs)
+            self._check_shared_storage()
             return self
 
         # assert the target device is same as graph device
@@ -292,11 +429,24 @@ class DeployableModule(torch.nn.Module):
                     f"After graph built, the device of graph can't be modified, current device: {current_device}, target device: {target_device}"
                 )
         self._deployable_module_model.to(*args, **kwargs)
+        self._check_shared_storage()
         return self
 
+    def _check_shared_storage(self):
+        if not self._deployable_module_options.get("strict_shared_storage", False):
+            return
+        alias_shared_storage(self)
+        report = verify_shared_storage(self)
+        if not report.ok:
+            raise RuntimeError(
+                f"Torch and oneflow weights of {type(self._deployable_module_model._torch_module)} diverged:\n{report}"
+            )
+
     # TODO(): Just for transformers VAE decoder
+    @handle_async_compile
     @input_output_processor
     @handle_deployable_exception
+    @handle_lazy_convert
     @graph_file_management
     def decode(self, *args, **kwargs):
         if self._deployable_module_use_graph:
@@ -319,11 +469,123 @@ class DeployableModule(torch.nn.Module):
         return getattr(self._deployable_module_model, name)
 
     def load_graph(self, file_path, device=None, run_warmup=True):
-        self.get_graph().load_graph(file_path, device, run_warmup)
+        with tensor_registry.owned_by(self._torch_module):
+            self.get_graph().load_graph(file_path, device, run_warmup)
 
     def save_graph(self, file_path):
         self.get_graph().save_graph(file_path)
 
+    def graph_entry(self, name: str) -> "DeployableModule":
+        """A DeployableModule running the converted module of this one, with a
+        graph of its own, created once per `name`.
+
+        A call with another count of input tensors than the last one rebuilds
+        the graph, e.g. at each switch between two kinds of calls of one
+        module. Calling each kind through its own entry keeps both graphs,
+        while the module is converted once and its weights are shared.
+
+            >>> full_step_unet = fast_unet.graph_entry("full_step")
+        """
+        entries = self.__dict__.setdefault("_deployable_module_graph_entries", {})
+        if name not in entries:
+            entry = type(self)(
+                self._deployable_module_model._torch_module,
+                None,
+                self._deployable_module_use_graph,
+                self._deployable_module_enable_dynamic,
+                self._deployable_module_options,
+            )
+            object.__setattr__(
+                entry, "_deployable_module_model", self._deployable_module_model
+            )
+            entry.__dict__["_deployable_module_graph_owner"] = self
+            entries[name] = entry
+        return entries[name]
+
+    def graph_entries(self) -> Dict[str, "DeployableModule"]:
+        """The entries created by `graph_entry`, by name."""
+        return dict(self.__dict__.get("_deployable_module_graph_entries", {}))
+
+    def _reset_graphs(self):
+        # The graphs of the module and of its entries run the same converted module
+        owner = self.__dict__.get("_deployable_module_graph_owner", self)
+        for module in [owner, *owner.graph_entries().values()]:
+            module._deployable_module_dpl_graph = None
+
+    def convert_pending_children(self):
+        """Convert the children left out by the 'lazy_convert' option, so the
+        iterators of the oneflow module (`modules()`, `state_dict()`, ...)
+        cover the whole tree."""
+        convert_pending_children(self._deployable_module_model.oneflow_module)
+
+    def async_compile_handle(self) -> AsyncGraphCompiler:
+        """The handle of the background compiles of the 'async_compile' option,
+        e.g. `wait()` on it before reporting ready."""
+        if "_deployable_module_async_compiler" not in self.__dict__:
+            self.__dict__["_deployable_module_async_compiler"] = AsyncGraphCompiler(
+                self
+            )
+        return self.__dict__["_deployable_module_async_compiler"]
+
+    def precompile(self, shapes, input_fn=None, graph_file=None):
+        """Compile the graph ahead of time for each input shape bucket.
+
+        Args:
+            shapes (list): The shape buckets to compile, e.g. [(1, 4, 128, 128), (2, 4, 96, 160)].
+            input_fn (callable, optional): `input_fn(shape) -> (args, kwargs)` builds the synthetic
+                inputs of a bucket. By default a single random tensor of `shape` is used, with the
+                dtype and device of the module parameters.
+            graph_file (str, optional): If set, all bucket graphs are saved into this one file.
+
+        Returns:
+            A list with the compile time (seconds) and the device/host memory delta (MB) of each bucket.
+        """
+        if input_fn is None:
+            param = next(self._deployable_module_model._torch_module.parameters())
+
+            def input_fn(shape):
+                return (torch.randn(shape, dtype=param.dtype, device=param.device),), {}
+
+        if self._deployable_module_use_graph:
+            # Every declared bucket has to stay in the graph cache.
+            size = self._deployable_module_options.get("size", 9)
+            set_graph_cache_size(self.get_graph(), max(size, len(shapes)))
+
+        report = []
+        for shape in shapes:
+            args, kwargs = input_fn(shape)
+            flow._oneflow_internal.eager.Sync()
+            before_used = flow._oneflow_internal.GetCUDAMemoryUsed()
+            before_host_used = flow._oneflow_internal.GetCPUMemoryUsed()
+            start_time = time.time()
+            if self._deployable_module_options.get("async_compile", False):
+                # Compile in this thread, `self(...)` would only queue it
+                self.async_compile_handle().compile(
+                    partial(DeployableModule.__call__.__wrapped__, self),
+                    args,
+                    kwargs,
+                )
+            else:
+                self(*args, **kwargs)
+            flow._oneflow_internal.eager.Sync()
+            compile_seconds = time.time() - start_time
+            result = {
+                "shape": tuple(shape),
+                "compile_seconds": compile_seconds,
+                "cuda_mem_diff_mb": flow._oneflow_internal.GetCUDAMemoryUsed()
+                - before_used,
+                "host_mem_diff_mb": flow._oneflow_internal.GetCPUMemoryUsed()
+                - before_host_used,
+            }
+            logger.info(
+                f"Precompiled {type(self._deployable_module_model._torch_module)} for {result}"
+            )
+            report.append(result)
+
+        if graph_file is not None and self._deployable_module_use_graph:
+            self.save_graph(graph_file)
+        return report
+
     def extra_repr(self) -> str:
         return self._deployable_module_model.extra_repr()
 
@@ -342,10 +604,14 @@ class OneflowGraph(flow.nn.Graph):
 
     @cost_cnt(transform_mgr.debug_mode)
     def load_graph(self, file_path, device=None, run_warmup=True):
-        state_dict = flow.load(file_path)
-        if device is not None:
-            state_dict = flow.nn.Graph.runtime_state_dict_to(state_dict, device)
-        self.load_runtime_state_dict(state_dict, warmup_with_run=run_warmup)
+        with metrics_registry.measure(GRAPH_LOAD_SECONDS):
+            state_dict = flow.load(file_path)
+            if device is not None:
+                state_dict = flow.nn.Graph.runtime_state_dict_to(state_dict, device)
+            state_dict = tensor_registry.dedup_state_dict(state_dict)
+            self.load_runtime_state_dict(state_dict, warmup_with_run=run_warmup)
+        if metrics_registry.enabled:
+            GRAPH_LOAD_BYTES.inc(path_size(file_path))
 
     @cost_cnt(transform_mgr.debug_mode)
     def save_graph(self, file_path):
@@ -376,12 +642,21 @@ class OneflowGraph(flow.nn.Graph):
 
         args_tree._is_dataclass = original_is_dataclass
 
-        flow.save(state_dict, file_path)
+        with metrics_registry.measure(GRAPH_SAVE_SECONDS):
+            flow.save(state_dict, file_path)
+        if metrics_registry.enabled:
+            GRAPH_SAVE_BYTES.inc(path_size(file_path))
+
+
+def set_graph_cache_size(graph, size):
+    graph._dynamic_input_graph_cache.set_cache_size(size)
+    # Read by the graph cache metrics, which mirror the cache
+    graph._onediff_cache_size = size
 
 
 def get_oneflow_graph(model, size=9, dynamic_graph=True):
     g = OneflowGraph(model)
-    g._dynamic_input_graph_cache.set_cache_size(size)
+    set_graph_cache_size(g, size)
     g._dynamic_input_graph_cache.enable_shared(dynamic_graph)
     return g
 
@@ -445,6 +720,13 @@ def oneflow_compile(
         - 'size' which config the cache size when cache is enabled. Note that after onediff v0.12, cache is default disabled.
         - 'graph_file' (None) generates a compilation cache file. If the file exists, loading occurs; if not, the compilation result is saved after the first run.
         - 'graph_file_device' (None) sets the device for the graph file, default None.  If set, the compilation result will be converted to the specified device.
+        - 'graph_file_weight_fingerprint' (False) adds a hash of sampled weight bytes to the graph file name, so checkpoints sharing an architecture do not share a graph file.
+        - 'graph_cache_store' (None) a `GraphCacheStore` shared by processes on one node. If set, it is used instead of 'graph_file' to load and save the graph.
+        - 'lazy_convert' (False) converts child modules to oneflow on first access only. The first call runs once in oneflow eager mode before the graph is built, unless the graph is loaded from a file, so subtrees forward never executes are not converted. Children not converted yet are missing from the iterators of the oneflow module (`modules()`, `state_dict()`, ...), see `DeployableModule.convert_pending_children`.
+        - 'strict_shared_storage' (False) after `to()`, points torch tensors that diverged from their oneflow counterparts back at the oneflow storage, and raises if any tensor is still held twice.
+        - 'shape_buckets' (None) a `ShapeBucketer`. If set, inputs are padded to the smallest bucket that fits and outputs are cropped back, which caps the number of graphs compiled. Padding changes the outputs near the padded region, and calls whose related tensors can't be padded by the same ratio are left unbucketed.
+        - 'async_compile' (False) compiles the graph of each new input shape in a background thread. Calls run in eager mode until it is ready, see `DeployableModule.async_compile_handle`.
+        - 'async_compile_fallback' ('torch') the eager mode of 'async_compile', 'torch' or 'oneflow'. The 'oneflow' fallback shares the module the graph is built from, so its calls wait for a running compile.
     """
 
     set_default_registry()
@@ -0,0 +1,10 @@
+from .engine import (
+    LoRAUpdate,
+    apply_lora_updates,
+    lora_factors,
+    is_quantized_module,
+    dequantize_weight,
+    requantize_weight_,
+    preserve_weight_storage,
+)
+from .delta_cache import LoRADeltaCache
@@ -0,0 +1,136 @@
+import weakref
+from collections import OrderedDict
+from typing import Optional, Union
+
+import torch
+
+from onediff.infer_compiler.utils.log_utils import logger
+
+
+class LoRADeltaCache:
+    r"""
+    LRU cache of the fused delta weight of each layer, keyed by the layer and
+    its combination of ((adapter name, scale), ...), under a byte budget.
+
+    With the cache passed to `apply_lora_updates`, switching back to a
+    recently used combination of adapters (or unfusing it) adds/subtracts the
+    cached deltas instead of recomputing `w_up @ w_down`.
+
+    The cache is disabled while `max_bytes` is 0, which is the default:
+
+        >>> from onediffx.lora import lora_delta_cache
+        >>> lora_delta_cache.configure(max_bytes=4 << 30, dtype=torch.float16, device="cpu", pin_memory=True)
+        >>> set_and_fuse_adapters(pipe, ["a", "b"], [0.8, 0.2])  # miss, computes and caches the deltas
+        >>> set_and_fuse_adapters(pipe, "a")
+        >>> set_and_fuse_adapters(pipe, ["a", "b"], [0.8, 0.2])  # hit
+        >>> lora_delta_cache.stats()
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 0,
+        dtype: Optional[torch.dtype] = torch.float16,
+        device: Union[str, torch.device, None] = "cpu",
+        pin_memory: bool = False,
+    ):
+        self._entries = OrderedDict()
+        self.configure(max_bytes, dtype, device, pin_memory)
+
+    def configure(
+        self,
+        max_bytes: int,
+        dtype: Optional[torch.dtype] = torch.float16,
+        device: Union[str, torch.device, None] = "cpu",
+        pin_memory: bool = False,
+    ):
+        r"""
+        Parameters:
+            max_bytes (int): The byte budget of the cached deltas, 0 disables the cache.
+            dtype (torch.dtype, optional): The dtype to store deltas in, None keeps the dtype of the layer weight.
+            device (str or torch.device, optional): The device to store deltas on, None keeps the device of the layer weight.
+            pin_memory (bool, optional): Whether to pin deltas stored on CPU, for faster async copies to cuda.
+        """
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self.device = torch.device(device) if device is not None else None
+        self.pin_memory = pin_memory
+        self.clear()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self._hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+        }
+
+    @staticmethod
+    def _key(layer, factors):
+        return (weakref.ref(layer), tuple(factors))
+
+    def get(self, layer, factors) -> Optional[torch.Tensor]:
+        if not self.enabled:
+            return None
+        key = self._key(layer, factors)
+        delta = self._entries.get(key)
+        if delta is None:
+            self._misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self._hits += 1
+        return delta
+
+    def put(self, layer, factors, delta: torch.Tensor):
+        if not self.enabled:
+            return
+        delta = delta.to(
+            device=self.device or delta.device, dtype=self.dtype or delta.dtype
+        )
+        if self.pin_memory and delta.device.type == "cpu":
+            delta = delta.pin_memory()
+        nbytes = delta.numel() * delta.element_size()
+        if nbytes > self.max_bytes:
+            return
+        key = self._key(layer, factors)
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = delta
+        self._bytes += nbytes
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self._evictions += 1
+
+    def invalidate(self, adapter_names):
+        r"""
+        Drop the deltas of every combination containing one of `adapter_names`,
+        e.g. when they are deleted or loaded again with other weights.
+        """
+        if isinstance(adapter_names, str):
+            adapter_names = [adapter_names]
+        adapter_names = set(adapter_names)
+        stale = [
+            key
+            for key in self._entries
+            if any(name in adapter_names for name, _ in key[1])
+        ]
+        for key in stale:
+            self._remove(key)
+        if len(stale) > 0:
+            logger.debug(f"[OneDiff LoRADeltaCache] invalidated {len(stale)} deltas")
+
+    def _remove(self, key):
+        delta = self._entries.pop(key)
+        self._bytes -= delta.numel() * delta.element_size()
+
@@ -0,0 +1,289 @@
+"""Batched, in-place LoRA weight updates.
+
+This is the engine behind the LoRA support of onediffx, the ComfyUI nodes and
+the WebUI extension. Weights are updated in place, so the data_ptrs shared by
+a `DeployableModule` with its compiled graph stay valid, and no recompilation
+or graph weight reload is needed after a LoRA switch.
+
+Usage:
+    >>> updates = [
+    ...     LoRAUpdate(linear.weight.data, [(lora_up, lora_down, 0.8)]),
+    ...     LoRAUpdate(conv.weight.data, [(conv_up, conv_down, 0.8)]),
+    ... ]
+    >>> apply_lora_updates(updates)  # fuse
+    >>> apply_lora_updates(updates, alpha=-1.0)  # unfuse
+"""
+import dataclasses
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, List, Optional, Tuple
+
+import torch
+
+__all__ = [
+    "LoRAUpdate",
+    "apply_lora_updates",
+    "lora_factors",
+    "is_quantized_module",
+    "dequantize_weight",
+    "requantize_weight_",
+    "preserve_weight_storage",
+    "bulk_copy_",
+    "bulk_add_",
+]
+
+# Bound of the float32 temporaries of one batched update, in bytes.
+LORA_BATCH_BYTES = 256 * 1024 * 1024
+
+
+@dataclasses.dataclass
+class LoRAUpdate:
+    """The low-rank factors to add to a weight.
+
+    `factors` is a list of (up, down, scale): the delta of the weight is the
+    sum of `scale * up.flatten(1) @ down.flatten(1)`, reshaped to the weight
+    shape. The factors may be on another device than the weight.
+
+    With `cache_owner` and `cache_key` set, the delta is looked up in and
+    stored into the `delta_cache` of `apply_lora_updates`.
+
+    `quant_module` is set for an int8 weight quantized per output channel,
+    e.g. of `onediff_quant.DynamicQuantLinearModule`: the module holds the
+    `weight_scale` and `weight_acc` to dequantize it and which are updated
+    when it is quantized again.
+    """
+
+    weight: torch.Tensor
+    factors: List[Tuple[torch.Tensor, torch.Tensor, float]]
+    cache_owner: Any = None
+    cache_key: Optional[tuple] = None
+    quant_module: Any = None
+
+
+def lora_factors(
+    up: torch.Tensor,
+    down: torch.Tensor,
+    alpha: Optional[float] = None,
+    mid: Optional[torch.Tensor] = None,
+    strength: float = 1.0,
+) -> Tuple[torch.Tensor, torch.Tensor, float]:
+    """The (up, down, scale) of a kohya LoRA/LoCon module.
+
+    `alpha` is the network alpha, scaled by the rank, and `mid` the optional
+    LoCon mid weight, which is folded into `down`.
+    """
+    scale = strength
+    if alpha is not None:
+        scale *= alpha / down.shape[0]
+    if mid is not None:
+        up = up.float()
+        down = down.to(device=up.device, dtype=torch.float32)
+        mid = mid.to(device=up.device, dtype=torch.float32)
+        final_shape = [down.shape[1], down.shape[0], mid.shape[2], mid.shape[3]]
+        down = (
+            torch.mm(
+                down.transpose(0, 1).flatten(start_dim=1),
+                mid.transpose(0, 1).flatten(start_dim=1),
+            )
+            .reshape(final_shape)
+            .transpose(0, 1)
+        )
+    return up, down, scale
+
+
+def is_quantized_module(module) -> bool:
+    """Whether `module` holds an int8 weight quantized per output channel,
+    like the dynamic quant modules of onediff_quant."""
+    return hasattr(module, "weight_scale") and hasattr(module, "weight_acc")
+
+
+def _stacked_factors(update: LoRAUpdate, device):
+    # The factors of all adapters are concatenated along the rank dim, so one
+    # matmul computes the sum of their deltas.
+    w_up = torch.cat(
+        [
+            up.to(device).float().flatten(start_dim=1) * scale
+            for up, _, scale in update.factors
+        ],
+        dim=1,
+    )
+    w_down = torch.cat(
+        [
+            down.to(device).float().flatten(start_dim=1)
+            for _, down, _ in update.factors
+        ],
+        dim=0,
+    )
+    return w_up, w_down
+
+
+def apply_lora_updates(
+    updates: List[LoRAUpdate], alpha: float = 1.0, delta_cache=None
+):
+    """Add `alpha` times the LoRA deltas to many weights at once, in place.
+
+    Weights are grouped by shapes, dtype and device, and each group is
+    updated with one `bmm` and one bulk in-place copy, in chunks bounded by
+    `LORA_BATCH_BYTES`. Deltas held by `delta_cache` (a `LoRADeltaCache`) are
+    added without any matmul, and the deltas computed are stored into it.
+
+    Int8 weights (see `LoRAUpdate.quant_module`) are dequantized, updated and
+    quantized again with new scales, in stacked groups as well.
+    """
+    groups = defaultdict(list)
+    cached = defaultdict(list)
+    quantized = []
+    for update in updates:
+        if len(update.factors) == 0:
+            continue
+        if update.quant_module is not None:
+            quantized.append(update)
+            continue
+        weight = update.weight
+        if delta_cache is not None and update.cache_key is not None:
+            delta = delta_cache.get(update.cache_owner, update.cache_key)
+            if delta is not None:
+                cached[(weight.dtype, weight.device)].append((weight, delta))
+                continue
+        w_up, w_down = _stacked_factors(update, weight.device)
+        key = (tuple(w_up.shape), tuple(w_down.shape), weight.dtype, weight.device)
+        groups[key].append((update, w_up, w_down))
+
+    for (dtype, device), entries in cached.items():
+        weights, deltas = zip(*entries)
+        deltas = [d.to(device=device, dtype=dtype, non_blocking=True) for d in deltas]
+        bulk_add_(list(weights), deltas, alpha)
+
+    for (up_shape, down_shape, dtype, _), entries in groups.items():
+        # The stacked float32 weights and deltas of a chunk
+        layer_bytes = 2 * 4 * up_shape[0] * down_shape[1]
+        chunk_size = max(LORA_BATCH_BYTES // layer_bytes, 1)
+        for i in range(0, len(entries), chunk_size):
+            chunk, w_ups, w_downs = zip(*entries[i : i + chunk_size])
+            weights = [update.weight for update in chunk]
+            deltas = torch.bmm(torch.stack(w_ups), torch.stack(w_downs))
+            if delta_cache is not None and delta_cache.enabled:
+                for update, delta in zip(chunk, deltas):
+                    if update.cache_key is not None:
+                        delta_cache.put(
+                            update.cache_owner,
+                            update.cache_key,
+                            delta.view(update.weight.shape),
+                        )
+            fused = torch.stack([w.reshape(w.shape[0], -1) for w in weights]).float()
+            fused = fused.add_(deltas, alpha=alpha).to(dtype)
+            bulk_copy_(weights, [f.view(w.shape) for f, w in zip(fused, weights)])
+
+    _apply_quantized_lora_updates(quantized, alpha)
+
+
+def _apply_quantized_lora_updates(updates: List[LoRAUpdate], alpha: float):
+    # Weights are dequantized, updated and quantized again in stacked groups
+    # of the same shapes, one group at a time, so no float copy of all the
+    # weights is ever resident.
+    groups = defaultdict(list)
+    for update in updates:
+        weight = update.weight
+        w_up, w_down = _stacked_factors(update, weight.device)
+        key = (tuple(w_up.shape), tuple(w_down.shape), weight.device)
+        groups[key].append((update, w_up, w_down))
+
+    for (up_shape, down_shape, device), entries in groups.items():
+        layer_bytes = 3 * 4 * up_shape[0] * down_shape[1]
+        chunk_size = max(LORA_BATCH_BYTES // layer_bytes, 1)
+        for i in range(0, len(entries), chunk_size):
+            chunk, w_ups, w_downs = zip(*entries[i : i + chunk_size])
+            modules = [update.quant_module for update in chunk]
+            weights = torch.stack(
+                [u.weight.reshape(u.weight.shape[0], -1) for u in chunk]
+            ).float()
+            scales = torch.stack(
+                [m.weight_scale.reshape(-1).to(device, torch.float32) for m in modules]
+            )
+            weights.mul_(scales.unsqueeze(-1)).baddbmm_(
+                torch.stack(w_ups), torch.stack(w_downs), alpha=alpha
+            )
+            quantized, scales, accs = _quantize_per_channel(weights)
+            bulk_copy_(
+                [u.weight for u in chunk],
+                [q.view(u.weight.shape) for q, u in zip(quantized, chunk)],
+            )
+            bulk_copy_(
+                [m.weight_scale for m in modules],
+                [s.view(m.weight_scale.shape) for s, m in zip(scales, modules)],
+            )
+            bulk_copy_(
+                [m.weight_acc for m in modules],
+                [a.view(m.weight_acc.shape) for a, m in zip(accs, modules)],
+            )
+
+
+def _channel_shape(weight: torch.Tensor):
+    return [-1] + [1] * (weight.dim() - 1)
+
+
+def _quantize_per_channel(weight: torch.Tensor):
+    """Quantize (..., out_channels, k) float weights per output channel,
+    symmetric over [-127, 127]. Returns the quantized values (as floats),
+    the scales and the accumulated dequantized weights of each channel."""
+    scale = weight.abs().amax(dim=-1, keepdim=True) / 127
+    scale = scale.clamp_(min=torch.finfo(torch.float32).tiny)
+    quantized = torch.round(weight / scale).clamp_(-127, 127)
+    acc = (quantized * scale).sum(dim=-1)
+    return quantized, scale.squeeze(-1), acc
+
+
+def dequantize_weight(weight: torch.Tensor, quant_module) -> torch.Tensor:
+    """The float32 weight of an int8 weight quantized per output channel."""
+    scale = quant_module.weight_scale.reshape(_channel_shape(weight))
+    return weight.float() * scale.to(device=weight.device, dtype=torch.float32)
+
+
+def requantize_weight_(weight: torch.Tensor, quant_module) -> torch.Tensor:
+    """Quantize a float weight per output channel, symmetric over [-127, 127].
+
+    The `weight_scale` and `weight_acc` of `quant_module` are updated in
+    place, and the int8 values are returned in the dtype of `weight`.
+    """
+    quantized, scale, acc = _quantize_per_channel(
+        weight.reshape(weight.shape[0], -1)
+    )
+    quant_module.weight_scale.copy_(scale.reshape(quant_module.weight_scale.shape))
+    quant_module.weight_acc.copy_(acc.reshape(quant_module.weight_acc.shape))
+    return quantized.view(weight.shape)
+
+
+@contextmanager
+def preserve_weight_storage(modules):
+    """Keep the storage of the parameters of `modules` across code that may
+    replace them (e.g. a LoRA loader assigning new tensors), by copying new
+    values back into the original storage, which a compiled graph shares."""
+    params = [
+        (module, name, param.data)
+        for module in modules
+        for name, param in module.named_parameters(recurse=False)
+    ]
+    yield
+    for module, name, data in params:
+        param = getattr(module, name)
+        if param is None or param.data.data_ptr() == data.data_ptr():
+            continue
+        if param.data.shape == data.shape:
+            data.copy_(param.data)
+            param.data = data
+
+
+def bulk_copy_(dst: List[torch.Tensor], src: List[torch.Tensor]):
+    if hasattr(torch, "_foreach_copy_"):
+        torch._foreach_copy_(dst, src)
+    else:
+        for d, s in zip(dst, src):
+            d.copy_(s)
+
+
+def bulk_add_(dst: List[torch.Tensor], src: List[torch.Tensor], alpha: float = 1.0):
+    if hasattr(torch, "_foreach_add_"):
+        torch._foreach_add_(dst, src, alpha=alpha)
+    else:
+        for d, s in zip(dst, src):
+            d.add_(s, alpha=alpha)
@@ -0,0 +1,54 @@
+"""
+Install:
+    pip install pytest
+Usage:
+    python -m pytest tests/test_graph_cache_store.py
+"""
+from onediff.infer_compiler.utils.graph_cache_store import GraphCacheStore
+
+
+def _saver(num_bytes):
+    def save(path):
+        with open(path, "wb") as f:
+            f.write(b"0" * num_bytes)
+
+    return save
+
+
+def test_lru_eviction(tmp_path):
+    store = GraphCacheStore(tmp_path, max_bytes=250)
+    store.put("a", _saver(100), compile_seconds=3.0)
+    store.put("b", _saver(100), compile_seconds=2.0)
+    assert store.lookup("a") is not None
+    store.put("c", _saver(100), compile_seconds=1.0)
+
+    assert sorted(store.entries()) == ["a", "c"]
+    assert store.lookup("b") is None
+    assert store.entries()["a"]["compile_seconds_saved"] == 3.0
+
+
+def test_verify_and_prune(tmp_path):
+    store = GraphCacheStore(tmp_path)
+    store.put("a", _saver(100))
+    store.put("b", _saver(100))
+    with open(store.entry_path("a"), "ab") as f:
+        f.write(b"1")
+
+    assert store.verify(remove_broken=True) == {"a": "size mismatch"}
+    assert list(store.entries()) == ["b"]
+    assert store.prune(max_bytes=0) == ["b"]
+    assert store.total_bytes() == 0
+
+
+def test_oversized_graph_is_not_stored(tmp_path):
+    store = GraphCacheStore(tmp_path, max_bytes=250)
+    store.put("a", _saver(100))
+
+    assert store.put("b", _saver(300)) is None
+    assert list(store.entries()) == ["a"]
+    assert not (tmp_path / "b.graph").exists()
+
+    # An entry that fits evicts the older ones, never itself
+    path = store.put("c", _saver(200))
+    assert path == store.entry_path("c")
+    assert list(store.entries()) == ["c"]
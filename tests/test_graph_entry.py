@@ -0,0 +1,61 @@
+"""
+Install:
+    pip install pytest
+Usage:
+    python -m pytest tests/test_graph_entry.py
+"""
+import torch
+import torch.nn as nn
+
+from onediff.infer_compiler import oneflow_compile
+from onediff.infer_compiler.utils.metrics import RECOMPILES, metrics_registry
+from onediff.infer_compiler.with_oneflow_compile import OneflowGraph
+
+
+class DeepCacheLike(nn.Module):
+    """Full steps run the whole module, shallow steps reuse the cached feature."""
+
+    def __init__(self):
+        super().__init__()
+        self.deep = nn.Linear(8, 8)
+        self.head = nn.Linear(8, 8)
+
+    def forward(self, x, feature=None):
+        if feature is None:
+            feature = self.deep(x)
+        return self.head(x + feature), feature
+
+
+def test_full_and_shallow_steps_keep_their_graphs(monkeypatch):
+    builds = []
+    build = OneflowGraph.build
+
+    def counted_build(graph, *args, **kwargs):
+        builds.append(len(args) + len(kwargs))
+        return build(graph, *args, **kwargs)
+
+    monkeypatch.setattr(OneflowGraph, "build", counted_build)
+    monkeypatch.setattr(metrics_registry, "enabled", True)
+    recompiles = RECOMPILES.value(reason="input_count", module="DeepCacheLike")
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = DeepCacheLike().to(device)
+    x = torch.randn(2, 8, device=device)
+    expected_out, expected_feature = model(x)
+
+    fast = oneflow_compile(model)
+    full = fast.graph_entry("full_step")
+    assert fast.graph_entry("full_step") is full
+    assert full._deployable_module_model is fast._deployable_module_model
+
+    with torch.no_grad():
+        out, feature = full(x)
+        fast(x, feature)
+        out, feature = full(x)
+        fast(x, feature)
+
+    # One build per kind of step, none at the switches between them
+    assert builds == [1, 2]
+    assert RECOMPILES.value(reason="input_count", module="DeepCacheLike") == recompiles
+    assert torch.allclose(out, expected_out, atol=1e-3)
+    assert torch.allclose(feature, expected_feature, atol=1e-3)
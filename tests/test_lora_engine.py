@@ -0,0 +1,82 @@
+"""
+Install:
+    pip install pytest
+Usage:
+    python -m pytest tests/test_lora_engine.py
+"""
+import torch
+from onediff.lora import (
+    LoRADeltaCache,
+    LoRAUpdate,
+    apply_lora_updates,
+    dequantize_weight,
+    requantize_weight_,
+)
+
+
+def _updates(shapes, rank=4, num_adapters=2):
+    torch.manual_seed(0)
+    updates = []
+    for out_features, in_features in shapes:
+        weight = torch.randn(out_features, in_features)
+        factors = [
+            (torch.randn(out_features, rank), torch.randn(rank, in_features), 0.5)
+            for _ in range(num_adapters)
+        ]
+        updates.append(LoRAUpdate(weight, factors))
+    return updates
+
+
+def test_batched_update_matches_per_layer():
+    updates = _updates([(16, 8), (16, 8), (8, 32)])
+    expected = [
+        u.weight + sum(scale * up @ down for up, down, scale in u.factors)
+        for u in updates
+    ]
+    data_ptrs = [u.weight.data_ptr() for u in updates]
+
+    apply_lora_updates(updates)
+
+    for update, weight, data_ptr in zip(updates, expected, data_ptrs):
+        assert update.weight.data_ptr() == data_ptr
+        assert torch.allclose(update.weight, weight, atol=1e-5)
+
+
+def test_delta_cache_hit():
+    cache = LoRADeltaCache(max_bytes=1 << 20, dtype=None)
+    owner = torch.nn.Linear(8, 16)
+    updates = _updates([(16, 8)])
+    updates[0].cache_owner, updates[0].cache_key = owner, (("a", 0.5),)
+    base = updates[0].weight.clone()
+
+    apply_lora_updates(updates, delta_cache=cache)
+    apply_lora_updates(updates, alpha=-1.0, delta_cache=cache)
+
+    assert cache.stats()["hits"] == 1
+    assert torch.allclose(updates[0].weight, base, atol=1e-5)
+
+
+def test_quantized_update_requantizes():
+    updates = _updates([(16, 8), (16, 8)])
+    expected = []
+    for update in updates:
+        module = torch.nn.Module()
+        module.weight_scale = torch.empty(16)
+        module.weight_acc = torch.empty(16)
+        update.weight = requantize_weight_(update.weight, module).to(torch.int8)
+        update.quant_module = module
+        expected.append(
+            dequantize_weight(update.weight, module)
+            + sum(scale * up @ down for up, down, scale in update.factors)
+        )
+
+    apply_lora_updates(updates)
+
+    for update, weight in zip(updates, expected):
+        assert update.weight.dtype == torch.int8
+        module = update.quant_module
+        dequantized = dequantize_weight(update.weight, module)
+        # Within half a quantization step of each output channel
+        error = (dequantized - weight).abs()
+        assert torch.all(error <= module.weight_scale[:, None] / 2 + 1e-5)
+        assert torch.allclose(module.weight_acc, dequantized.sum(dim=1), atol=1e-5)